@@ -0,0 +1,164 @@
+"""
+Benchmark de la exportación por streaming (GET /api/admin/export): la memoria pico del
+servidor no debe crecer con el número de filas exportadas.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.export_stream                          # 10k, 100k y 500k filas, CSV y NDJSON
+    python -m benchmarks.export_stream --sizes 1000 1000000 --format csv
+    python -m benchmarks.export_stream --fetchall               # compara con fetchall + json.dumps
+
+Crea una tabla sintética (benchmarks/pg_fixture.py) con tantas filas como el mayor tamaño y
+la descarga en proceso (ASGI, sin acumular el cuerpo) con ?limit=N. Por corrida reporta
+filas, MB, filas/s y el pico de memoria de Python (tracemalloc); antes comprueba que sin
+la clave de administrador (AGENT_ADMIN_KEY; se genera una si no hay) la descarga se rechaza. Termina con código 1 si el pico del mayor tamaño supera
+--max-growth veces el del menor.
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from benchmarks.pg_fixture import SYNTHETIC_SCHEMA, generate_synthetic_schema, local_postgres  # noqa: E402
+
+TABLE = f"{SYNTHETIC_SCHEMA}.t_0001"
+
+
+async def _download(app: Any, fmt: str, rows: int, token: Optional[str]) -> Dict[str, Any]:
+    """Llama a la app ASGI directamente y descarta cada fragmento al recibirlo (httpx.ASGITransport
+    acumula el cuerpo entero, y eso es justo lo que se quiere medir en el servidor)."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/admin/export", "raw_path": b"/api/admin/export", "root_path": "",
+        "query_string": urlencode({"table": TABLE, "format": fmt, "limit": rows}).encode(),
+        "headers": [(b"authorization", f"Bearer {token}".encode())] if token else [],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80),
+    }
+    done = asyncio.Event()
+    received = {"status": 0, "bytes": 0, "lines": 0}
+
+    async def receive() -> Dict[str, Any]:
+        if not received.get("requested"):
+            received["requested"] = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        if message["type"] == "http.response.start":
+            received["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            received["bytes"] += len(body)
+            received["lines"] += body.count(b"\n")
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    # CSV lleva una línea de cabecera
+    return {"status": received["status"], "bytes": received["bytes"], "rows": received["lines"] - (1 if fmt == "csv" else 0)}
+
+
+def check_auth(app: Any) -> None:
+    """La exportación no responde sin la clave de administrador (ni con una equivocada)."""
+    for token in (None, "clave-equivocada"):
+        status = asyncio.run(_download(app, "csv", 1, token))["status"]
+        if status not in (401, 403):
+            raise SystemExit(f"La exportación respondió HTTP {status} sin credencial de administrador")
+    print("Exportación sin clave de administrador: rechazada")
+
+
+def _fetchall(rows: int) -> Dict[str, Any]:
+    """Lo que haría subir el límite de get_sample_rows: todas las filas en memoria y un json.dumps."""
+    from psycopg2 import sql
+
+    from src.db import execute_query
+
+    schema, table = TABLE.split(".")
+    query = sql.SQL("SELECT * FROM {}.{} LIMIT {}").format(sql.Identifier(schema), sql.Identifier(table), sql.Literal(rows))
+    data = execute_query(query)
+    body = json.dumps([list(r) for r in data], default=str)
+    return {"bytes": len(body), "rows": len(data)}
+
+
+def measure(app: Any, mode: str, rows: int) -> Dict[str, Any]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = _fetchall(rows) if mode == "fetchall" else asyncio.run(_download(app, mode, rows, os.environ["AGENT_ADMIN_KEY"]))
+    if result.get("status", 200) != 200:
+        raise SystemExit(f"La exportación respondió HTTP {result['status']}")
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "mode": mode,
+        "requested": rows,
+        "rows": result["rows"],
+        "mb": round(result["bytes"] / 1e6, 2),
+        "seconds": round(wall, 3),
+        "rows_per_s": round(result["rows"] / wall) if wall else 0,
+        "peak_mb": round(peak / 1e6, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    parser.add_argument("--format", choices=("csv", "ndjson"), action="append", help="por defecto ambos")
+    parser.add_argument("--columns", type=int, default=12)
+    parser.add_argument("--fetchall", action="store_true", help="incluye la lectura completa en memoria como referencia")
+    parser.add_argument("--max-growth", type=float, default=2.0)
+    parser.add_argument("--pg", choices=("temp", "env"), default="temp")
+    parser.add_argument("--json", type=Path, help="guarda los resultados en este archivo")
+    args = parser.parse_args()
+    sizes = sorted(set(args.sizes))
+    modes: List[str] = (args.format or ["csv", "ndjson"]) + (["fetchall"] if args.fetchall else [])
+
+    workdir = tempfile.mkdtemp(prefix="agent-export-")
+    os.environ.update(AGENT_DATA_DIR=workdir, LLM_WARMUP="0")
+    os.environ.setdefault("AGENT_ADMIN_KEY", secrets.token_urlsafe(16))
+    results: List[Dict[str, Any]] = []
+    try:
+        with local_postgres(args.pg) as connect:
+            generate_synthetic_schema(connect, tables=1, columns=args.columns, rows=sizes[-1])
+            from src.server import app
+
+            check_auth(app)
+            for mode in modes:
+                for rows in sizes:
+                    r = measure(app, mode, rows)
+                    results.append(r)
+                    print(f"{mode:9s} {r['rows']:>9,} filas  {r['mb']:>8} MB  {r['seconds']:>7} s  "
+                          f"{r['rows_per_s']:>8,} filas/s  pico {r['peak_mb']} MB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = False
+    for mode in modes:
+        if mode == "fetchall" or len(sizes) < 2:
+            continue
+        runs = [r for r in results if r["mode"] == mode]
+        growth = runs[-1]["peak_mb"] / max(runs[0]["peak_mb"], 0.01)
+        ok = growth <= args.max_growth
+        failed |= not ok
+        print(f"{mode}: pico x{growth:.2f} de {sizes[0]:,} a {sizes[-1]:,} filas {'OK' if ok else 'REGRESIÓN'}")
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
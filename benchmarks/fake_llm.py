@@ -0,0 +1,154 @@
+"""
+Modelos de chat falsos y deterministas para los benchmarks (sin llamadas a Groq/Gemini).
+
+La respuesta depende solo de los mensajes recibidos y la latencia simulada es
+`latency + jitter * h`, con h en [0, 1) derivado del prompt: dos corridas con la misma
+configuración hacen exactamente el mismo trabajo.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+Responder = Callable[[List[BaseMessage]], AIMessage]
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model con latencia configurable; `responder` decide el contenido."""
+
+    responder: Responder
+    latency: float = 0.0
+    jitter: float = 0.0
+    model_name: str = "fake-bench"
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-bench"
+
+    def _delay(self, messages: List[BaseMessage]) -> float:
+        if not self.jitter:
+            return self.latency
+        digest = hashlib.sha256(str(messages[-1].content if messages else "").encode("utf-8")).digest()
+        return self.latency + self.jitter * (int.from_bytes(digest[:4], "big") / 2**32)
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        message = self.responder(messages)
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([message])
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        delay = self._delay(messages)
+        if delay:
+            time.sleep(delay)
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        delay = self._delay(messages)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._result(messages)
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "FakeChatModel":
+        # Las llamadas a herramientas las decide el responder
+        return self
+
+
+def _prose(words: int, seed: str) -> str:
+    tag = hashlib.sha256(seed.encode("utf-8")).hexdigest()[:8]
+    return f"Respuesta simulada {tag}: " + " ".join(f"palabra{i}" for i in range(words))
+
+
+def _last_human(messages: List[BaseMessage]) -> str:
+    for m in reversed(messages):
+        if isinstance(m, HumanMessage):
+            return str(m.content)
+    return ""
+
+
+def simple_responder(reply_words: int = 60) -> Responder:
+    """Groq/Gemini de src/simple.py: plan JSON para el planificador y prosa para lo demás."""
+    from src.simple import INTENT_KEYWORDS, export_format, extract_table_mention
+
+    action_for = {"overview": "overview", "count": "count_tables", "list": "list_tables"}
+
+    def respond(messages: List[BaseMessage]) -> AIMessage:
+        text = _last_human(messages)
+        if text.startswith("Eres un planificador"):
+            user_text = text.rsplit("Usuario:", 1)[-1].strip()
+            lowered = user_text.lower()
+            table = extract_table_mention(user_text)
+            actions: List[Dict[str, Any]] = []
+            for intent, keywords in INTENT_KEYWORDS.items():
+                if not any(k in lowered for k in keywords):
+                    continue
+                if intent in action_for:
+                    actions.append({"type": action_for[intent]})
+                elif table:
+                    action = {"type": intent, "table": table}
+                    if intent == "sample":
+                        action["limit"] = 5
+                    elif intent == "export":
+                        action["format"] = export_format(user_text)
+                    actions.append(action)
+            plan = {"intent": "bench", "actions": actions, "clarifications": []}
+            return AIMessage(content=json.dumps(plan, ensure_ascii=False))
+        return AIMessage(content=_prose(reply_words, text))
+
+    return respond
+
+
+def galleta_responder(trip_ids: Callable[[], List[int]], reply_words: int = 40) -> Responder:
+    """Modelo de src/main.py: pide reservar_viaje cuando el usuario quiere reservar y, tras la
+    respuesta de la herramienta, confirma en texto. `trip_ids` se consulta en el primer uso."""
+    call_ids = itertools.count()
+    trips: List[int] = []
+
+    def respond(messages: List[BaseMessage]) -> AIMessage:
+        last = messages[-1] if messages else None
+        if isinstance(last, ToolMessage):
+            return AIMessage(content=_prose(reply_words, str(last.content)))
+        text = _last_human(messages)
+        if "reserv" in text.lower():
+            if not trips:
+                trips.extend(trip_ids())
+            digest = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+            viaje_id = trips[digest % len(trips)]
+            return AIMessage(
+                content="",
+                tool_calls=[{
+                    "name": "reservar_viaje",
+                    "args": {"viaje_id": viaje_id, "num_personas": 1 + digest % 3},
+                    "id": f"call_{next(call_ids)}",
+                }],
+            )
+        return AIMessage(content=_prose(reply_words, text))
+
+    return respond
+
+
+def install_fakes(latency: float = 0.0, jitter: float = 0.0, reply_words: int = 60) -> None:
+    """Reemplaza los modelos de src/simple.py, src/server.py y src/main.py por modelos falsos
+    (latencia y jitter en segundos)."""
+    from src import main, server, simple
+
+    simple.llm_groq = FakeChatModel(responder=simple_responder(reply_words), latency=latency, jitter=jitter, model_name="fake-groq")
+    simple.llm_gemini = FakeChatModel(responder=simple_responder(reply_words), latency=latency, jitter=jitter, model_name="fake-gemini")
+    server.llm_groq = simple.llm_groq
+    main.llm = FakeChatModel(
+        responder=galleta_responder(lambda: [v["id"] for v in main.reservas.viajes()], reply_words),
+        latency=latency, jitter=jitter, model_name="fake-galleta",
+    )
@@ -0,0 +1,302 @@
+"""
+Prueba de carga: reproduce las peticiones de requests.jsonl contra POST /api/chat.
+
+Cada línea es una petición de chat ({"message", "user_role"?, "user_id"?, "user_name"?,
+"history"?}). Las líneas sin "message" (p. ej. el backlog con request_id/title/body) usan
+body o title como mensaje y un user_id derivado de request_id entre --users usuarios:
+con pocos usuarios hay más peticiones simultáneas del mismo usuario (contención del historial).
+
+Destinos:
+    python -m benchmarks.load_replay                       # en proceso (ASGI), Postgres temporal
+    python -m benchmarks.load_replay --workers 4           # uvicorn con 4 workers (puerto --port)
+    python -m benchmarks.load_replay --url http://host:8000  # servidor ya levantado, p. ej. con
+        BENCH_LLM_LATENCY_MS=200 uvicorn benchmarks.mock_server:app --workers 4
+
+Carga:
+    -c/--concurrency  máximo de peticiones en vuelo
+    --rate            llegadas por segundo (Poisson, lazo abierto); 0 = lazo cerrado (-c clientes)
+    -n/--requests     total de peticiones (se recorre el archivo en ciclo)
+
+La latencia se mide desde el instante de llegada previsto, así que incluye la espera en
+cola cuando el servidor no da abasto. Reporta throughput, p50/p95/p99/máx, errores por tipo
+y contención por usuario: peticiones que coincidieron con otra del mismo usuario (y su
+latencia) y, del servidor, esperas por el lock de escritura del historial.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from benchmarks.pg_fixture import local_postgres, seed_init_db  # noqa: E402
+from benchmarks.pipeline import _percentile  # noqa: E402
+
+
+def load_requests(path: Path, users: int, role: str) -> List[Dict[str, Any]]:
+    """Lee el archivo JSONL y lo convierte en cuerpos de ChatRequest."""
+    payloads = []
+    for i, line in enumerate(path.read_text(encoding="utf-8").splitlines()):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if "message" in record:
+            payload = {k: record[k] for k in ("message", "user_role", "user_id", "user_name", "history") if k in record}
+        else:
+            payload = {"message": record.get("body") or record.get("title") or ""}
+        key = str(record.get("request_id") or record.get("user_id") or i)
+        payload.setdefault("user_id", 1 + zlib.crc32(key.encode("utf-8")) % users)
+        payload.setdefault("user_role", role)
+        payloads.append(payload)
+    if not payloads:
+        raise SystemExit(f"{path} no tiene peticiones")
+    return payloads
+
+
+def _arrivals(n: int, rate: float, seed: int) -> List[float]:
+    """Instantes de llegada (s desde el inicio) de un proceso de Poisson de `rate` por segundo."""
+    rng = random.Random(seed)
+    t, out = 0.0, []
+    for _ in range(n):
+        t += rng.expovariate(rate)
+        out.append(t)
+    return out
+
+
+async def replay(
+    client: httpx.AsyncClient,
+    payloads: List[Dict[str, Any]],
+    requests: int,
+    concurrency: int,
+    rate: float,
+    headers: Dict[str, str],
+    seed: int,
+) -> Tuple[List[Dict[str, Any]], float]:
+    """Envía las peticiones y devuelve un registro por petición y la duración total."""
+    results: List[Dict[str, Any]] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async def send(i: int, intended: float) -> None:
+        payload = payloads[i % len(payloads)]
+        async with semaphore:
+            sent = time.perf_counter()
+            status, error = 0, None
+            try:
+                resp = await client.post("/api/chat", json=payload, headers=headers)
+                status = resp.status_code
+                if status != 200:
+                    error = f"HTTP {status}"
+            except Exception as e:
+                error = type(e).__name__
+            done = time.perf_counter()
+        results.append({
+            "user_id": payload["user_id"],
+            "start": sent - started,
+            "end": done - started,
+            "latency": done - (started + intended),
+            "service": done - sent,
+            "error": error,
+        })
+
+    if rate > 0:
+        tasks = []
+        for i, at in enumerate(_arrivals(requests, rate, seed)):
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(i, at)))
+        await asyncio.gather(*tasks)
+    else:
+        counter = iter(range(requests))
+
+        async def worker() -> None:
+            for i in counter:
+                await send(i, time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+def user_overlap(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Peticiones que estuvieron en vuelo a la vez que otra del mismo usuario."""
+    by_user: Dict[Any, List[Dict[str, Any]]] = defaultdict(list)
+    for r in results:
+        by_user[r["user_id"]].append(r)
+    overlapped: List[float] = []
+    alone: List[float] = []
+    max_parallel = 0
+    for reqs in by_user.values():
+        reqs.sort(key=lambda r: r["start"])
+        events = sorted([(r["start"], 1) for r in reqs] + [(r["end"], -1) for r in reqs], key=lambda e: (e[0], e[1]))
+        level = 0
+        for _, delta in events:
+            level += delta
+            max_parallel = max(max_parallel, level)
+        for r in reqs:
+            clash = any(o is not r and o["start"] < r["end"] and r["start"] < o["end"] for o in reqs)
+            (overlapped if clash else alone).append(r["service"])
+    return {
+        "users": len(by_user),
+        "overlapping_requests": len(overlapped),
+        "overlapping_ratio": round(len(overlapped) / len(results), 4) if results else 0.0,
+        "max_parallel_same_user": max_parallel,
+        "p95_ms_overlapping": round(_percentile(sorted(overlapped), 0.95) * 1000, 2),
+        "p95_ms_alone": round(_percentile(sorted(alone), 0.95) * 1000, 2),
+    }
+
+
+def summarize(results: List[Dict[str, Any]], wall: float) -> Dict[str, Any]:
+    ok = sorted(r["latency"] for r in results if not r["error"])
+    errors = Counter(r["error"] for r in results if r["error"])
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(sum(errors.values()) / len(results), 4) if results else 0.0,
+        "errors": dict(errors),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(ok, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(ok, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(ok, 0.99) * 1000, 2),
+        "max_ms": round(ok[-1] * 1000, 2) if ok else 0.0,
+        "contention": user_overlap(results),
+    }
+
+
+async def _server_stats(client: httpx.AsyncClient, headers: Dict[str, str]) -> Dict[str, Any]:
+    try:
+        resp = await client.get("/api/admin/user-cache", headers=headers)
+        return resp.json() if resp.status_code == 200 else {}
+    except Exception:
+        return {}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_uvicorn(workers: int, port: int, stack: ExitStack) -> str:
+    cmd = [sys.executable, "-m", "uvicorn", "benchmarks.mock_server:app", "--workers", str(workers),
+           "--port", str(port), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=ROOT)
+    stack.callback(lambda: (proc.terminate(), proc.wait(timeout=30)))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit("uvicorn terminó al arrancar (¿está instalado? pip install 'uvicorn[standard]')")
+        try:
+            httpx.get(url + "/docs", timeout=1)
+            return url
+        except httpx.HTTPError:
+            time.sleep(0.3)
+    raise SystemExit("uvicorn no respondió en 60 s")
+
+
+async def run(args: argparse.Namespace, payloads: List[Dict[str, Any]], target: Any) -> Dict[str, Any]:
+    token = args.token or os.getenv("AGENT_API_KEY")
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if isinstance(target, str):
+        client = httpx.AsyncClient(base_url=target, timeout=args.timeout, limits=limits)
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=target), base_url="http://bench", timeout=args.timeout)
+    async with client:
+        before = await _server_stats(client, headers)
+        results, wall = await replay(client, payloads, args.requests, args.concurrency, args.rate, headers, args.seed)
+        after = await _server_stats(client, headers)
+    summary = summarize(results, wall)
+    # Con varios workers cada uno tiene sus contadores: son los del worker que respondió
+    summary["server"] = {
+        k: after[k] - before.get(k, 0) if isinstance(after[k], (int, float)) and not k.endswith(("_max", "_avg", "_per_request")) else after[k]
+        for k in after
+        if k.startswith("history_") or k in ("disk_reads", "disk_writes", "requests")
+    }
+    return summary
+
+
+def print_report(summary: Dict[str, Any]) -> None:
+    c = summary["contention"]
+    print(f"peticiones      {summary['requests']} ({summary['ok']} ok, tasa de error {summary['error_rate']:.2%})")
+    if summary["errors"]:
+        print(f"errores         {summary['errors']}")
+    print(f"throughput      {summary['throughput_rps']} pet/s")
+    print(f"latencia (ms)   p50 {summary['p50_ms']}  p95 {summary['p95_ms']}  p99 {summary['p99_ms']}  máx {summary['max_ms']}")
+    print(f"por usuario     {c['users']} usuarios, {c['overlapping_requests']} peticiones ({c['overlapping_ratio']:.1%}) "
+          f"coincidieron con otra del mismo usuario; máx. {c['max_parallel_same_user']} a la vez")
+    print(f"                p95 servicio: {c['p95_ms_overlapping']} ms con coincidencia / {c['p95_ms_alone']} ms sin ella")
+    s = summary.get("server") or {}
+    if "history_writes" in s:
+        print(f"historial       {s['history_writes']} escrituras, {s['history_contended_writes']} esperaron el lock del usuario "
+              f"(espera total {s['history_lock_wait_ms_total']} ms, máx {s['history_lock_wait_ms_max']} ms, "
+              f"escritura media {s['history_write_ms_avg']} ms)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", type=Path, default=ROOT / "requests.jsonl")
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0.0, help="llegadas/s (0 = lazo cerrado)")
+    parser.add_argument("--users", type=int, default=5, help="usuarios entre los que se reparten las peticiones sin user_id")
+    parser.add_argument("--role", default="administrador", help="rol de las peticiones que no lo traen")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--token", help="Bearer token (por defecto AGENT_API_KEY)")
+    parser.add_argument("--url", help="servidor ya levantado; si no, se arranca uno con modelos falsos")
+    parser.add_argument("--workers", type=int, default=0, help="arranca uvicorn con N workers (0 = en proceso, ASGI)")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--pg", choices=("temp", "env"), default="temp", help="BD del servidor arrancado aquí")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--json", type=Path, help="guarda el resumen en este archivo")
+    args = parser.parse_args()
+
+    payloads = load_requests(args.file, args.users, args.role)
+    with ExitStack() as stack:
+        if args.url:
+            target: Any = args.url
+        else:
+            workdir = tempfile.mkdtemp(prefix="agent-load-")
+            stack.callback(shutil.rmtree, workdir, True)
+            os.environ.update(
+                AGENT_DATA_DIR=workdir,
+                LLM_CACHE_ENABLED="0",
+                LLM_WARMUP="0",
+                BENCH_LLM_LATENCY_MS=str(args.llm_latency_ms),
+                BENCH_LLM_JITTER_MS=str(args.llm_jitter_ms),
+            )
+            seed_init_db(stack.enter_context(local_postgres(args.pg)))
+            if args.workers:
+                target = _start_uvicorn(args.workers, args.port or _free_port(), stack)
+            else:
+                from benchmarks.mock_server import app
+
+                target = app
+        summary = asyncio.run(run(args, payloads, target))
+
+    print_report(summary)
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""
+La app de src/server.py con modelos falsos (benchmarks/fake_llm.py), para pruebas de carga
+sin llamar a Groq ni a Gemini:
+
+    BENCH_LLM_LATENCY_MS=200 uvicorn benchmarks.mock_server:app --workers 4
+
+Variables: BENCH_LLM_LATENCY_MS (50), BENCH_LLM_JITTER_MS (20), BENCH_REPLY_WORDS (60).
+La caché de LLM y la precarga de modelos se desactivan salvo que se pidan explícitamente.
+"""
+import os
+
+os.environ.setdefault("LLM_WARMUP", "0")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+
+from benchmarks.fake_llm import install_fakes  # noqa: E402
+from src.server import app  # noqa: E402,F401
+
+install_fakes(
+    float(os.getenv("BENCH_LLM_LATENCY_MS", "50")) / 1000,
+    float(os.getenv("BENCH_LLM_JITTER_MS", "20")) / 1000,
+    int(os.getenv("BENCH_REPLY_WORDS", "60")),
+)
@@ -0,0 +1,128 @@
+"""
+Postgres local para los benchmarks, sembrado con init_db.sql y, opcionalmente, con un
+esquema sintético grande (muchas tablas/columnas/filas) para estresar el catálogo.
+
+Modos:
+  temp -> servidor desechable con `pgserver` (pip install pgserver) en un directorio temporal
+  env  -> la BD configurada para src/db.py (DB_* / .env), aislada en el esquema `agent_bench` (search_path vía PGOPTIONS);
+          al terminar se borran `agent_bench` y el esquema sintético salvo con keep=True
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import psycopg2
+
+ROOT = Path(__file__).resolve().parent.parent
+INIT_SQL = ROOT / "init_db.sql"
+BENCH_SCHEMA = "agent_bench"
+SYNTHETIC_SCHEMA = "bench_synth"
+
+# Tipos que rota el generador (nombre de columna, tipo SQL, expresión para generate_series `g`)
+_COLUMN_TYPES = [
+    ("cantidad", "integer", "(g * 7) % 1000"),
+    ("nombre", "text", "'item ' || g"),
+    ("monto", "numeric(12, 2)", "(g % 5000) / 3.0"),
+    ("creado", "timestamp", "timestamp '2024-01-01' + g * interval '1 minute'"),
+    ("activo", "boolean", "g % 2 = 0"),
+    ("codigo", "varchar(32)", "md5(g::text)"),
+]
+
+
+Connect = Callable[[], Any]
+
+
+def _autocommit(connect: Connect):
+    conn = connect()
+    conn.autocommit = True
+    return conn
+
+
+def seed_init_db(connect: Connect, seats: int = 1_000_000) -> None:
+    """Crea las tablas de init_db.sql y deja cupos de sobra para los escenarios de reserva."""
+    with _autocommit(connect) as conn, conn.cursor() as cur:
+        cur.execute(INIT_SQL.read_text(encoding="utf-8"))
+        cur.execute("TRUNCATE reservaciones")
+        cur.execute("UPDATE viajes SET cupos_disponibles = %s", (seats,))
+    conn.close()
+
+
+def generate_synthetic_schema(
+    connect: Connect,
+    tables: int = 50,
+    columns: int = 12,
+    rows: int = 1000,
+    schema: str = SYNTHETIC_SCHEMA,
+) -> None:
+    """(Re)crea `schema` con `tables` tablas de `columns` columnas y `rows` filas cada una.
+
+    Cada quinta tabla tiene una FK a la anterior y todas un índice secundario, para que
+    columnas, PK, FK e índices del catálogo tengan contenido. Se termina con ANALYZE para
+    que el conteo estimado (reltuples) sea realista.
+    """
+    with _autocommit(connect) as conn, conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        cur.execute(f'CREATE SCHEMA "{schema}"')
+        for t in range(1, tables + 1):
+            name = f'"{schema}".t_{t:04d}'
+            cols = [("id", "integer PRIMARY KEY", "g")]
+            for c in range(columns - 1):
+                col, sql_type, expr = _COLUMN_TYPES[c % len(_COLUMN_TYPES)]
+                cols.append((f"{col}_{c}", sql_type, expr))
+            if t > 1 and t % 5 == 0:
+                cols.append(("padre_id", f'integer REFERENCES "{schema}".t_{t - 1:04d}(id)', f"1 + (g % {max(rows, 1)})"))
+            cur.execute(f"CREATE TABLE {name} (" + ", ".join(f"{c} {ty}" for c, ty, _ in cols) + ")")
+            # Sin parámetros: las expresiones usan % (módulo)
+            cur.execute(
+                f"INSERT INTO {name} (" + ", ".join(c for c, _, _ in cols) + ") "
+                "SELECT " + ", ".join(e for _, _, e in cols) + f" FROM generate_series(1, {int(rows)}) AS g"
+            )
+            cur.execute(f"CREATE INDEX ON {name} ({cols[1][0]})")
+        cur.execute("ANALYZE")
+    conn.close()
+
+
+@contextmanager
+def local_postgres(mode: str = "temp", keep: bool = False) -> Iterator[Connect]:
+    """Deja listas las variables de entorno de la BD (antes de importar src/) y devuelve una
+    función que abre conexiones nuevas a ella."""
+    if mode == "temp":
+        try:
+            import pgserver
+        except ImportError as e:
+            raise SystemExit("El modo temp necesita `pip install pgserver` (o usa --pg env).") from e
+        pgdata = tempfile.mkdtemp(prefix="agent-bench-pg-")
+        server = pgserver.get_server(pgdata, cleanup_mode="stop")
+        # Sin cadena .NET: src/db.py debe usar las DB_* que se fijan aquí
+        os.environ.update(
+            DB_CONNECTION_STRING="", DOTNET_DEFAULT_CONNECTION="",
+            DB_HOST=pgdata, DB_NAME="postgres", DB_USER="postgres", DB_PASSWORD="bench", DB_PORT="5432", DB_SSLMODE="disable",
+        )
+        try:
+            yield lambda: psycopg2.connect(host=pgdata, dbname="postgres", user="postgres", password="bench", sslmode="disable")
+        finally:
+            if not keep:
+                server.cleanup()
+                shutil.rmtree(pgdata, ignore_errors=True)
+        return
+
+    if mode != "env":
+        raise ValueError(f"Modo de Postgres desconocido: {mode}")
+    # libpq lee PGOPTIONS en cada conexión: también las del pool de src/db.py
+    os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+    from src.db import get_db_connection
+
+    with _autocommit(get_db_connection) as conn, conn.cursor() as cur:
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS "{BENCH_SCHEMA}"')
+    conn.close()
+    try:
+        yield get_db_connection
+    finally:
+        if not keep:
+            with _autocommit(get_db_connection) as conn, conn.cursor() as cur:
+                cur.execute(f'DROP SCHEMA IF EXISTS "{BENCH_SCHEMA}" CASCADE')
+                cur.execute(f'DROP SCHEMA IF EXISTS "{SYNTHETIC_SCHEMA}" CASCADE')
+            conn.close()
@@ -0,0 +1,341 @@
+"""
+Benchmark offline del pipeline del agente: modelos de chat falsos con latencia configurable
+(benchmarks/fake_llm.py) y un Postgres local sembrado con init_db.sql (benchmarks/pg_fixture.py).
+No llama a Groq ni a Gemini.
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.pipeline                               # todos los escenarios
+    python -m benchmarks.pipeline -s columns -s galleta_booking -n 500 -c 32
+    python -m benchmarks.pipeline --llm-latency-ms 300 --synthetic-tables 500
+    python -m benchmarks.pipeline --save-baseline               # guarda la línea base
+    python -m benchmarks.pipeline --pg env                      # BD de .env, esquema agent_bench
+
+Por escenario reporta p50/p95/p99, peticiones/s, idas a la BD y llamadas al LLM por petición
+y la ruta de nodos del grafo. Si hay una línea base con la misma configuración se compara
+y el proceso termina con código 1 ante regresiones: latencia o throughput fuera de la
+tolerancia, más idas a la BD o al LLM por petición, otra ruta, o (escenario conversation)
+un prompt que crece con la longitud de la conversación.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from benchmarks.pg_fixture import BENCH_SCHEMA, generate_synthetic_schema, local_postgres, seed_init_db  # noqa: E402
+
+DEFAULT_BASELINE = ROOT / "benchmarks" / "baselines" / "pipeline.json"
+
+# Escenarios del grafo de src/simple.py (rol administrador): mensaje del usuario.
+# {schema} es "" con --pg temp y "agent_bench." con --pg env, donde public puede tener
+# tablas con el mismo nombre y la tabla sin esquema sería ambigua.
+SIMPLE_SCENARIOS = {
+    "overview": "Dame un overview de toda la base de datos",
+    "list": "Muéstrame las tablas",
+    "columns": "¿Qué columnas tiene la tabla {schema}viajes?",
+    "rowcount": "¿Cuántas filas tiene la tabla {schema}reservaciones?",
+    "sample": "Muestra filas de la tabla {schema}viajes, primeros 5",
+    # Varias intenciones a la vez: el planificador por reglas cede el plan al LLM
+    "llm_plan": "Describe la tabla {schema}viajes: sus columnas y cuántas filas tiene",
+}
+SCENARIOS = list(SIMPLE_SCENARIOS) + ["galleta_booking", "conversation"]
+
+# Parámetros que deben coincidir con la línea base para que la comparación tenga sentido
+CONFIG_KEYS = (
+    "requests", "concurrency", "llm_latency_ms", "llm_jitter_ms", "reply_words",
+    "synthetic_tables", "synthetic_columns", "synthetic_rows", "llm_cache", "cold_schema", "turns",
+)
+
+# Mensajes de la conversación larga: todos pasan por el LLM, que recibe el historial
+CONVERSATION_SCENARIOS = ("columns", "sample", "llm_plan")
+# El prompt de la conversación larga no debe crecer: media de los últimos turnos frente a
+# la de los turnos 10-21, cuando la ventana de historial ya se llenó (mismas vueltas de mensajes)
+MAX_PROMPT_GROWTH = 1.2
+# Diferencias menores no cuentan como regresión: ruido de planificación del SO en latencias
+# cortas, y pings del pool / chequeos de huella del esquema que suman idas a la BD ocasionales
+NOISE_MS = 10.0
+NOISE_PER_REQUEST = 0.1
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def _summarize(latencies: List[float], db: List[float], llm: List[float], errors: List[str], wall: float, path: str) -> Dict[str, Any]:
+    ordered = sorted(latencies)
+    n = len(ordered)
+    return {
+        "requests": n + len(errors),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "rps": round(n / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 2),
+        "db_per_request": round(statistics.fmean(db), 3) if db else 0.0,
+        "llm_per_request": round(statistics.fmean(llm), 3) if llm else 0.0,
+        "path": path,
+    }
+
+
+def _path(trace) -> str:
+    return ">".join(s["node"] for s in trace.spans) or "-"
+
+
+async def run_load(name: str, call: Callable[[int], Awaitable[Any]], requests: int, concurrency: int, warmup: int) -> Dict[str, Any]:
+    """Ejecuta `call(i)` `requests` veces con `concurrency` en vuelo y resume lo medido."""
+    from src.metrics import request_trace
+
+    for i in range(warmup):
+        await call(-1 - i)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    db: List[float] = []
+    llm: List[float] = []
+    errors: List[str] = []
+    paths: List[str] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                with request_trace(f"bench_{name}") as trace:
+                    await call(i)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+                return
+            latencies.append(time.perf_counter() - start)
+            db.append(trace.totals["db_queries"])
+            llm.append(trace.totals["llm_calls"])
+            if not paths:
+                paths.append(_path(trace))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return _summarize(latencies, db, llm, errors, time.perf_counter() - started, paths[0] if paths else "-")
+
+
+async def run_conversation(turns: int, scenarios: Dict[str, str]) -> Dict[str, Any]:
+    """Una conversación de `turns` turnos por /api/chat (historial, resumen y grafo reales).
+
+    Además de la latencia mide los tokens de prompt que el grafo envía al LLM en cada turno:
+    con el historial compactado deben mantenerse planos aunque la conversación crezca.
+    """
+    from src import server
+
+    messages = [scenarios[name] for name in CONVERSATION_SCENARIOS]
+    user_id = 900_000 + os.getpid() % 10_000
+    latencies: List[float] = []
+    db: List[float] = []
+    llm: List[float] = []
+    prompt_tokens: List[float] = []
+    errors: List[str] = []
+    started = time.perf_counter()
+    for turn in range(turns):
+        req = server.ChatRequest(message=messages[turn % len(messages)], user_role="administrador", user_id=user_id, debug=True)
+        start = time.perf_counter()
+        try:
+            response = await server.chat(req, authorization=f"Bearer {server.AGENT_API_KEY}" if server.AGENT_API_KEY else None)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            continue
+        latencies.append(time.perf_counter() - start)
+        # El endpoint abre su propia traza; con debug=True la devuelve en `timings`
+        timings = response["timings"]
+        db.append(timings["db_queries"])
+        llm.append(timings["llm_calls"])
+        prompt_tokens.append(sum(n.get("input_tokens", 0) for n in timings["nodes"]))
+    server.user_cache.flush()
+
+    result = _summarize(latencies, db, llm, errors, time.perf_counter() - started, "-")
+    # Ventanas de 4 vueltas que empiezan en el mismo mensaje, para comparar la misma mezcla
+    period = len(messages)
+    span = 4 * period
+    if not errors and len(prompt_tokens) >= 9 + 2 * span:
+        late_start = 9 + (len(prompt_tokens) - 9 - span) // period * period
+        early = statistics.fmean(prompt_tokens[9:9 + span])
+        late = statistics.fmean(prompt_tokens[late_start:late_start + span])
+        result.update(
+            prompt_tokens_first=prompt_tokens[0],
+            prompt_tokens_last=prompt_tokens[-1],
+            prompt_tokens_max=max(prompt_tokens),
+            prompt_growth=round(late / early, 3) if early else 0.0,
+        )
+    return result
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regresiones de `current` frente a `baseline` (mismos escenarios)."""
+    problems: List[str] = []
+    for name, cur in current.items():
+        growth = cur.get("prompt_growth")
+        if growth and growth > MAX_PROMPT_GROWTH:
+            problems.append(f"{name}: el prompt crece con la conversación (x{growth})")
+        base = baseline.get(name)
+        if not base:
+            continue
+        slower = cur["p50_ms"] - base["p50_ms"] > NOISE_MS or cur["p95_ms"] - base["p95_ms"] > NOISE_MS
+        if slower and cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {base['p95_ms']} -> {cur['p95_ms']} ms")
+        if slower and cur["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {base['rps']} -> {cur['rps']}")
+        for key, label in (("db_per_request", "idas a la BD"), ("llm_per_request", "llamadas al LLM")):
+            if cur[key] > base[key] + NOISE_PER_REQUEST:
+                problems.append(f"{name}: {label}/petición {base[key]} -> {cur[key]}")
+        if base.get("path") and cur["path"] != base["path"]:
+            problems.append(f"{name}: ruta {base['path']} -> {cur['path']}")
+        if cur["errors"] > base["errors"]:
+            problems.append(f"{name}: errores {base['errors']} -> {cur['errors']} ({cur['first_error']})")
+    return problems
+
+
+def print_report(results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Any]]) -> None:
+    header = f"{'escenario':<16}{'n':>6}{'err':>5}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'bd/pet':>8}{'llm/pet':>8}  ruta"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(
+            f"{name:<16}{r['requests']:>6}{r['errors']:>5}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}"
+            f"{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['db_per_request']:>8.2f}{r['llm_per_request']:>8.2f}  {r['path']}"
+        )
+        base = (baseline or {}).get(name)
+        if base:
+            print(f"{'  base':<16}{'':>11}{base['rps']:>10.1f}{base['p50_ms']:>10.2f}{base['p95_ms']:>10.2f}"
+                  f"{base['p99_ms']:>10.2f}{base['db_per_request']:>8.2f}{base['llm_per_request']:>8.2f}")
+        if "prompt_growth" in r:
+            print(f"{'':<16}tokens de prompt: 1er turno {r['prompt_tokens_first']}, último {r['prompt_tokens_last']}, "
+                  f"máx {r['prompt_tokens_max']}, crecimiento x{r['prompt_growth']}")
+        if r["first_error"]:
+            print(f"{'':<16}primer error: {r['first_error']}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    # Importar después de preparar el entorno: src/ lee la configuración al importarse
+    from langchain_core.messages import HumanMessage
+
+    from benchmarks.fake_llm import install_fakes
+    from src import main, simple
+    from src.catalog import schema_cache
+
+    prefix = f"{BENCH_SCHEMA}." if args.pg == "env" else ""
+    scenarios = {name: text.format(schema=prefix) for name, text in SIMPLE_SCENARIOS.items()}
+    install_fakes(args.llm_latency_ms / 1000, args.llm_jitter_ms / 1000, args.reply_words)
+
+    def simple_call(text: str):
+        async def call(i: int):
+            if args.cold_schema:
+                schema_cache.invalidate()
+            return await simple.agent.ainvoke(
+                {"messages": [HumanMessage(content=text)], "user_role": "administrador", "user_id": 1}
+            )
+        return call
+
+    async def galleta_call(i: int):
+        result = await main.agent.ainvoke(
+            {"messages": [HumanMessage(content=f"Quiero reservar un viaje (pedido {i})")]},
+            config={"configurable": {"user_id": 1000 + i % 50}},
+        )
+        # La reserva debe haber pasado por la herramienta (y haberse confirmado)
+        if not any(getattr(m, "type", "") == "tool" and '"success": true' in str(m.content) for m in result["messages"]):
+            raise RuntimeError(f"reserva no confirmada: {result['messages'][-2].content}")
+        return result
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in args.scenario:
+        if name == "conversation":
+            results[name] = await run_conversation(args.turns, scenarios)
+        else:
+            call = galleta_call if name == "galleta_booking" else simple_call(scenarios[name])
+            results[name] = await run_load(name, call, args.requests, args.concurrency, args.warmup)
+        print(f"  {name}: {results[name]['rps']} pet/s, p95 {results[name]['p95_ms']} ms", file=sys.stderr)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--scenario", action="append", choices=SCENARIOS, help="repetible; por defecto todos")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="peticiones medidas por escenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=100, help="turnos del escenario conversation")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--llm-cache", action="store_true", help="deja activa la caché de LLM (por defecto se desactiva)")
+    parser.add_argument("--cold-schema", action="store_true", help="vacía la caché de metadatos antes de cada petición")
+    parser.add_argument("--synthetic-tables", type=int, default=0, help="tablas del esquema sintético (0 = sin él)")
+    parser.add_argument("--synthetic-columns", type=int, default=12)
+    parser.add_argument("--synthetic-rows", type=int, default=1000)
+    parser.add_argument("--pg", choices=("temp", "env"), default="temp")
+    parser.add_argument("--keep-db", action="store_true", help="no borra el servidor/esquemas al terminar")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="guarda estos resultados como línea base")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="margen relativo para latencia y rps (el ruido entre corridas ronda el 30%%)")
+    parser.add_argument("--json", type=Path, help="guarda los resultados en este archivo")
+    args = parser.parse_args()
+    args.scenario = args.scenario or SCENARIOS
+
+    config = {k: getattr(args, k) for k in CONFIG_KEYS}
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    os.environ.update(
+        LLM_CACHE_ENABLED="1" if args.llm_cache else "0",
+        LLM_CACHE_PATH=str(Path(workdir) / "llm_cache.sqlite"),
+        AGENT_DATA_DIR=workdir,
+        GALLETA_STORE="postgres",
+        GALLETA_CHECKPOINTER="none",
+        LLM_WARMUP="0",
+    )
+
+    with local_postgres(args.pg, keep=args.keep_db) as connect:
+        seed_init_db(connect)
+        if args.synthetic_tables:
+            print(f"Generando esquema sintético ({args.synthetic_tables} tablas)...", file=sys.stderr)
+            generate_synthetic_schema(connect, args.synthetic_tables, args.synthetic_columns, args.synthetic_rows)
+        results = asyncio.run(run(args))
+        from src.db import close_pool
+
+        close_pool()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline.exists() and not args.save_baseline:
+        stored = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if stored.get("config") == config:
+            baseline = stored["scenarios"]
+        else:
+            print(f"La línea base {args.baseline} usa otra configuración; no se compara.", file=sys.stderr)
+
+    print_report(results, baseline)
+    payload = {"config": config, "scenarios": results}
+    if args.json:
+        args.json.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(payload, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"Línea base guardada en {args.baseline}")
+
+    problems = compare(baseline or {}, results, args.tolerance)
+    if problems:
+        print("\nRegresiones:")
+        for p in problems:
+            print(f"  - {p}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark de arranque: tiempo de import de cada módulo del proyecto en un proceso nuevo.
+
+Uso (desde la raíz del repo):
+    python benchmarks/startup.py                 # todos los módulos, 5 repeticiones
+    python benchmarks/startup.py src.server -n 10
+    python benchmarks/startup.py --top 15        # además, los imports más pesados
+    python benchmarks/startup.py --models        # además, lo que tarda crear los modelos (1er uso)
+
+Cada medición usa `python -X importtime`, así que no la afectan los módulos ya cargados
+por otra medición.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+MODULES = [
+    "src.db",
+    "src.catalog",
+    "src.llm_cache",
+    "src.history_store",
+    "src.lazy_llm",
+    "src.simple",
+    "src.main",
+    "src.server",
+]
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_times(module: str) -> Tuple[float, List[Tuple[int, str]]]:
+    """Importa `module` en un proceso nuevo. Devuelve (ms totales, [(µs acumulados, módulo)])."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}:\n{proc.stderr[-2000:]}")
+    rows = []
+    total = 0
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        cumulative, name = int(m.group(2)), m.group(4)
+        rows.append((cumulative, name))
+        if name == module:
+            total = cumulative
+    return total / 1000, rows
+
+
+def model_init_times() -> Dict[str, float]:
+    """Milisegundos que tarda crear cada modelo en su primer uso (carga del SDK incluida)."""
+    code = (
+        "import json, time\n"
+        "from src.simple import llm_groq, llm_gemini\n"
+        "out = {}\n"
+        "for name, m in (('groq', llm_groq), ('gemini', llm_gemini)):\n"
+        "    t = time.perf_counter(); m.get(); out[name] = (time.perf_counter() - t) * 1000\n"
+        "print(json.dumps(out))\n"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="muestra los N imports más pesados de cada módulo")
+    parser.add_argument("--models", action="store_true", help="mide también la creación de los modelos")
+    parser.add_argument("--json", help="guarda los resultados (mediana en ms por módulo) en este archivo")
+    args = parser.parse_args()
+
+    results: Dict[str, float] = {}
+    print(f"{'módulo':<22}{'mediana':>10}{'mín':>10}{'máx':>10}   (ms, {args.repeat} procesos)")
+    for module in args.modules:
+        samples = []
+        rows: List[Tuple[int, str]] = []
+        for _ in range(args.repeat):
+            ms, rows = import_times(module)
+            samples.append(ms)
+        results[module] = statistics.median(samples)
+        print(f"{module:<22}{results[module]:>10.1f}{min(samples):>10.1f}{max(samples):>10.1f}")
+        if args.top:
+            # Solo paquetes de primer nivel bajo el módulo medido, para no contar dos veces
+            heaviest = sorted((r for r in rows if r[1] != module and "." not in r[1]), reverse=True)[: args.top]
+            for cumulative, name in heaviest:
+                print(f"    {cumulative / 1000:>9.1f}  {name}")
+
+    if args.models:
+        for name, ms in model_init_times().items():
+            print(f"{'1er uso ' + name:<22}{ms:>10.1f}")
+            results[f"model:{name}"] = ms
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
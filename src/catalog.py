@@ -0,0 +1,295 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, TypedDict
+
+from src.db import execute_query, pooled_connection
+from src.metrics import record_cache
+
+
+class TableMeta(TypedDict):
+    schema: str
+    name: str
+    columns: List[tuple]               # (column_name, data_type, is_nullable) como get_columns
+    primary_key: List[str]
+    foreign_keys: List[Dict[str, Any]]  # mismo formato que get_foreign_keys
+    indexes: List[Dict[str, Any]]       # mismo formato que get_indexes
+
+
+# Cada consulta recorre el catálogo completo una sola vez (set-based), sin importar
+# cuántas tablas haya. Se filtra por el mismo conjunto de tablas en todas.
+_TABLES_FILTER = """
+    c.relkind IN ('r', 'p')
+    AND n.nspname NOT LIKE 'pg\\_toast%%'
+    AND n.nspname NOT LIKE 'pg\\_temp%%'
+    AND (%(include_system)s OR n.nspname NOT IN ('pg_catalog', 'information_schema'))
+"""
+
+_TABLES_SQL = f"""
+SELECT n.nspname, c.relname
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE {_TABLES_FILTER}
+ORDER BY n.nspname, c.relname
+"""
+
+_COLUMNS_SQL = f"""
+SELECT n.nspname, c.relname, a.attname,
+       pg_catalog.format_type(a.atttypid, a.atttypmod),
+       CASE WHEN a.attnotnull THEN 'NO' ELSE 'YES' END
+FROM pg_catalog.pg_attribute a
+JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE {_TABLES_FILTER}
+  AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY n.nspname, c.relname, a.attnum
+"""
+
+_PRIMARY_KEYS_SQL = f"""
+SELECT n.nspname, c.relname, a.attname
+FROM pg_catalog.pg_constraint con
+JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+CROSS JOIN LATERAL unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+WHERE con.contype = 'p' AND {_TABLES_FILTER}
+ORDER BY n.nspname, c.relname, k.ord
+"""
+
+_FOREIGN_KEYS_SQL = f"""
+SELECT n.nspname, c.relname, con.conname, a.attname,
+       rn.nspname, rc.relname, ra.attname
+FROM pg_catalog.pg_constraint con
+JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_class rc ON rc.oid = con.confrelid
+JOIN pg_catalog.pg_namespace rn ON rn.oid = rc.relnamespace
+CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY AS k(attnum, ref_attnum, ord)
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+JOIN pg_catalog.pg_attribute ra ON ra.attrelid = rc.oid AND ra.attnum = k.ref_attnum
+WHERE con.contype = 'f' AND {_TABLES_FILTER}
+ORDER BY n.nspname, c.relname, con.conname, k.ord
+"""
+
+_INDEXES_SQL = f"""
+SELECT n.nspname, c.relname, ic.relname, pg_catalog.pg_get_indexdef(i.indexrelid)
+FROM pg_catalog.pg_index i
+JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE {_TABLES_FILTER}
+ORDER BY n.nspname, c.relname, ic.relname
+"""
+
+
+def load_catalog_snapshot(include_system: bool = False) -> Dict[Tuple[str, str], TableMeta]:
+    """Carga columnas, PKs, FKs e índices de TODAS las tablas con cinco consultas
+    sobre pg_catalog, usando una sola conexión. Devuelve {(schema, tabla): TableMeta}
+    ordenado por esquema y tabla.
+
+    Las cinco consultas comparten una transacción REPEATABLE READ de solo lectura: ven
+    el mismo catálogo aunque otra sesión cree o borre tablas entre una y otra.
+    """
+    params = {"include_system": include_system}
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            # Primera sentencia de la transacción: solo afecta a esta (pooled_connection hace commit)
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            cur.execute(_TABLES_SQL, params)
+            tables = cur.fetchall()
+            cur.execute(_COLUMNS_SQL, params)
+            columns = cur.fetchall()
+            cur.execute(_PRIMARY_KEYS_SQL, params)
+            pks = cur.fetchall()
+            cur.execute(_FOREIGN_KEYS_SQL, params)
+            fks = cur.fetchall()
+            cur.execute(_INDEXES_SQL, params)
+            indexes = cur.fetchall()
+
+    snapshot: Dict[Tuple[str, str], TableMeta] = {
+        (s, t): {"schema": s, "name": t, "columns": [], "primary_key": [], "foreign_keys": [], "indexes": []}
+        for s, t in tables
+    }
+    for s, t, col, typ, nullable in columns:
+        snapshot[(s, t)]["columns"].append((col, typ, nullable))
+    for s, t, col in pks:
+        snapshot[(s, t)]["primary_key"].append(col)
+    for s, t, name, col, rs, rt, rc in fks:
+        table_fks = snapshot[(s, t)]["foreign_keys"]
+        if not table_fks or table_fks[-1]["constraint"] != name:
+            table_fks.append({"constraint": name, "columns": [], "ref_schema": rs, "ref_table": rt, "ref_columns": []})
+        table_fks[-1]["columns"].append(col)
+        table_fks[-1]["ref_columns"].append(rc)
+    for s, t, name, definition in indexes:
+        snapshot[(s, t)]["indexes"].append({"name": name, "def": definition})
+    return snapshot
+
+
+def render_overview(snapshot: Dict[Tuple[str, str], TableMeta], max_tables: Optional[int] = None) -> str:
+    """Genera el texto de visión general a partir del modelo en memoria."""
+    if not snapshot:
+        return "No se encontraron tablas (excluyendo schemas del sistema)."
+    lines: List[str] = []
+    for count, meta in enumerate(snapshot.values()):
+        if max_tables is not None and count >= max_tables:
+            break
+        lines.append(f"# {meta['schema']}.{meta['name']}")
+        if meta["columns"]:
+            lines.append("- Columnas:")
+            for c, t, n in meta["columns"]:
+                lines.append(f"  - {c}: {t} nullable={n}")
+        if meta["primary_key"]:
+            lines.append(f"- PK: {', '.join(meta['primary_key'])}")
+        if meta["foreign_keys"]:
+            lines.append("- FKs:")
+            for fk in meta["foreign_keys"]:
+                cols_s = ", ".join(fk["columns"])
+                ref_cols_s = ", ".join(fk["ref_columns"])
+                lines.append(f"  - {fk['constraint']}: ({cols_s}) -> {fk['ref_schema']}.{fk['ref_table']}({ref_cols_s})")
+        if meta["indexes"]:
+            lines.append("- Índices:")
+            for i in meta["indexes"]:
+                lines.append(f"  - {i['name']}: {i['def']}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+# ------------------ CACHÉ DE METADATOS ------------------
+
+# El esquema cambia muy poco: los metadatos se guardan con un TTL largo y se invalidan
+# antes si cambia la "huella" del catálogo (se comprueba como mucho cada CHECK_INTERVAL s).
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "3600"))
+SCHEMA_CACHE_MAX_ENTRIES = int(os.getenv("SCHEMA_CACHE_MAX_ENTRIES", "512"))
+SCHEMA_CACHE_CHECK_INTERVAL = float(os.getenv("SCHEMA_CACHE_CHECK_INTERVAL", "30"))
+
+# Cualquier DDL (CREATE/ALTER/DROP/RENAME) reescribe filas de pg_class, pg_attribute,
+# pg_constraint o pg_namespace, cambiando su xmin; basta con agregarlos.
+_FINGERPRINT_SQL = """
+SELECT
+  (SELECT count(*) || ':' || coalesce(sum(xmin::text::bigint), 0) FROM pg_catalog.pg_namespace),
+  (SELECT count(*) || ':' || coalesce(sum(xmin::text::bigint), 0)
+     FROM pg_catalog.pg_class WHERE relkind IN ('r', 'p', 'i')),
+  (SELECT count(*) || ':' || coalesce(sum(a.xmin::text::bigint), 0)
+     FROM pg_catalog.pg_attribute a
+     JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+     WHERE c.relkind IN ('r', 'p') AND a.attnum > 0),
+  (SELECT count(*) || ':' || coalesce(sum(xmin::text::bigint), 0) FROM pg_catalog.pg_constraint)
+"""
+
+
+def schema_fingerprint() -> Tuple[Any, ...]:
+    """Huella barata del catálogo; cambia cuando se ejecuta DDL."""
+    rows = execute_query(_FINGERPRINT_SQL)
+    return tuple(rows[0]) if rows else ()
+
+
+class SchemaCache:
+    """Caché LRU con TTL para metadatos del esquema, con contadores de aciertos/fallos.
+
+    `fingerprint` es una función opcional que devuelve la huella actual del catálogo;
+    si cambia respecto a la última vista se vacía toda la caché.
+    """
+
+    def __init__(
+        self,
+        ttl: float = SCHEMA_CACHE_TTL,
+        max_entries: int = SCHEMA_CACHE_MAX_ENTRIES,
+        check_interval: float = SCHEMA_CACHE_CHECK_INTERVAL,
+        fingerprint: Optional[Callable[[], Any]] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self._fingerprint_fn = fingerprint
+        self._fingerprint: Any = None
+        self._last_check = 0.0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_schema_changed(self) -> None:
+        if self._fingerprint_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            current = self._fingerprint_fn()
+        except Exception:
+            # Si no se puede verificar, se confía en el TTL
+            return
+        if self._fingerprint is not None and current != self._fingerprint:
+            self.invalidate()
+        self._fingerprint = current
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        self._check_schema_changed()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                record_cache("schema", True)
+                return entry[1]
+            self.misses += 1
+        record_cache("schema", False)
+        value = loader()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, prefix: Optional[str] = None) -> int:
+        """Elimina todas las entradas (o solo las cuya clave empieza por `prefix`)."""
+        with self._lock:
+            if prefix is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [k for k in self._entries if isinstance(k, tuple) and k and k[0] == prefix]
+                for k in keys:
+                    del self._entries[k]
+                removed = len(keys)
+            self.invalidations += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# Caché compartida por todo el proceso
+schema_cache = SchemaCache(fingerprint=schema_fingerprint)
+
+
+def cached_schema_lookup(kind: str):
+    """Decorador: memoriza el resultado de una consulta de metadatos en `schema_cache`
+    bajo la clave (kind, *args). `kind` permite invalidar por tipo de consulta.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (kind,) + args + tuple(sorted(kwargs.items()))
+            return schema_cache.get_or_load(key, lambda: fn(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,460 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+
+# Checkpointer durable para hilos de LangGraph (SQLite o PostgreSQL):
+#   - cada checkpoint se guarda serializado en una fila; las escrituras pendientes en otra tabla
+#   - compactación: solo se conservan los últimos `keep_last` checkpoints por hilo
+#   - TTL/evicción: los hilos sin actividad en `ttl` segundos (o más allá de `max_threads`) se borran
+#   - capa caliente: LRU acotada en memoria con el último checkpoint de los hilos activos,
+#     para no releer la BD al inicio de cada turno (es por proceso: con varios workers
+#     cada hilo debe atenderlo siempre el mismo, o usar hot_size=0)
+
+Runner = Callable[[str, tuple], List[tuple]]
+
+
+class SqliteCheckpointBackend:
+    """Tablas en un archivo SQLite (WAL, una conexión por hilo)."""
+
+    blob_type = "BLOB"
+    real_type = "REAL"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self) -> Iterator[Runner]:
+        db = self._conn()
+        with db:
+            yield lambda query, params=(): db.execute(query, params).fetchall()
+
+
+class PostgresCheckpointBackend:
+    """Tablas en la base de datos del proyecto, usando el pool de src/db.py."""
+
+    blob_type = "BYTEA"
+    real_type = "DOUBLE PRECISION"
+
+    @contextmanager
+    def transaction(self) -> Iterator[Runner]:
+        from src.db import pooled_connection
+
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                def run(query: str, params: tuple = ()) -> List[tuple]:
+                    cur.execute(query.replace("?", "%s"), params)
+                    rows = cur.fetchall() if cur.description else []
+                    # BYTEA llega como memoryview
+                    return [tuple(bytes(v) if isinstance(v, memoryview) else v for v in r) for r in rows]
+
+                yield run
+
+
+class DurableCheckpointSaver(BaseCheckpointSaver):
+    def __init__(
+        self,
+        backend,
+        ttl: float = 0,
+        keep_last: int = 20,
+        hot_size: int = 256,
+        max_threads: int = 0,
+        sweep_interval: float = 300,
+        serde=None,
+    ):
+        """`ttl`: segundos sin actividad tras los que se borra un hilo (0 = nunca).
+        `keep_last`: checkpoints conservados por hilo/namespace (0 = todos).
+        `hot_size`: hilos cuyo último checkpoint se guarda en memoria.
+        `max_threads`: hilos conservados en total; se borran los menos recientes (0 = sin límite).
+        `sweep_interval`: cada cuántos segundos (como mucho) se aplican TTL y max_threads."""
+        super().__init__(serde=serde)
+        self.backend = backend
+        self.ttl = ttl
+        self.keep_last = keep_last
+        self.hot_size = hot_size
+        self.max_threads = max_threads
+        self.sweep_interval = sweep_interval
+        # (thread_id, ns) -> (checkpoint_id, parent_id, checkpoint serializado, metadata serializada)
+        self._hot: "OrderedDict[Tuple[str, str], Tuple[str, Optional[str], Tuple[str, bytes], Tuple[str, bytes]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.hot_hits = 0
+        self.hot_misses = 0
+        self.evicted_threads = 0
+        self._setup()
+
+    def _setup(self) -> None:
+        blob, real = self.backend.blob_type, self.backend.real_type
+        with self.backend.transaction() as run:
+            run(
+                "CREATE TABLE IF NOT EXISTS graph_checkpoints ("
+                " thread_id TEXT NOT NULL,"
+                " checkpoint_ns TEXT NOT NULL DEFAULT '',"
+                " checkpoint_id TEXT NOT NULL,"
+                " parent_checkpoint_id TEXT,"
+                " checkpoint_type TEXT NOT NULL,"
+                f" checkpoint {blob} NOT NULL,"
+                " metadata_type TEXT NOT NULL,"
+                f" metadata {blob} NOT NULL,"
+                " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))"
+            )
+            run(
+                "CREATE TABLE IF NOT EXISTS graph_checkpoint_writes ("
+                " thread_id TEXT NOT NULL,"
+                " checkpoint_ns TEXT NOT NULL DEFAULT '',"
+                " checkpoint_id TEXT NOT NULL,"
+                " task_id TEXT NOT NULL,"
+                " idx INTEGER NOT NULL,"
+                " channel TEXT NOT NULL,"
+                " value_type TEXT NOT NULL,"
+                f" value {blob} NOT NULL,"
+                " task_path TEXT NOT NULL DEFAULT '',"
+                " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))"
+            )
+            run(
+                "CREATE TABLE IF NOT EXISTS graph_threads ("
+                " thread_id TEXT PRIMARY KEY,"
+                f" last_access {real} NOT NULL)"
+            )
+            run("CREATE INDEX IF NOT EXISTS idx_graph_threads_access ON graph_threads(last_access)")
+
+    # ------------------ CAPA CALIENTE ------------------
+
+    def _hot_get(self, key: Tuple[str, str]):
+        with self._lock:
+            entry = self._hot.get(key)
+            if entry is None:
+                self.hot_misses += 1
+                return None
+            self._hot.move_to_end(key)
+            self.hot_hits += 1
+            return entry
+
+    def _hot_put(self, key: Tuple[str, str], entry) -> None:
+        if self.hot_size <= 0:
+            return
+        with self._lock:
+            self._hot[key] = entry
+            self._hot.move_to_end(key)
+            while len(self._hot) > self.hot_size:
+                self._hot.popitem(last=False)
+
+    def _hot_drop(self, thread_id: str, checkpoint_ns: Optional[str] = None) -> None:
+        with self._lock:
+            for key in [k for k in self._hot if k[0] == thread_id and checkpoint_ns in (None, k[1])]:
+                del self._hot[key]
+
+    # ------------------ LECTURA ------------------
+
+    def _load_writes(self, run: Runner, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> List[Tuple[str, str, Any]]:
+        rows = run(
+            "SELECT task_id, idx, channel, value_type, value, task_path FROM graph_checkpoint_writes"
+            " WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        )
+        rows.sort(key=lambda r: writes_sort_key(r[5], r[0], r[1]))
+        return [(task_id, channel, self.serde.loads_typed((vtype, value))) for task_id, _, channel, vtype, value, _ in rows]
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, entry, pending_writes) -> CheckpointTuple:
+        checkpoint_id, parent_id, checkpoint, metadata = entry
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed(checkpoint),
+            metadata=self.serde.loads_typed(metadata),
+            pending_writes=pending_writes,
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id
+                else None
+            ),
+        )
+
+    _SELECT = (
+        "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,"
+        " checkpoint_type, checkpoint, metadata_type, metadata FROM graph_checkpoints"
+    )
+
+    @staticmethod
+    def _entry(row: tuple):
+        return row[2], row[3], (row[4], row[5]), (row[6], row[7])
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        key = (thread_id, checkpoint_ns)
+        if not checkpoint_id:
+            # En la capa caliente solo hay checkpoints sin escrituras pendientes
+            entry = self._hot_get(key)
+            if entry is not None:
+                return self._to_tuple(thread_id, checkpoint_ns, entry, [])
+        with self.backend.transaction() as run:
+            if checkpoint_id:
+                rows = run(self._SELECT + " WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id=?", (thread_id, checkpoint_ns, checkpoint_id))
+            else:
+                rows = run(self._SELECT + " WHERE thread_id=? AND checkpoint_ns=? ORDER BY checkpoint_id DESC LIMIT 1", (thread_id, checkpoint_ns))
+            if not rows:
+                return None
+            entry = self._entry(rows[0])
+            writes = self._load_writes(run, thread_id, checkpoint_ns, entry[0])
+        if not checkpoint_id and not writes:
+            self._hot_put(key, entry)
+        return self._to_tuple(thread_id, checkpoint_ns, entry, writes)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        where, params = [], []
+        if config:
+            where.append("thread_id=?")
+            params.append(str(config["configurable"]["thread_id"]))
+            if config["configurable"].get("checkpoint_ns") is not None:
+                where.append("checkpoint_ns=?")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append("checkpoint_id=?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append("checkpoint_id<?")
+            params.append(before_id)
+        query = self._SELECT + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY checkpoint_id DESC"
+        results: List[CheckpointTuple] = []
+        with self.backend.transaction() as run:
+            for row in run(query, tuple(params)):
+                entry = self._entry(row)
+                if filter:
+                    metadata = self.serde.loads_typed(entry[3])
+                    if not all(metadata.get(k) == v for k, v in filter.items()):
+                        continue
+                if limit is not None and len(results) >= limit:
+                    break
+                writes = self._load_writes(run, row[0], row[1], entry[0])
+                results.append(self._to_tuple(row[0], row[1], entry, writes))
+        yield from results
+
+    # ------------------ ESCRITURA ------------------
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        entry = (
+            checkpoint["id"],
+            parent_id,
+            self.serde.dumps_typed(checkpoint),
+            self.serde.dumps_typed(get_checkpoint_metadata(config, metadata)),
+        )
+        with self.backend.transaction() as run:
+            run(
+                "INSERT INTO graph_checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,"
+                " checkpoint_type, checkpoint, metadata_type, metadata) VALUES (?,?,?,?,?,?,?,?)"
+                " ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id) DO UPDATE SET"
+                " checkpoint_type=excluded.checkpoint_type, checkpoint=excluded.checkpoint,"
+                " metadata_type=excluded.metadata_type, metadata=excluded.metadata",
+                (thread_id, checkpoint_ns, entry[0], parent_id, entry[2][0], entry[2][1], entry[3][0], entry[3][1]),
+            )
+            run(
+                "INSERT INTO graph_threads (thread_id, last_access) VALUES (?,?)"
+                " ON CONFLICT (thread_id) DO UPDATE SET last_access=excluded.last_access",
+                (thread_id, time.time()),
+            )
+            if self.keep_last > 0:
+                self._compact(run, thread_id, checkpoint_ns, self.keep_last)
+        self._hot_put((thread_id, checkpoint_ns), entry)
+        self._maybe_sweep()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # El checkpoint ahora tiene escrituras pendientes: se lee de la BD hasta el próximo put
+        self._hot_drop(thread_id, checkpoint_ns)
+        with self.backend.transaction() as run:
+            for idx, (channel, value) in enumerate(writes):
+                idx = WRITES_IDX_MAP.get(channel, idx)
+                vtype, vbytes = self.serde.dumps_typed(value)
+                # Escrituras especiales (índice negativo) reemplazan; las normales no se duplican
+                conflict = (
+                    "DO UPDATE SET channel=excluded.channel, value_type=excluded.value_type, value=excluded.value"
+                    if idx < 0
+                    else "DO NOTHING"
+                )
+                run(
+                    "INSERT INTO graph_checkpoint_writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx,"
+                    " channel, value_type, value, task_path) VALUES (?,?,?,?,?,?,?,?,?)"
+                    " ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id, task_id, idx) " + conflict,
+                    (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, vtype, vbytes, task_path),
+                )
+
+    # ------------------ LIMPIEZA ------------------
+
+    @staticmethod
+    def _compact(run: Runner, thread_id: str, checkpoint_ns: str, keep: int) -> None:
+        """Borra los checkpoints (y sus escrituras) anteriores a los `keep` más recientes."""
+        cutoff = run(
+            "SELECT checkpoint_id FROM graph_checkpoints WHERE thread_id=? AND checkpoint_ns=?"
+            " ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+            (thread_id, checkpoint_ns, keep - 1),
+        )
+        if not cutoff:
+            return
+        for table in ("graph_checkpoints", "graph_checkpoint_writes"):
+            run(
+                f"DELETE FROM {table} WHERE thread_id=? AND checkpoint_ns=? AND checkpoint_id<?",
+                (thread_id, checkpoint_ns, cutoff[0][0]),
+            )
+
+    def _delete_threads(self, run: Runner, thread_ids: Sequence[str]) -> None:
+        for thread_id in thread_ids:
+            for table in ("graph_checkpoints", "graph_checkpoint_writes", "graph_threads"):
+                run(f"DELETE FROM {table} WHERE thread_id=?", (thread_id,))
+            self._hot_drop(thread_id)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.backend.transaction() as run:
+            self._delete_threads(run, [str(thread_id)])
+
+    def prune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        """Compacta hilos a su último checkpoint ("keep_latest") o los borra ("delete")."""
+        with self.backend.transaction() as run:
+            if strategy == "delete":
+                self._delete_threads(run, [str(t) for t in thread_ids])
+                return
+            for thread_id in thread_ids:
+                namespaces = run("SELECT DISTINCT checkpoint_ns FROM graph_checkpoints WHERE thread_id=?", (str(thread_id),))
+                for (checkpoint_ns,) in namespaces:
+                    self._compact(run, str(thread_id), checkpoint_ns, 1)
+                self._hot_drop(str(thread_id))
+
+    def evict_expired(self) -> int:
+        """Aplica TTL y max_threads. Devuelve cuántos hilos se borraron."""
+        with self.backend.transaction() as run:
+            expired: List[str] = []
+            if self.ttl > 0:
+                expired += [r[0] for r in run("SELECT thread_id FROM graph_threads WHERE last_access<?", (time.time() - self.ttl,))]
+            if self.max_threads > 0:
+                expired += [
+                    r[0]
+                    for r in run(
+                        "SELECT thread_id FROM graph_threads WHERE last_access<("
+                        " SELECT last_access FROM graph_threads ORDER BY last_access DESC LIMIT 1 OFFSET ?)",
+                        (self.max_threads - 1,),
+                    )
+                ]
+            expired = list(dict.fromkeys(expired))
+            self._delete_threads(run, expired)
+        self.evicted_threads += len(expired)
+        return len(expired)
+
+    def _maybe_sweep(self) -> None:
+        if self.ttl <= 0 and self.max_threads <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+        self.evict_expired()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.backend.transaction() as run:
+            threads = run("SELECT COUNT(*) FROM graph_threads")[0][0]
+            checkpoints = run("SELECT COUNT(*) FROM graph_checkpoints")[0][0]
+        with self._lock:
+            hot = len(self._hot)
+        return {
+            "threads": threads,
+            "checkpoints": checkpoints,
+            "hot_threads": hot,
+            "hot_hits": self.hot_hits,
+            "hot_misses": self.hot_misses,
+            "evicted_threads": self.evicted_threads,
+        }
+
+    # ------------------ ASYNC ------------------
+    # La E/S es síncrona (sqlite3/psycopg2); en async se delega a un hilo
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    async def aprune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        await asyncio.to_thread(self.prune, thread_ids, strategy=strategy)
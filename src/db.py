@@ -0,0 +1,268 @@
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from dotenv import load_dotenv
+
+from src.metrics import record_db_query
+
+load_dotenv()
+
+# Configuración de la base de datos por variables de entorno o cadena .NET
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "database": os.getenv("DB_NAME"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+    "port": int(os.getenv("DB_PORT", "5432")),
+    "sslmode": os.getenv("DB_SSLMODE", "require"),
+}
+
+DOTNET_CONNSTR = os.getenv("DB_CONNECTION_STRING") or os.getenv("DOTNET_DEFAULT_CONNECTION")
+
+# Pool de conexiones: tamaño mínimo/máximo, espera máxima por una conexión libre
+# y segundos de inactividad tras los cuales se hace un ping antes de reutilizarla.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+
+# Errores que indican una conexión caída (reinicio del servidor, timeout de red, etc.)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def _parse_dotnet_pg_connstr(conn: str) -> Dict[str, Any]:
+    """Convierte una connection string estilo .NET (con ;) a kwargs de psycopg2."""
+    parts = [p.strip() for p in conn.strip().split(";") if p.strip()]
+    kv = {}
+    for p in parts:
+        if "=" not in p:
+            continue
+        k, v = p.split("=", 1)
+        kv[k.strip().lower()] = v.strip()
+    host = kv.get("host") or kv.get("server")
+    database = kv.get("database") or kv.get("dbname")
+    user = kv.get("username") or kv.get("user id") or kv.get("user")
+    password = kv.get("password")
+    port = int(kv.get("port", "5432"))
+    sslmode = (kv.get("ssl mode") or kv.get("sslmode") or "require").lower()
+    # Trust Server Certificate=true -> mantener sslmode=require; psycopg2 no soporta "trust" explícito
+    return {
+        "host": host,
+        "database": database,
+        "user": user,
+        "password": password,
+        "port": port,
+        "sslmode": sslmode,
+    }
+
+@lru_cache(maxsize=1)
+def _effective_db_config() -> Dict[str, Any]:
+    if DOTNET_CONNSTR:
+        return _parse_dotnet_pg_connstr(DOTNET_CONNSTR)
+    return DB_CONFIG
+
+def _checked_db_config() -> Dict[str, Any]:
+    cfg = _effective_db_config()
+    missing = [k for k, v in cfg.items() if v in (None, "")]
+    if missing:
+        raise RuntimeError(f"Variables/campos faltantes para DB: {', '.join(missing)}")
+    return cfg
+
+def get_db_connection():
+    """Establece una conexión nueva (fuera del pool) con la base de datos PostgreSQL"""
+    return psycopg2.connect(**_checked_db_config())
+
+
+# ------------------ POOL DE CONEXIONES ------------------
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor de las conexiones del pool: registra cada sentencia (ida y vuelta a la BD) en
+    src/metrics.py, también las que no pasan por execute_query (catálogo, reservas, checkpoints)."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = super().execute(query, vars)
+            ok = True
+            return result
+        finally:
+            record_db_query(time.perf_counter() - start, ok)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = super().executemany(query, vars_list)
+            ok = True
+            return result
+        finally:
+            record_db_query(time.perf_counter() - start, ok)
+
+
+_pool: Optional[pg_pool.ThreadedConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_slots: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+# id(conn) -> instante (monotonic) en que volvió al pool
+_last_used: Dict[int, float] = {}
+
+
+def get_pool() -> pg_pool.ThreadedConnectionPool:
+    """Devuelve el pool del proceso, creándolo en el primer uso (y tras un fork)."""
+    global _pool, _pool_pid, _pool_slots
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Tras un fork (p. ej. workers de uvicorn) las conexiones heredadas no se comparten
+            _pool = pg_pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, cursor_factory=InstrumentedCursor, **_checked_db_config()
+            )
+            _pool_pid = pid
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _last_used.clear()
+    return _pool
+
+
+def close_pool() -> None:
+    """Cierra todas las conexiones del pool (p. ej. al apagar el servidor)."""
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+        _pool_slots = None
+        _last_used.clear()
+
+
+def _is_healthy(conn) -> bool:
+    """Verifica la conexión al sacarla del pool; solo hace ping si estuvo inactiva un rato."""
+    if conn.closed:
+        return False
+    idle_since = _last_used.get(id(conn))
+    if idle_since is not None and time.monotonic() - idle_since < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except CONNECTION_ERRORS:
+        return False
+
+
+def _checkout(pool: pg_pool.ThreadedConnectionPool):
+    # Se reintenta hasta DB_POOL_MAX veces: cada conexión rota se descarta y se abre otra
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise RuntimeError("No se pudo obtener una conexión sana del pool de BD.")
+
+
+@contextmanager
+def pooled_connection() -> Iterator[Any]:
+    """Presta una conexión del pool. Hace commit al salir y rollback si hubo error.
+
+    Si la espera por una conexión libre supera DB_POOL_TIMEOUT se lanza RuntimeError.
+    Las conexiones caídas se cierran y no vuelven a prestarse.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise RuntimeError(f"Pool de BD agotado ({DB_POOL_MAX} conexiones en uso).")
+    conn = None
+    broken = False
+    try:
+        conn = _checkout(pool)
+        yield conn
+        conn.commit()
+    except CONNECTION_ERRORS:
+        broken = True
+        raise
+    except Exception:
+        if conn is not None and not conn.closed:
+            try:
+                conn.rollback()
+            except CONNECTION_ERRORS:
+                broken = True
+        raise
+    finally:
+        if conn is not None:
+            broken = broken or bool(conn.closed)
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=broken)
+        slots.release()
+
+
+def execute_query(query, params: tuple = None) -> List[tuple]:
+    """Ejecuta una consulta SQL con una conexión del pool y retorna las filas.
+
+    Si la conexión se cae a mitad de la consulta se reintenta una vez con otra conexión.
+    """
+    for attempt in range(2):
+        try:
+            with pooled_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, params or ())
+                    if cur.description:
+                        return cur.fetchall()
+                    return []
+        except CONNECTION_ERRORS:
+            if attempt:
+                raise
+    return []
+
+
+def stream_query(query, params: tuple = None, batch_size: int = 1000) -> Iterator[Any]:
+    """Ejecuta una consulta con un cursor de servidor (con nombre) y la entrega por lotes.
+
+    Produce primero la tupla de nombres de columna y luego listas de hasta `batch_size`
+    filas: en memoria nunca hay más de un lote, sin importar cuántas filas devuelva.
+    La conexión del pool queda prestada hasta que el generador se agota o se cierra
+    (p. ej. si el cliente corta la descarga); al salir se descarta la transacción.
+    """
+    with pooled_connection() as conn:
+        # El cursor con nombre es un DECLARE ... CURSOR: vive en la transacción de la conexión
+        cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        try:
+            cur.execute(query, params or ())
+            headers = None
+            while True:
+                # Cada fetchmany es un FETCH al servidor (una ida a la BD)
+                start = time.perf_counter()
+                ok = False
+                try:
+                    rows = cur.fetchmany(batch_size)
+                    ok = True
+                finally:
+                    record_db_query(time.perf_counter() - start, ok)
+                if headers is None:
+                    headers = tuple(desc[0] for desc in cur.description)
+                    yield headers
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Solo lectura: el rollback cierra el cursor también cuando el generador se
+            # abandona a medias (GeneratorExit no pasa por el rollback de pooled_connection)
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except CONNECTION_ERRORS:
+                    pass
@@ -0,0 +1,398 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.metrics import record_user_cache
+
+# Historial de conversaciones en SQLite (modo WAL): cada turno es una fila nueva, así que
+# guardar un turno cuesta lo mismo tenga el usuario 5 o 5000 mensajes, y leer los últimos N
+# usa el índice (user_id, id) sin cargar el resto.
+
+Turn = Tuple[str, str]  # (role, content)
+TurnRow = Tuple[int, str, str]  # (id, role, content)
+
+
+class ConversationStore:
+    def __init__(self, path: Path, legacy_dir: Optional[Path] = None, retention: int = 0):
+        """`legacy_dir`: carpeta con los antiguos {user_id}.json, que se importan en el primer acceso.
+        `retention`: turnos que se conservan por usuario (0 = todos)."""
+        self.path = Path(path)
+        self.legacy_dir = Path(legacy_dir) if legacy_dir else None
+        self.retention = retention
+        self._local = threading.local()
+        self._user_locks: Dict[int, threading.Lock] = defaultdict(threading.Lock)
+        self._user_locks_guard = threading.Lock()
+        self._migrated: set = set()
+        # Contención por usuario al escribir (peticiones simultáneas del mismo usuario)
+        self._stats_lock = threading.Lock()
+        self.write_stats: Dict[str, float] = {
+            "writes": 0, "contended_writes": 0, "lock_wait_seconds": 0.0, "max_lock_wait_seconds": 0.0, "write_seconds": 0.0,
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " user_id INTEGER NOT NULL,"
+                " role TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_turns_user ON turns(user_id, id)")
+            # Resumen acumulado de los turnos que ya salieron de la ventana (hasta until_id)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " user_id INTEGER PRIMARY KEY,"
+                " until_id INTEGER NOT NULL,"
+                " summary TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una conexión por hilo; WAL permite lectores concurrentes con un escritor
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def user_lock(self, user_id: int) -> threading.Lock:
+        with self._user_locks_guard:
+            return self._user_locks[int(user_id)]
+
+    def _import_legacy(self, user_id: int) -> None:
+        """Importa una sola vez el historial del antiguo formato JSON, si existe."""
+        if user_id in self._migrated:
+            return
+        self._migrated.add(user_id)
+        if not self.legacy_dir:
+            return
+        p = self.legacy_dir / f"{user_id}.json"
+        if not p.exists():
+            return
+        try:
+            data = json.loads(p.read_text(encoding="utf-8"))
+            turns = [(t["role"], t["content"]) for t in data]
+        except Exception:
+            return
+        db = self._conn()
+        with db:
+            exists = db.execute("SELECT 1 FROM turns WHERE user_id=? LIMIT 1", (user_id,)).fetchone()
+            if not exists:
+                now = time.time()
+                db.executemany(
+                    "INSERT INTO turns (user_id, role, content, created_at) VALUES (?,?,?,?)",
+                    [(user_id, r, c, now) for r, c in turns],
+                )
+        p.rename(p.with_suffix(".json.migrated"))
+
+    def append(
+        self, user_id: int, turns: Iterable[Turn], on_commit: Optional[Callable[[List[int]], None]] = None
+    ) -> List[int]:
+        """Agrega turnos al final del historial del usuario (una transacción). Devuelve sus ids.
+        `on_commit(ids)` se llama tras confirmar, aún con el lock del usuario tomado: así las
+        copias en memoria se actualizan en el mismo orden que los ids."""
+        user_id = int(user_id)
+        rows = [(user_id, role, content, time.time()) for role, content in turns]
+        if not rows:
+            return []
+        lock = self.user_lock(user_id)
+        contended = lock.locked()
+        requested = time.perf_counter()
+        with lock:
+            acquired = time.perf_counter()
+            self._import_legacy(user_id)
+            db = self._conn()
+            with db:
+                ids = [
+                    db.execute("INSERT INTO turns (user_id, role, content, created_at) VALUES (?,?,?,?)", row).lastrowid
+                    for row in rows
+                ]
+                if self.retention > 0:
+                    db.execute(
+                        "DELETE FROM turns WHERE user_id=? AND id <= ("
+                        " SELECT id FROM turns WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (user_id, user_id, self.retention),
+                    )
+            if on_commit is not None:
+                on_commit(ids)
+        self._record_write(contended, acquired - requested, time.perf_counter() - acquired)
+        return ids
+
+    def _record_write(self, contended: bool, waited: float, elapsed: float) -> None:
+        with self._stats_lock:
+            st = self.write_stats
+            st["writes"] += 1
+            st["contended_writes"] += int(contended)
+            st["lock_wait_seconds"] += waited
+            st["max_lock_wait_seconds"] = max(st["max_lock_wait_seconds"], waited)
+            st["write_seconds"] += elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        """Escrituras al historial y cuánto esperaron por el lock del usuario."""
+        with self._stats_lock:
+            st = dict(self.write_stats)
+        writes = st["writes"]
+        return {
+            "history_writes": int(writes),
+            "history_contended_writes": int(st["contended_writes"]),
+            "history_lock_wait_ms_total": round(st["lock_wait_seconds"] * 1000, 3),
+            "history_lock_wait_ms_max": round(st["max_lock_wait_seconds"] * 1000, 3),
+            "history_write_ms_avg": round(st["write_seconds"] * 1000 / writes, 3) if writes else 0.0,
+        }
+
+    def recent(self, user_id: int, limit: int = 50) -> List[Turn]:
+        """Últimos `limit` turnos en orden cronológico."""
+        return [(r, c) for _, r, c in self.recent_rows(user_id, limit)]
+
+    def recent_rows(self, user_id: int, limit: int = 50) -> List[TurnRow]:
+        """Como recent() pero con el id de cada turno."""
+        user_id = int(user_id)
+        if user_id not in self._migrated:
+            with self.user_lock(user_id):
+                self._import_legacy(user_id)
+        rows = self._conn().execute(
+            "SELECT id, role, content FROM turns WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return [(i, r, c) for i, r, c in rows]
+
+    def rows_between(self, user_id: int, after_id: int, before_id: int, limit: int = 200) -> List[TurnRow]:
+        """Turnos con after_id < id < before_id (los `limit` más recientes), en orden cronológico."""
+        rows = self._conn().execute(
+            "SELECT id, role, content FROM turns WHERE user_id=? AND id>? AND id<? ORDER BY id DESC LIMIT ?",
+            (int(user_id), after_id, before_id, limit),
+        ).fetchall()
+        rows.reverse()
+        return [(i, r, c) for i, r, c in rows]
+
+    def get_summary(self, user_id: int) -> Optional[Tuple[int, str]]:
+        row = self._conn().execute(
+            "SELECT until_id, summary FROM summaries WHERE user_id=?", (int(user_id),)
+        ).fetchone()
+        return (int(row[0]), row[1]) if row else None
+
+    def save_summary(self, user_id: int, until_id: int, summary: str) -> None:
+        db = self._conn()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO summaries (user_id, until_id, summary, updated_at) VALUES (?,?,?,?)",
+                (int(user_id), until_id, summary, time.time()),
+            )
+
+    def count(self, user_id: int) -> int:
+        row = self._conn().execute("SELECT COUNT(*) FROM turns WHERE user_id=?", (int(user_id),)).fetchone()
+        return int(row[0])
+
+
+# ------------------ CACHÉ EN MEMORIA POR USUARIO ------------------
+
+class UserCache:
+    """LRU en memoria con el perfil y los turnos recientes de cada usuario.
+
+    - Perfiles: escritura diferida (write-behind). Un cambio marca el perfil como sucio y un
+      hilo lo guarda cada `flush_interval` s; si el perfil no cambió no se escribe nada.
+    - Historial: se agrega en SQLite en el momento (es O(1)) y se actualiza la copia en memoria.
+    - Las entradas caducan tras `ttl` s para acotar la desactualización con varios workers.
+
+    Con varios workers (uvicorn --workers N) cada proceso tiene su copia: un worker puede no
+    ver hasta `ttl` s los turnos que otro guardó para el mismo usuario. Con
+    `cache_history=False` el historial se lee siempre de SQLite (compartido) y solo se
+    cachean los perfiles.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        load_profile: Callable[[int], dict],
+        save_profile: Callable[[int, dict], None],
+        max_users: int = 1024,
+        window: int = 50,
+        ttl: float = 300.0,
+        flush_interval: float = 2.0,
+        cache_history: bool = True,
+    ):
+        self.store = store
+        self._load_profile = load_profile
+        self._save_profile = save_profile
+        self.max_users = max_users
+        self.window = window
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_history = cache_history
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._dirty: Dict[int, dict] = {}
+        self._lock = threading.RLock()
+        self._flush_event = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.counters = {
+            "requests": 0,
+            "profile_hits": 0,
+            "profile_misses": 0,
+            "history_hits": 0,
+            "history_misses": 0,
+            "disk_reads": 0,
+            "disk_writes": 0,
+            "skipped_writes": 0,
+        }
+        atexit.register(self.flush)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+        # /metrics y, para la E/S de disco, el desglose de la petición en curso (src/metrics.py)
+        record_user_cache(name, n)
+
+    def _entry(self, user_id: int) -> Dict[str, Any]:
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is None or now - entry["loaded_at"] > self.ttl:
+            # Un perfil pendiente de guardar manda sobre lo que haya en disco
+            dirty = self._dirty.get(user_id)
+            entry = {"profile": dict(dirty) if dirty is not None else None, "history": None, "loaded_at": now}
+            self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            # Sin E/S con el lock tomado: un perfil sucio sigue en _dirty (que manda al recargar)
+            # y lo guarda el hilo de escritura diferida
+            self._entries.popitem(last=False)
+        return entry
+
+    def begin_request(self) -> None:
+        """Cuenta una petición (para las medias por petición de stats)."""
+        with self._lock:
+            self.counters["requests"] += 1
+
+    # ---- perfiles ----
+
+    def get_profile(self, user_id: int) -> dict:
+        user_id = int(user_id)
+        with self._lock:
+            entry = self._entry(user_id)
+            if entry["profile"] is not None:
+                profile = dict(entry["profile"])
+                hit = True
+            else:
+                hit = False
+        if hit:
+            self._count("profile_hits")
+            return profile
+        self._count("profile_misses")
+        self._count("disk_reads")
+        profile = self._load_profile(user_id)
+        with self._lock:
+            self._entry(user_id)["profile"] = dict(profile)
+        return dict(profile)
+
+    def set_profile(self, user_id: int, profile: dict) -> bool:
+        """Actualiza el perfil; devuelve False (y no escribe) si no cambió."""
+        user_id = int(user_id)
+        current = self.get_profile(user_id)
+        if current == profile:
+            self._count("skipped_writes")
+            return False
+        with self._lock:
+            self._entry(user_id)["profile"] = dict(profile)
+            self._dirty[user_id] = dict(profile)
+        self._ensure_flusher()
+        return True
+
+    def flush(self) -> int:
+        """Escribe en disco todos los perfiles pendientes y devuelve cuántos se guardaron.
+
+        Un perfil sale de la lista de pendientes solo tras escribirse (y si no cambió mientras
+        tanto); si alguna escritura falla los demás se intentan igual y se relanza el error.
+        """
+        with self._lock:
+            pending = list(self._dirty.items())
+        written = 0
+        error: Optional[Exception] = None
+        for user_id, profile in pending:
+            try:
+                self._save_profile(user_id, profile)
+            except Exception as e:
+                error = e
+                continue
+            with self._lock:
+                # set_profile guarda un dict nuevo: si es otro objeto, hay un cambio por escribir
+                if self._dirty.get(user_id) is profile:
+                    del self._dirty[user_id]
+            self._count("disk_writes")
+            written += 1
+        if error is not None:
+            raise error
+        return written
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name="profile-flusher", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._flush_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Se reintenta en la siguiente vuelta
+                pass
+
+    # ---- historial ----
+
+    def get_history(self, user_id: int, limit: int) -> List[Turn]:
+        return [(r, c) for _, r, c in self.get_history_rows(user_id, limit)]
+
+    def get_history_rows(self, user_id: int, limit: int) -> List[TurnRow]:
+        user_id = int(user_id)
+        if self.cache_history and limit <= self.window:
+            with self._lock:
+                history = self._entry(user_id)["history"]
+                if history is not None:
+                    turns = history[-limit:] if limit else []
+                else:
+                    turns = None
+            if turns is not None:
+                self._count("history_hits")
+                return list(turns)
+        self._count("history_misses")
+        self._count("disk_reads")
+        turns = self.store.recent_rows(user_id, max(limit, self.window))
+        if self.cache_history:
+            with self._lock:
+                self._entry(user_id)["history"] = turns[-self.window:]
+        return turns[-limit:] if limit else []
+
+    def append_history(self, user_id: int, turns: List[Turn]) -> None:
+        user_id = int(user_id)
+        if not turns:
+            return
+
+        def update_cache(ids: List[int]) -> None:
+            # Con el lock del usuario del store: dos appends simultáneos no se cruzan en la copia
+            rows = [(i, r, c) for i, (r, c) in zip(ids, turns)]
+            with self._lock:
+                entry = self._entry(user_id)
+                if entry["history"] is not None:
+                    entry["history"] = (entry["history"] + rows)[-self.window:]
+
+        self.store.append(user_id, turns, on_commit=update_cache)
+        self._count("disk_writes")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.counters)
+            stats["cached_users"] = len(self._entries)
+            stats["dirty_profiles"] = len(self._dirty)
+        requests = stats["requests"]
+        stats["disk_writes_per_request"] = round(stats["disk_writes"] / requests, 4) if requests else 0.0
+        stats["disk_reads_per_request"] = round(stats["disk_reads"] / requests, 4) if requests else 0.0
+        return stats
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+from src.history_store import ConversationStore, TurnRow
+
+# Compactación del historial antes de ejecutar el grafo:
+#   - ventana deslizante: los turnos más recientes que caben en un presupuesto de tokens
+#   - resumen acumulado: los turnos que salen de la ventana se pliegan en un resumen que
+#     se guarda (hasta qué turno cubre) y solo se recalcula cuando lo pendiente pasa un umbral.
+
+# (resumen_anterior, turnos_nuevos) -> resumen actualizado
+Summarizer = Callable[[str, List[TurnRow]], Awaitable[str]]
+
+
+def turn_message(role: str, content: str) -> BaseMessage:
+    if role == "user":
+        return HumanMessage(content=content)
+    if role == "assistant":
+        return AIMessage(content=content)
+    return SystemMessage(content=content)
+
+
+def count_turn_tokens(role: str, content: str) -> int:
+    return count_tokens_approximately([turn_message(role, content)])
+
+
+def split_window(rows: List[TurnRow], budget: int) -> Tuple[List[TurnRow], List[TurnRow], int]:
+    """Separa (anteriores, ventana, tokens_ventana): la ventana son los turnos más recientes
+    cuya suma de tokens no supera `budget`."""
+    used = 0
+    start = len(rows)
+    for i in range(len(rows) - 1, -1, -1):
+        tokens = count_turn_tokens(rows[i][1], rows[i][2])
+        if used + tokens > budget:
+            break
+        used += tokens
+        start = i
+    return rows[:start], rows[start:], used
+
+
+class HistoryCompactor:
+    """Arma el contexto conversacional acotado (resumen + ventana) de cada usuario.
+
+    Los turnos que salen de la ventana y aún no están en el resumen ("pendientes") se siguen
+    enviando tal cual; solo cuando suman más de `resummarize_tokens` (por defecto la mitad del
+    presupuesto) se pliegan en el resumen. Así la llamada al resumidor ocurre cada varios
+    turnos y no en cada uno, y el contexto queda acotado a budget + resummarize_tokens.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        summarizer: Summarizer,
+        budget: int,
+        max_source_turns: int = 200,
+        resummarize_tokens: Optional[int] = None,
+        max_users: int = 1024,
+    ):
+        self.store = store
+        self.summarizer = summarizer
+        self.budget = budget
+        self.max_source_turns = max_source_turns
+        self.resummarize_tokens = budget // 2 if resummarize_tokens is None else resummarize_tokens
+        self.max_users = max_users
+        # user_id -> (until_id, resumen), LRU; evita releer SQLite en cada turno
+        self._summaries: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Un resumen en curso por usuario: las peticiones concurrentes esperan y usan su resultado
+        self._user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.summary_recomputes = 0
+        self.summary_reuses = 0
+        self.summary_failures = 0
+
+    def _remember(self, user_id: int, summary: Tuple[int, str]) -> None:
+        with self._lock:
+            self._summaries[user_id] = summary
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+
+    def _stored_summary(self, user_id: int) -> Optional[Tuple[int, str]]:
+        with self._lock:
+            cached = self._summaries.get(user_id)
+            if cached is not None:
+                self._summaries.move_to_end(user_id)
+                return cached
+        stored = self.store.get_summary(user_id)
+        if stored is not None:
+            self._remember(user_id, stored)
+        return stored
+
+    def _user_lock(self, user_id: int) -> asyncio.Lock:
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = asyncio.Lock()
+            return lock
+
+    def _pending(self, user_id: int, older: List[TurnRow]) -> Tuple[int, str, List[TurnRow], bool]:
+        """(hasta qué turno cubre el resumen, resumen, turnos pendientes, hay resumen guardado)."""
+        stored = self._stored_summary(user_id)
+        covered = stored[0] if stored else 0
+        # Los ids son globales (todos los usuarios): se compara contra las filas del
+        # propio usuario, no contra la diferencia de ids
+        return covered, stored[1] if stored else "", [r for r in older if r[0] > covered], stored is not None
+
+    async def compact(self, user_id: Optional[int], rows: List[TurnRow]) -> Dict[str, Any]:
+        """Devuelve {"summary", "window" (TurnRow), "usage"} a partir de los turnos recientes
+        del usuario (en orden)."""
+        older, window, window_tokens = split_window(rows, self.budget)
+        summary_text = ""
+        summarized = 0
+        if user_id and rows:
+            user_id = int(user_id)
+            covered, summary_text, pending, stored = self._pending(user_id, older)
+            if sum(count_turn_tokens(r, c) for _, r, c in pending) > self.resummarize_tokens:
+                async with self._user_lock(user_id):
+                    # Otra petición del mismo usuario pudo resumir este tramo mientras se esperaba
+                    covered, summary_text, pending, stored = self._pending(user_id, older)
+                    if sum(count_turn_tokens(r, c) for _, r, c in pending) > self.resummarize_tokens:
+                        window_start = window[0][0] if window else rows[-1][0] + 1
+                        try:
+                            new_rows = self.store.rows_between(user_id, covered, window_start, limit=self.max_source_turns)
+                            new_summary = await self.summarizer(summary_text, new_rows) if new_rows else None
+                        except Exception:
+                            self.summary_failures += 1
+                            new_rows, new_summary = [], None
+                        if new_summary is not None:
+                            summary_text = new_summary
+                            covered = new_rows[-1][0]
+                            self.store.save_summary(user_id, covered, summary_text)
+                            self._remember(user_id, (covered, summary_text))
+                            self.summary_recomputes += 1
+                            summarized = len(new_rows)
+                            pending = [r for r in pending if r[0] > covered]
+            if stored and not summarized:
+                self.summary_reuses += 1
+            # Los pendientes (aún no resumidos, o si falló el resumidor) van completos delante
+            # de la ventana: nunca se pierden del contexto
+            window = pending + window
+            window_tokens += sum(count_turn_tokens(r, c) for _, r, c in pending)
+            older = older[: len(older) - len(pending)]
+
+        summary_tokens = count_tokens_approximately([SystemMessage(content=summary_text)]) if summary_text else 0
+        return {
+            "summary": summary_text,
+            "window": window,
+            "usage": {
+                "window_turns": len(window),
+                "window_tokens": window_tokens,
+                "dropped_turns": len(older),
+                "summary_tokens": summary_tokens,
+                "newly_summarized_turns": summarized,
+                "history_tokens": window_tokens + summary_tokens,
+            },
+        }
@@ -0,0 +1,54 @@
+import threading
+from typing import Any, Dict
+
+# Modelos de chat perezosos: init_chat_model (y con él los SDK de Groq / Google GenAI, que
+# tardan cientos de ms en importarse) se ejecuta en el primer uso, no al importar el módulo.
+# Así `langgraph dev`, server.py y los scripts de prueba arrancan sin pagar ese costo.
+
+
+class LazyChatModel:
+    """Proxy de un modelo de init_chat_model que lo construye en el primer acceso.
+
+    Se usa igual que el modelo (invoke, ainvoke, bind_tools, model_name...): cualquier
+    atributo se delega al modelo real, creado una sola vez aunque lo pidan varios hilos.
+    """
+
+    def __init__(self, model: str, **kwargs: Any):
+        self._model_name = model
+        self._kwargs: Dict[str, Any] = kwargs
+        self._model = None
+        self._lock = threading.Lock()
+
+    # Identidad del modelo sin cargarlo (la usa la clave de src/llm_cache.py): un acierto
+    # de caché no necesita importar el SDK del proveedor
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    @property
+    def temperature(self) -> Any:
+        return self._kwargs.get("temperature")
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        """Devuelve el modelo real, creándolo si hace falta."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from langchain.chat_models import init_chat_model
+
+                    self._model = init_chat_model(self._model_name, **self._kwargs)
+        return self._model
+
+    def __getattr__(self, name: str) -> Any:
+        # Solo se llama para atributos que no son del proxy
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self) -> str:
+        state = "cargado" if self.loaded else "sin cargar"
+        return f"LazyChatModel({self._model_name!r}, {state})"
@@ -0,0 +1,386 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+from src.metrics import record_llm_call
+
+# Caché de respuestas de LLM en tres niveles:
+#   1. memoria (LRU con TTL) -> aciertos sin E/S
+#   2. SQLite en disco       -> sobrevive reinicios y se comparte entre workers
+#   3. similitud semántica   -> opcional; sirve paráfrasis de la misma pregunta
+# La clave es el prompt normalizado + modelo + temperatura. Los prompts de reason/finalize
+# incluyen db_results, así que si los datos cambian la clave cambia y no se sirve nada viejo.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "1024"))
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    str((Path(__file__).resolve().parent / ".." / "data" / "llm_cache.sqlite").resolve()),
+)
+# p. ej. "google_genai:models/text-embedding-004"; vacío = sin nivel semántico
+LLM_CACHE_EMBEDDINGS = os.getenv("LLM_CACHE_EMBEDDINGS", "")
+LLM_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", "0.97"))
+LLM_CACHE_SEMANTIC_SIZE = int(os.getenv("LLM_CACHE_SEMANTIC_SIZE", "1000"))
+# Cada cuántas escrituras se borra lo vencido (sobre todo las filas de SQLite); 0 = nunca
+LLM_CACHE_PURGE_EVERY = int(os.getenv("LLM_CACHE_PURGE_EVERY", "500"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normaliza unicode (NFC) y espacios para que diferencias triviales compartan clave."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def model_id(llm: Any) -> str:
+    return str(getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__)
+
+
+def cache_key(namespace: str, model: str, temperature: Any, messages: Sequence[BaseMessage]) -> str:
+    payload = json.dumps(
+        {
+            "ns": namespace,
+            "model": model,
+            "temperature": temperature,
+            "messages": [[m.type, normalize_text(str(m.content))] for m in messages],
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = math.sqrt(sum(x * x for x in a))
+    nb = math.sqrt(sum(y * y for y in b))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+class LLMCache:
+    """Caché de respuestas (texto) por clave, con nivel en memoria, SQLite y semántico opcional."""
+
+    def __init__(
+        self,
+        memory_size: int = LLM_CACHE_MEMORY_SIZE,
+        ttl: float = LLM_CACHE_TTL,
+        sqlite_path: Optional[str] = LLM_CACHE_PATH,
+        embeddings: Any = None,
+        similarity: float = LLM_CACHE_SIMILARITY,
+        semantic_size: int = LLM_CACHE_SEMANTIC_SIZE,
+        purge_every: int = LLM_CACHE_PURGE_EVERY,
+    ):
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.embeddings = embeddings
+        self.similarity = similarity
+        self.semantic_size = semantic_size
+        self.purge_every = purge_every
+        self._memory: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()  # key -> (expira, ns, texto)
+        # (ns, modelo, contexto) -> {id: (vector, expira, texto)}; el orden de inserción de todos
+        # los grupos vive en _semantic_order, así se desaloja lo más antiguo del total
+        self._semantic: Dict[Tuple[str, str, str], Dict[int, Tuple[List[float], float, str]]] = {}
+        self._semantic_order: "OrderedDict[Tuple[Tuple[str, str, str], int], None]" = OrderedDict()
+        self._semantic_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.stats_counters = {"memory_hits": 0, "sqlite_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "purged": 0}
+
+    # ---- SQLite ----
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        if not self.sqlite_path:
+            return None
+        if self._db is None:
+            Path(self.sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.sqlite_path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, namespace TEXT NOT NULL, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_ns ON llm_cache(namespace)")
+            self._db = db
+        return self._db
+
+    def _sqlite_get(self, key: str, now: float) -> Optional[Tuple[str, str, float]]:
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT namespace, response, expires_at FROM llm_cache WHERE key=? AND expires_at>?", (key, now)
+            ).fetchone()
+        return row
+
+    def _sqlite_put(self, key: str, namespace: str, response: str, now: float, expires: float) -> None:
+        with self._db_lock:
+            db = self._conn()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, namespace, response, created_at, expires_at) VALUES (?,?,?,?,?)",
+                (key, namespace, response, now, expires),
+            )
+
+    # ---- memoria ----
+
+    def _memory_put(self, key: str, namespace: str, response: str, expires: float) -> None:
+        with self._lock:
+            self._memory[key] = (expires, namespace, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    # ---- API ----
+
+    def get(self, key: str, semantic: Optional[Tuple[str, str, str, str]] = None) -> Optional[str]:
+        """Busca por clave exacta; si falla y hay `semantic` = (ns, modelo, contexto, texto),
+        busca una pregunta parecida con el mismo contexto."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.stats_counters["memory_hits"] += 1
+                return entry[2]
+        row = self._sqlite_get(key, now)
+        if row is not None:
+            namespace, response, expires = row
+            self._memory_put(key, namespace, response, expires)
+            with self._lock:
+                self.stats_counters["sqlite_hits"] += 1
+            return response
+        if semantic is not None and self.embeddings is not None:
+            found = self._semantic_get(semantic, now)
+            if found is not None:
+                with self._lock:
+                    self.stats_counters["semantic_hits"] += 1
+                return found
+        with self._lock:
+            self.stats_counters["misses"] += 1
+        return None
+
+    def put(
+        self,
+        key: str,
+        namespace: str,
+        response: str,
+        ttl: Optional[float] = None,
+        semantic: Optional[Tuple[str, str, str, str]] = None,
+    ) -> None:
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        self._memory_put(key, namespace, response, expires)
+        self._sqlite_put(key, namespace, response, now, expires)
+        if semantic is not None and self.embeddings is not None:
+            self._semantic_put(semantic, response, expires)
+        with self._lock:
+            self.stats_counters["stores"] += 1
+            purge = self.purge_every > 0 and self.stats_counters["stores"] % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+
+    def _semantic_get(self, semantic: Tuple[str, str, str, str], now: float) -> Optional[str]:
+        ns, model, context, text = semantic
+        with self._lock:
+            candidates = list(self._semantic.get((ns, model, context), {}).values())
+        if not candidates:
+            return None
+        vector = self.embeddings.embed_query(normalize_text(text))
+        best, best_score = None, self.similarity
+        for vec, expires, response in candidates:
+            if expires <= now:
+                continue
+            score = _cosine(vector, vec)
+            if score >= best_score:
+                best, best_score = response, score
+        return best
+
+    def _semantic_put(self, semantic: Tuple[str, str, str, str], response: str, expires: float) -> None:
+        ns, model, context, text = semantic
+        vector = self.embeddings.embed_query(normalize_text(text))
+        group = (ns, model, context)
+        with self._lock:
+            entry_id = next(self._semantic_ids)
+            self._semantic.setdefault(group, {})[entry_id] = (vector, expires, response)
+            self._semantic_order[(group, entry_id)] = None
+            if len(self._semantic_order) > self.semantic_size:
+                # Primero lo vencido; si no alcanza, lo más antiguo de cualquier grupo
+                self._semantic_purge(time.time())
+                while len(self._semantic_order) > self.semantic_size:
+                    self._semantic_remove(*self._semantic_order.popitem(last=False)[0])
+
+    def _semantic_remove(self, group: Tuple[str, str, str], entry_id: int) -> None:
+        # Con self._lock tomado; el llamador ya lo sacó de _semantic_order
+        bucket = self._semantic.get(group)
+        if bucket is not None:
+            bucket.pop(entry_id, None)
+            if not bucket:
+                del self._semantic[group]
+
+    def _semantic_purge(self, now: float, namespace: Optional[str] = None) -> int:
+        """Quita las entradas semánticas vencidas (o todas las de `namespace`). Con self._lock tomado."""
+        doomed = [
+            (group, entry_id)
+            for group, bucket in self._semantic.items()
+            for entry_id, (_, expires, _) in bucket.items()
+            if (group[0] == namespace if namespace is not None else expires <= now)
+        ]
+        for group, entry_id in doomed:
+            del self._semantic_order[(group, entry_id)]
+            self._semantic_remove(group, entry_id)
+        return len(doomed)
+
+    def invalidate(self, namespace: Optional[str] = None) -> int:
+        """Borra todas las entradas (o las de un namespace: plan, reason, finalize...)."""
+        with self._lock:
+            if namespace is None:
+                removed = len(self._memory)
+                self._memory.clear()
+                self._semantic.clear()
+                self._semantic_order.clear()
+            else:
+                keys = [k for k, v in self._memory.items() if v[1] == namespace]
+                for k in keys:
+                    del self._memory[k]
+                removed = len(keys)
+                self._semantic_purge(time.time(), namespace)
+        with self._db_lock:
+            db = self._conn()
+            if db is not None:
+                if namespace is None:
+                    cur = db.execute("DELETE FROM llm_cache")
+                else:
+                    cur = db.execute("DELETE FROM llm_cache WHERE namespace=?", (namespace,))
+                removed = max(removed, cur.rowcount)
+        return removed
+
+    def purge_expired(self) -> int:
+        """Borra lo vencido de los tres niveles; se llama sola cada `purge_every` escrituras.
+        Devuelve las filas borradas de SQLite."""
+        now = time.time()
+        with self._lock:
+            for k in [k for k, v in self._memory.items() if v[0] <= now]:
+                del self._memory[k]
+            self._semantic_purge(now)
+        with self._db_lock:
+            db = self._conn()
+            removed = db.execute("DELETE FROM llm_cache WHERE expires_at<=?", (now,)).rowcount if db is not None else 0
+        with self._lock:
+            self.stats_counters["purged"] += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.stats_counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["semantic_entries"] = len(self._semantic_order)
+        hits = stats["memory_hits"] + stats["sqlite_hits"] + stats["semantic_hits"]
+        total = hits + stats["misses"]
+        stats["hit_ratio"] = round(hits / total, 4) if total else 0.0
+        stats["semantic_enabled"] = self.embeddings is not None
+        return stats
+
+
+def _build_embeddings():
+    if not LLM_CACHE_EMBEDDINGS:
+        return None
+    from langchain.embeddings import init_embeddings
+
+    return init_embeddings(LLM_CACHE_EMBEDDINGS)
+
+
+llm_cache = LLMCache(embeddings=_build_embeddings()) if LLM_CACHE_ENABLED else None
+
+
+def _lookup(llm: Any, messages: Sequence[BaseMessage], namespace: str, semantic_text: Optional[str], context: Any):
+    model = model_id(llm)
+    key = cache_key(namespace, model, getattr(llm, "temperature", None), messages)
+    semantic = None
+    if semantic_text:
+        context_hash = hashlib.sha256(
+            json.dumps(context, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        semantic = (namespace, model, context_hash, semantic_text)
+    return key, semantic, llm_cache.get(key, semantic)
+
+
+def token_usage(messages: Sequence[BaseMessage], response: BaseMessage) -> Tuple[int, int]:
+    """(tokens de entrada, tokens de salida): los que reporta el proveedor o una aproximación."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("input_tokens") or usage.get("output_tokens"):
+        return int(usage.get("input_tokens") or 0), int(usage.get("output_tokens") or 0)
+    return count_tokens_approximately(list(messages)), count_tokens_approximately([response])
+
+
+def _record(llm: Any, messages: Sequence[BaseMessage], namespace: str, start: float, response: Any, hit: Optional[bool]) -> None:
+    tokens = (0, 0) if hit else token_usage(messages, response)
+    record_llm_call(namespace, model_id(llm), time.perf_counter() - start, *tokens, cache_hit=hit)
+
+
+def cached_invoke(
+    llm: Any,
+    messages: Sequence[BaseMessage],
+    namespace: str,
+    semantic_text: Optional[str] = None,
+    context: Any = None,
+    ttl: Optional[float] = None,
+) -> AIMessage:
+    """llm.invoke con caché. `semantic_text` (la pregunta del usuario) y `context` (lo demás
+    que determina la respuesta) habilitan el nivel semántico si está configurado."""
+    start = time.perf_counter()
+    if llm_cache is None:
+        response = llm.invoke(messages)
+        _record(llm, messages, namespace, start, response, None)
+        return response
+    key, semantic, hit = _lookup(llm, messages, namespace, semantic_text, context)
+    if hit is not None:
+        _record(llm, messages, namespace, start, None, True)
+        return AIMessage(content=hit, response_metadata={"cache_hit": True})
+    response = llm.invoke(messages)
+    _record(llm, messages, namespace, start, response, False)
+    llm_cache.put(key, namespace, str(response.content), ttl=ttl, semantic=semantic)
+    return response
+
+
+async def acached_invoke(
+    llm: Any,
+    messages: Sequence[BaseMessage],
+    namespace: str,
+    semantic_text: Optional[str] = None,
+    context: Any = None,
+    ttl: Optional[float] = None,
+) -> AIMessage:
+    """Versión async de cached_invoke; la E/S de la caché (SQLite, embeddings) va a un hilo."""
+    start = time.perf_counter()
+    if llm_cache is None:
+        response = await llm.ainvoke(messages)
+        _record(llm, messages, namespace, start, response, None)
+        return response
+    key, semantic, hit = await asyncio.to_thread(_lookup, llm, messages, namespace, semantic_text, context)
+    if hit is not None:
+        _record(llm, messages, namespace, start, None, True)
+        return AIMessage(content=hit, response_metadata={"cache_hit": True})
+    response = await llm.ainvoke(messages)
+    _record(llm, messages, namespace, start, response, False)
+    await asyncio.to_thread(llm_cache.put, key, namespace, str(response.content), ttl, semantic)
+    return response
@@ -1,15 +1,28 @@
 from langgraph.graph import StateGraph, START, END, MessagesState
 from langchain_core.messages import AIMessage, SystemMessage, HumanMessage, BaseMessage, trim_messages
-from langchain.chat_models import init_chat_model
-from typing import Literal, TypedDict, List, Dict, Any, Annotated
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+from langgraph.prebuilt import ToolNode, tools_condition
+from typing import Literal, TypedDict, List, Dict, Any, Annotated, Optional
+from pathlib import Path
+import itertools
+import json
 import os
+import threading
+import time
 from dotenv import load_dotenv
 from langgraph.checkpoint.memory import MemorySaver
 
+from src.lazy_llm import LazyChatModel
+from src.llm_cache import model_id, token_usage
+from src.metrics import record_llm_call, traced_node
+from src.checkpoint_store import DurableCheckpointSaver, PostgresCheckpointBackend, SqliteCheckpointBackend
+from src.reservas import CatalogIndex, PostgresReservationStore, ReservationEngine
+
 load_dotenv()
 
-# Modelo LLM
-llm = init_chat_model("llama-3.1-8b-instant", model_provider="groq", temperature=0.7)
+# Modelo LLM (se construye en el primer uso; ver src/lazy_llm.py)
+llm = LazyChatModel("llama-3.1-8b-instant", model_provider="groq", temperature=0.7)
 
 # Datos estáticos de viajes (sin base de datos)
 VIAJES_CATALOGO = [
@@ -87,106 +100,294 @@ VIAJES_CATALOGO = [
     }
 ]
 
-# Almacenamiento temporal de reservaciones (en memoria)
-RESERVACIONES = {}
-RESERVACION_COUNTER = 1
-
 # ------------------ FUNCIONES HELPER ------------------
 
 def obtener_viajes() -> List[Dict[str, Any]]:
     """Devuelve el catálogo de viajes."""
-    return VIAJES_CATALOGO
+    return reservas.viajes()
 
 def crear_reservacion_mock(user_id: str, viaje_id: int, num_personas: int = 1) -> Dict[str, Any]:
-    """Crea una reservación simulada en memoria."""
-    global RESERVACION_COUNTER
-    
-    # Buscar el viaje
-    viaje = next((v for v in VIAJES_CATALOGO if v["id"] == viaje_id), None)
-    if not viaje:
-        return {"success": False, "error": "El viaje no existe"}
-    
-    if viaje["cupos_disponibles"] < num_personas:
-        return {"success": False, "error": f"Solo hay {viaje['cupos_disponibles']} cupos disponibles"}
-    
-    # Crear reservación
-    reservacion_id = RESERVACION_COUNTER
-    RESERVACION_COUNTER += 1
-    
-    reservacion = {
-        "id": reservacion_id,
-        "usuario_id": user_id,
-        "viaje": viaje,
-        "num_personas": num_personas,
-        "total": viaje["precio"] * num_personas,
-        "estado": "confirmada"
-    }
-    
-    if user_id not in RESERVACIONES:
-        RESERVACIONES[user_id] = []
-    RESERVACIONES[user_id].append(reservacion)
-    
-    return {
-        "success": True,
-        "reservacion_id": reservacion_id,
-        "destino": viaje["destino"],
-        "num_personas": num_personas,
-        "total": reservacion["total"]
-    }
+    """Crea una reservación simulada en memoria (descuenta cupos de forma atómica)."""
+    return reservas.reservar(user_id, viaje_id, num_personas)
 
 def obtener_reservaciones(user_id: str) -> List[Dict[str, Any]]:
     """Obtiene las reservaciones de un usuario."""
-    return RESERVACIONES.get(user_id, [])
+    return reservas.reservaciones_de(user_id)
+
+_indice_lock = threading.Lock()
+_indice: Dict[str, Any] = {"catalogo": None, "version": None, "index": None}
+
+def indice_catalogo() -> CatalogIndex:
+    """Índice de búsqueda del catálogo; se reconstruye solo si el catálogo cambió."""
+    catalogo = reservas.catalogo()
+    version = CATALOGO_VERSION
+    with _indice_lock:
+        if _indice["catalogo"] is not catalogo or _indice["version"] != version:
+            _indice["index"] = CatalogIndex(catalogo.values())
+            _indice["catalogo"], _indice["version"] = catalogo, version
+        return _indice["index"]
+
+def consultar_catalogo(
+    texto: Optional[str] = None,
+    precio_min: Optional[float] = None,
+    precio_max: Optional[float] = None,
+    salida_desde: Optional[str] = None,
+    salida_hasta: Optional[str] = None,
+    min_cupos: int = 1,
+    limite: int = 20,
+) -> List[Dict[str, Any]]:
+    """Devuelve solo los viajes que cumplen los filtros (ver CatalogIndex.buscar)."""
+    return indice_catalogo().buscar(
+        texto=texto, precio_min=precio_min, precio_max=precio_max,
+        salida_desde=salida_desde, salida_hasta=salida_hasta, min_cupos=min_cupos, limite=limite,
+    )
+
+# ------------------ HERRAMIENTAS ------------------
+# El LLM consulta y reserva a través de estas herramientas (ToolNode) en lugar de leer
+# el catálogo completo en el prompt y "simular" reservas.
+
+def _json(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _resumen_viaje(v: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v[k] for k in ("id", "destino", "precio", "fecha_salida", "fecha_regreso", "cupos_disponibles")}
+
+
+_SIN_USUARIO_NUMERICO = (
+    "Para reservar o ver reservaciones se necesita un usuario identificado "
+    "(configurable.user_id numérico)."
+)
+
+
+def _usuario_actual(config: RunnableConfig) -> Optional[str]:
+    # Se usa el user_id de la configuración; si no hay, el hilo de conversación. Con
+    # GALLETA_STORE=postgres reservaciones.usuario_id es un entero: solo vale un user_id
+    # numérico (el hilo no identifica a nadie) y sin él se devuelve None
+    configurable = (config or {}).get("configurable", {})
+    if GALLETA_STORE == "postgres":
+        user_id = str(configurable.get("user_id") or "")
+        return user_id if user_id.isdigit() else None
+    return str(configurable.get("user_id") or configurable.get("thread_id") or "anonimo")
+
+
+@tool
+def listar_viajes() -> str:
+    """Lista todos los viajes del catálogo con precio, fechas y cupos disponibles."""
+    return _json([_resumen_viaje(v) for v in obtener_viajes()])
+
+
+@tool
+def buscar_viajes(texto: str) -> str:
+    """Busca viajes cuyo destino o descripción contenga las palabras (p. ej. 'playa', 'Japón')."""
+    return _json([_resumen_viaje(v) for v in consultar_catalogo(texto=texto)])
+
+
+@tool
+def filtrar_viajes(
+    texto: Optional[str] = None,
+    precio_max: Optional[float] = None,
+    salida_desde: Optional[str] = None,
+    salida_hasta: Optional[str] = None,
+    min_cupos: int = 1,
+) -> str:
+    """Filtra viajes por palabras del destino/descripción, precio máximo por persona, rango
+    de fecha de salida ('YYYY-MM-DD' o 'YYYY-MM' para un mes completo, inclusive) y cupos
+    mínimos disponibles (p. ej. el número de personas). Devuelve los más baratos primero."""
+    return _json([
+        _resumen_viaje(v)
+        for v in consultar_catalogo(
+            texto=texto, precio_max=precio_max, salida_desde=salida_desde, salida_hasta=salida_hasta, min_cupos=min_cupos
+        )
+    ])
+
+
+@tool
+def detalle_viaje(viaje_id: int) -> str:
+    """Devuelve la información completa de un viaje (incluida la descripción)."""
+    viaje = reservas.viaje(viaje_id)
+    return _json(viaje if viaje else {"error": "El viaje no existe"})
+
+
+@tool
+def reservar_viaje(viaje_id: int, num_personas: int, config: RunnableConfig) -> str:
+    """Reserva un viaje para el usuario actual. Úsala solo cuando el usuario confirme
+    el viaje y la cantidad de personas. Devuelve la confirmación o el motivo del rechazo."""
+    usuario = _usuario_actual(config)
+    if usuario is None:
+        return _json({"success": False, "error": _SIN_USUARIO_NUMERICO})
+    return _json(crear_reservacion_mock(usuario, viaje_id, num_personas))
+
+
+@tool
+def mis_reservaciones(config: RunnableConfig) -> str:
+    """Lista las reservaciones del usuario actual."""
+    usuario = _usuario_actual(config)
+    if usuario is None:
+        return _json({"error": _SIN_USUARIO_NUMERICO})
+    return _json([
+        {"id": r["id"], "destino": r["viaje"]["destino"], "fecha_salida": r["viaje"]["fecha_salida"],
+         "num_personas": r["num_personas"], "total": r["total"], "estado": r["estado"]}
+        for r in obtener_reservaciones(usuario)
+    ])
+
+
+GALLETA_TOOLS = [listar_viajes, buscar_viajes, filtrar_viajes, detalle_viaje, reservar_viaje, mis_reservaciones]
+
+# ------------------ PROMPT DEL SISTEMA ------------------
+
+# El prompt se arma una sola vez por versión del catálogo. Quien modifique el catálogo
+# (viajes nuevos, destinos) debe llamar a marcar_catalogo_modificado().
+# La parte fija va primero y unos pocos destinos de ejemplo al final: así el prefijo es idéntico
+# entre peticiones y los proveedores con caché de prefijo de prompt pueden reutilizarlo.
+# Precios, fechas y cupos no van en el prompt: se consultan con las herramientas.
+_PROMPT_FIJO = """Eres Galleta 🍪, un asistente virtual simpático, servicial y conversacional.
+
+IMPORTANTE: Puedes hablar de CUALQUIER tema, no solo de viajes. Si el usuario quiere charlar,
+hacer preguntas generales, o hablar de otros temas, respóndele de forma natural y amigable.
+
+Cuando se trate de viajes, usa las herramientas:
+- listar_viajes, buscar_viajes, filtrar_viajes y detalle_viaje para precios, fechas y cupos
+- reservar_viaje para reservar (solo tras confirmar viaje y número de personas)
+- mis_reservaciones para consultar las reservaciones del usuario
+Nunca inventes precios, cupos ni confirmaciones: usa siempre el resultado de la herramienta.
+
+Características:
+- Sé amigable, cálido y cercano
+- Usa emojis cuando sea apropiado
+- Recuerda el contexto de la conversación
+- Si no sabes algo, admítelo honestamente
+- Ayuda con cualquier consulta, no solo viajes
+- Mantén un tono conversacional natural
+"""
+
+CATALOGO_VERSION = 0
+_prompt_lock = threading.Lock()
+_prompt_cache: Dict[str, Any] = {"version": None, "message": None}
+
+
+def marcar_catalogo_modificado() -> int:
+    """Invalida el prompt cacheado tras un cambio en el catálogo. Devuelve la nueva versión."""
+    global CATALOGO_VERSION
+    with _prompt_lock:
+        CATALOGO_VERSION += 1
+        return CATALOGO_VERSION
+
+
+# Catálogo y reservaciones: "memory" (VIAJES_CATALOGO, se pierde al reiniciar) o "postgres"
+# (tablas de init_db.sql; lecturas cacheadas GALLETA_CATALOG_TTL segundos).
+# Los cambios de cupos no afectan al prompt (solo lleva unos pocos destinos de ejemplo).
+GALLETA_STORE = os.getenv("GALLETA_STORE", "memory").lower()
+GALLETA_CATALOG_TTL = float(os.getenv("GALLETA_CATALOG_TTL", "30"))
+
+if GALLETA_STORE == "postgres":
+    # Al refrescar la caché se detectan viajes nuevos agregados desde otro proceso
+    reservas = PostgresReservationStore(cache_ttl=GALLETA_CATALOG_TTL, on_change=marcar_catalogo_modificado)
+else:
+    reservas = ReservationEngine(VIAJES_CATALOGO)
+
+
+# Destinos de ejemplo en el prompt: un número fijo, no el catálogo entero (con miles de
+# viajes el prompt crecería sin límite); el resto se encuentra con las herramientas
+GALLETA_PROMPT_DESTINOS = int(os.getenv("GALLETA_PROMPT_DESTINOS", "20"))
+
+
+def _render_catalogo(catalogo: Dict[int, Dict[str, Any]]) -> str:
+    lineas = [f"- {v['id']}: {v['destino']}" for v in itertools.islice(catalogo.values(), GALLETA_PROMPT_DESTINOS)]
+    if len(catalogo) > GALLETA_PROMPT_DESTINOS:
+        lineas.append(f"- ... y {len(catalogo) - GALLETA_PROMPT_DESTINOS} viajes más: usa buscar_viajes o filtrar_viajes para encontrarlos.")
+    return "\n".join(lineas)
+
+
+def galleta_system_message() -> SystemMessage:
+    """SystemMessage de Galleta para la versión actual del catálogo (se reconstruye solo si cambió)."""
+    # La versión se toma antes de leer el catálogo (fuera del lock: refrescar la caché del
+    # catálogo puede subirla); si cambia mientras tanto, la siguiente llamada reconstruye.
+    # catalogo() no copia nada: solo se recorre (unos pocos viajes) si hay que reconstruir
+    version = CATALOGO_VERSION
+    catalogo = reservas.catalogo()
+    with _prompt_lock:
+        if _prompt_cache["version"] != version:
+            destinos = _render_catalogo(catalogo) if GALLETA_PROMPT_DESTINOS > 0 else ""
+            _prompt_cache["message"] = SystemMessage(
+                content=_PROMPT_FIJO + ("\nAlgunos destinos del catálogo (id: destino):\n" + destinos if destinos else "")
+            )
+            _prompt_cache["version"] = version
+        return _prompt_cache["message"]
+
 
 # ------------------ NODO DEL AGENTE ------------------
 
+_llm_con_tools: Dict[str, Any] = {"llm": None, "runnable": None}
+
+
+def _modelo_con_herramientas():
+    # bind_tools genera los esquemas de las herramientas; se hace una vez por modelo
+    if _llm_con_tools["llm"] is not llm:
+        _llm_con_tools["runnable"] = llm.bind_tools(GALLETA_TOOLS)
+        _llm_con_tools["llm"] = llm
+    return _llm_con_tools["runnable"]
+
+
 def chatbot(state: MessagesState):
-    """Nodo principal del chatbot que responde con contexto y memoria."""
-    # Sistema de prompts con contexto de viajes
-    system_message = SystemMessage(content="""
-    Eres Galleta 🍪, un asistente virtual simpático, servicial y conversacional.
-    
-    IMPORTANTE: Puedes hablar de CUALQUIER tema, no solo de viajes. Si el usuario quiere charlar,
-    hacer preguntas generales, o hablar de otros temas, respóndele de forma natural y amigable.
-    
-    Cuando se trate de viajes, tienes acceso a un catálogo de viajes y puedes:
-    - Mostrar los viajes disponibles
-    - Ayudar a hacer reservaciones (simuladas, sin persistencia real)
-    - Consultar reservaciones del usuario
-    - Dar información sobre destinos
-    
-    Catálogo de viajes disponibles:
-    """ + "\n".join([f"- {v['destino']}: ${v['precio']} ({v['fecha_salida']} - {v['fecha_regreso']}) - {v['cupos_disponibles']} cupos" 
-                       for v in VIAJES_CATALOGO]) + """
-    
-    Características:
-    - Sé amigable, cálido y cercano
-    - Usa emojis cuando sea apropiado
-    - Recuerda el contexto de la conversación
-    - Si no sabes algo, adí telo honestamente
-    - Ayuda con cualquier consulta, no solo viajes
-    - Mantén un tono conversacional natural
-    """)
-    
-    # Mantener historial limitado para no exceder tokens
-    messages = [system_message] + state["messages"]
-    
-    # Invocar el modelo
-    response = llm.invoke(messages)
-    
+    """Nodo principal del chatbot: responde o pide ejecutar herramientas."""
+    messages = [galleta_system_message()] + state["messages"]
+
+    # Invocar el modelo (latencia y tokens quedan en src/metrics.py)
+    start = time.perf_counter()
+    response = _modelo_con_herramientas().invoke(messages)
+    record_llm_call("galleta", model_id(llm), time.perf_counter() - start, *token_usage(messages, response))
+
     return {"messages": [response]}
 
 # ------------------ GRAFO ------------------
 
+# chatbot -> (si pidió herramientas) tools -> chatbot -> ... -> END
 builder = StateGraph(MessagesState)
-builder.add_node("chatbot", chatbot)
+builder.add_node("chatbot", traced_node("chatbot", chatbot))
+builder.add_node("tools", ToolNode(GALLETA_TOOLS))
 builder.add_edge(START, "chatbot")
-builder.add_edge("chatbot", END)
+builder.add_conditional_edges("chatbot", tools_condition, {"tools": "tools", END: END})
+builder.add_edge("tools", "chatbot")
+
+# ------------------ CHECKPOINTER ------------------
+
+# Persistencia de hilos: "none" (por defecto; LangGraph Studio usa la suya), "memory",
+# "sqlite" o "postgres" (misma BD del proyecto, vía el pool de src/db.py)
+GALLETA_CHECKPOINTER = os.getenv("GALLETA_CHECKPOINTER", "none").lower()
+GALLETA_CHECKPOINT_PATH = os.getenv("GALLETA_CHECKPOINT_PATH", str(Path(__file__).resolve().parent.parent / "data" / "galleta_checkpoints.sqlite"))
+GALLETA_THREAD_TTL = float(os.getenv("GALLETA_THREAD_TTL", str(7 * 24 * 3600)))
+GALLETA_MAX_THREADS = int(os.getenv("GALLETA_MAX_THREADS", "0"))
+GALLETA_CHECKPOINT_KEEP = int(os.getenv("GALLETA_CHECKPOINT_KEEP", "20"))
+GALLETA_CHECKPOINT_HOT_SIZE = int(os.getenv("GALLETA_CHECKPOINT_HOT_SIZE", "256"))
+
+
+def build_checkpointer(kind: Optional[str] = None):
+    """Crea el checkpointer configurado (o None para compilar sin memoria propia)."""
+    kind = (kind or GALLETA_CHECKPOINTER).lower()
+    if kind in ("", "none"):
+        return None
+    if kind == "memory":
+        return MemorySaver()
+    if kind == "sqlite":
+        backend = SqliteCheckpointBackend(Path(GALLETA_CHECKPOINT_PATH))
+    elif kind == "postgres":
+        backend = PostgresCheckpointBackend()
+    else:
+        raise ValueError(f"GALLETA_CHECKPOINTER desconocido: {kind}")
+    return DurableCheckpointSaver(
+        backend,
+        ttl=GALLETA_THREAD_TTL,
+        keep_last=GALLETA_CHECKPOINT_KEEP,
+        hot_size=GALLETA_CHECKPOINT_HOT_SIZE,
+        max_threads=GALLETA_MAX_THREADS,
+    )
+
 
 # Compilar el grafo
-# Nota: LangGraph Studio maneja la persistencia automáticamente,
-# por lo que NO usamos checkpointer aquí para compatibilidad.
-# Para uso local con memoria, ver test_galleta.py que usa MemorySaver
-agent = builder.compile()
+# Nota: LangGraph Studio maneja la persistencia automáticamente, por lo que por defecto
+# NO usamos checkpointer aquí. Para servir Galleta con memoria durable, definir
+# GALLETA_CHECKPOINTER=sqlite|postgres (ver también test_galleta.py).
+checkpointer = build_checkpointer()
+agent = builder.compile(checkpointer=checkpointer)
 agent.name = "Galleta"
-
@@ -0,0 +1,339 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Instrumentación del agente sin dependencias externas:
+#   - métricas de proceso (histogramas y contadores) que /metrics expone en formato Prometheus
+#   - traza por petición (RequestTrace): tiempo, consultas a BD, tokens y aciertos de caché
+#     de cada nodo del grafo; server.py la adjunta a la respuesta en modo debug.
+# La traza activa viaja en un contextvar, así que la ven los nodos async, los nodos sync que
+# LangGraph corre en hilos y las consultas de src/db.py sin pasarla como argumento.
+
+# Buckets por defecto de Prometheus (segundos)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+_INF = 'le="+Inf"'
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple[Any, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: Any) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda kv: tuple(map(str, kv[0])))
+        for values, total in items:
+            lines.append(f"{self.name}{_labels(self.label_names, values)} {_number(total)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label_values -> [conteo por bucket (no acumulado) + overflow, suma, total]
+        self._series: Dict[Tuple[Any, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, *label_values: Any) -> Dict[str, Any]:
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                return {"count": 0, "sum": 0.0, "buckets": {}}
+            counts, total, n = list(series[0]), series[1], series[2]
+        cumulative, buckets = 0, {}
+        for bound, c in zip(self.buckets, counts):
+            cumulative += c
+            buckets[bound] = cumulative
+        return {"count": n, "sum": total, "buckets": buckets}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(
+                ((k, list(v[0]), v[1], v[2]) for k, v in self._series.items()),
+                key=lambda s: tuple(map(str, s[0])),
+            )
+        for values, counts, total, n in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, values, _INF)} {n}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, values)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, values)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    "agent_request_duration_seconds", "Duración de cada petición al agente", ["endpoint", "status"]))
+NODE_SECONDS = registry.register(Histogram(
+    "agent_node_duration_seconds", "Duración de cada nodo del grafo", ["node"]))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    "agent_db_query_duration_seconds", "Duración de cada sentencia SQL en conexiones del pool", ["status"]))
+DB_QUERIES_PER_REQUEST = registry.register(Histogram(
+    "agent_db_queries_per_request", "Consultas a la BD por petición", ["endpoint"], buckets=COUNT_BUCKETS))
+LLM_SECONDS = registry.register(Histogram(
+    "agent_llm_duration_seconds", "Duración de cada llamada al LLM (incluye aciertos de caché)", ["namespace", "cache"]))
+LLM_TOKENS = registry.register(Counter(
+    "agent_llm_tokens_total", "Tokens enviados/recibidos del LLM (sin contar aciertos de caché)", ["namespace", "model", "direction"]))
+CACHE_LOOKUPS = registry.register(Counter(
+    "agent_cache_lookups_total", "Búsquedas en cachés (llm, schema)", ["cache", "result"]))
+USER_CACHE_EVENTS = registry.register(Counter(
+    "agent_user_cache_events_total", "Aciertos, fallos y E/S de disco de la caché de usuarios", ["event"]))
+
+
+# ------------------ TRAZA POR PETICIÓN ------------------
+
+_COUNTERS = (
+    "db_queries", "db_ms", "llm_calls", "llm_ms", "input_tokens", "output_tokens", "cache_hits", "cache_misses",
+    "user_disk_reads", "user_disk_writes",
+)
+
+
+def _empty_counters() -> Dict[str, float]:
+    return dict.fromkeys(_COUNTERS, 0)
+
+
+class RequestTrace:
+    """Desglose de una petición: un tramo por cada ejecución de nodo, más lo que ocurre fuera
+    del grafo (carga de historial, resumen...)."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.outside = _empty_counters()
+        self.totals = _empty_counters()
+        self.elapsed: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, span: Optional[Dict[str, Any]], **amounts: float) -> None:
+        target = span["counters"] if span is not None else self.outside
+        with self._lock:
+            for key, amount in amounts.items():
+                target[key] += amount
+                self.totals[key] += amount
+
+    def start_span(self, node: str) -> Dict[str, Any]:
+        span = {"node": node, "start": time.perf_counter(), "ms": None, "counters": _empty_counters()}
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def finish(self, status: str = "ok") -> Dict[str, Any]:
+        """Cierra la traza (una sola vez), alimenta los histogramas por petición y devuelve el resumen."""
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter() - self.started
+            REQUEST_SECONDS.observe(self.elapsed, self.endpoint, status)
+            DB_QUERIES_PER_REQUEST.observe(self.totals["db_queries"], self.endpoint)
+        return self.summary()
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        with self._lock:
+            nodes = [
+                {
+                    "node": s["node"],
+                    "start_ms": round((s["start"] - self.started) * 1000, 2),
+                    "ms": s["ms"],
+                    **{k: round(v, 2) for k, v in s["counters"].items() if v},
+                }
+                for s in self.spans
+            ]
+            outside = {k: round(v, 2) for k, v in self.outside.items() if v}
+            totals = {k: round(v, 2) for k, v in self.totals.items()}
+        return {"total_ms": round(elapsed * 1000, 2), "nodes": nodes, "outside_graph": outside, **totals}
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("agent_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("agent_span", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def tracing(trace: RequestTrace) -> Iterator[RequestTrace]:
+    """Activa `trace` en el contexto actual (y en las tareas/hilos que se creen desde él)."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def request_trace(endpoint: str) -> Iterator[RequestTrace]:
+    """Crea una traza, la activa y la cierra al salir (status=error si hubo excepción)."""
+    trace = RequestTrace(endpoint)
+    status = "error"
+    try:
+        with tracing(trace):
+            yield trace
+        status = "ok"
+    finally:
+        trace.finish(status)
+
+
+def propagate(fn: Callable) -> Callable:
+    """Envuelve `fn` para ejecutarla en otro hilo con el contexto actual (traza y nodo).
+
+    ThreadPoolExecutor / run_in_executor no copian los contextvars; cada llamada usa su
+    propia copia porque un mismo Context no puede estar activo en dos hilos a la vez.
+    """
+    ctx = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+# ------------------ PUNTOS DE MEDICIÓN ------------------
+
+@contextmanager
+def _span(node: str) -> Iterator[None]:
+    trace = _current_trace.get()
+    span = trace.start_span(node) if trace is not None else None
+    token = _current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        NODE_SECONDS.observe(elapsed, node)
+        if span is not None:
+            span["ms"] = round(elapsed * 1000, 2)
+
+
+def traced_node(name: str, fn: Callable) -> Callable:
+    """Envuelve un nodo del grafo (sync o async) para medirlo como `name`."""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with _span(name):
+                return await fn(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _span(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _record(**amounts: float) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(_current_span.get(), **amounts)
+
+
+def record_db_query(seconds: float, ok: bool = True) -> None:
+    DB_QUERY_SECONDS.observe(seconds, "ok" if ok else "error")
+    _record(db_queries=1, db_ms=seconds * 1000)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache, "hit" if hit else "miss")
+    if hit:
+        _record(cache_hits=1)
+    else:
+        _record(cache_misses=1)
+
+
+def record_user_cache(event: str, amount: int = 1) -> None:
+    """Evento de la caché de usuarios (profile_hits, disk_reads...); la E/S de disco también
+    va a la traza de la petición en curso."""
+    USER_CACHE_EVENTS.inc(event, amount=amount)
+    if event in ("disk_reads", "disk_writes"):
+        _record(**{f"user_{event}": amount})
+
+
+def record_llm_call(
+    namespace: str,
+    model: str,
+    seconds: float,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    cache_hit: Optional[bool] = None,
+) -> None:
+    """Registra una llamada al LLM. `cache_hit=None` si la llamada no pasa por la caché."""
+    cache = "none" if cache_hit is None else ("hit" if cache_hit else "miss")
+    LLM_SECONDS.observe(seconds, namespace, cache)
+    if input_tokens:
+        LLM_TOKENS.inc(namespace, model, "input", amount=input_tokens)
+    if output_tokens:
+        LLM_TOKENS.inc(namespace, model, "output", amount=output_tokens)
+    _record(llm_calls=1, llm_ms=seconds * 1000, input_tokens=input_tokens, output_tokens=output_tokens)
+    if cache_hit is not None:
+        record_cache("llm", cache_hit)
+
+
+def render_metrics() -> str:
+    return registry.render()
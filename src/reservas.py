@@ -0,0 +1,393 @@
+import bisect
+import heapq
+import itertools
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from src.db import execute_query, pooled_connection
+
+# Motor de reservaciones en memoria para Galleta:
+#   - índice id -> viaje (sin recorrer el catálogo en cada reserva)
+#   - descuento de cupos atómico con un lock por viaje (no se sobrevende con reservas concurrentes)
+#   - ids de reservación de un contador atómico y un índice secundario por usuario
+
+
+class ReservationEngine:
+    def __init__(self, viajes: Iterable[Dict[str, Any]], on_change: Optional[Callable[[], Any]] = None):
+        """`viajes`: dicts del catálogo; se indexan por id y sus cupos se actualizan en el lugar.
+        `on_change`: se llama tras cada cambio de cupos (p. ej. para invalidar el prompt)."""
+        self._viajes: Dict[int, Dict[str, Any]] = {int(v["id"]): v for v in viajes}
+        self._viaje_locks: Dict[int, threading.Lock] = {vid: threading.Lock() for vid in self._viajes}
+        self._counter = itertools.count(1)
+        self._counter_lock = threading.Lock()
+        self._por_usuario: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._por_viaje: Dict[int, List[int]] = defaultdict(list)
+        self._index_lock = threading.Lock()
+        self.on_change = on_change
+
+    def viajes(self) -> List[Dict[str, Any]]:
+        return list(self._viajes.values())
+
+    def catalogo(self) -> Dict[int, Dict[str, Any]]:
+        """Índice id -> viaje sin copiar (solo lectura)."""
+        return self._viajes
+
+    def viaje(self, viaje_id: int) -> Optional[Dict[str, Any]]:
+        return self._viajes.get(int(viaje_id))
+
+    def reservar(self, user_id: str, viaje_id: int, num_personas: int = 1) -> Dict[str, Any]:
+        """Descuenta cupos y registra la reservación. Devuelve {"success", ...} como antes."""
+        viaje = self._viajes.get(int(viaje_id))
+        if not viaje:
+            return {"success": False, "error": "El viaje no existe"}
+        if num_personas < 1:
+            return {"success": False, "error": "La reservación debe ser para al menos 1 persona"}
+
+        # Comprobar y descontar bajo el mismo lock: dos reservas no pueden ver los mismos cupos
+        with self._viaje_locks[viaje["id"]]:
+            if viaje["cupos_disponibles"] < num_personas:
+                return {"success": False, "error": f"Solo hay {viaje['cupos_disponibles']} cupos disponibles"}
+            viaje["cupos_disponibles"] -= num_personas
+        with self._counter_lock:
+            reservacion_id = next(self._counter)
+
+        reservacion = {
+            "id": reservacion_id,
+            "usuario_id": user_id,
+            "viaje": {k: v for k, v in viaje.items() if k != "cupos_disponibles"},
+            "num_personas": num_personas,
+            "total": viaje["precio"] * num_personas,
+            "estado": "confirmada",
+        }
+        with self._index_lock:
+            self._por_usuario[user_id].append(reservacion)
+            self._por_viaje[viaje["id"]].append(reservacion_id)
+        if self.on_change:
+            self.on_change()
+
+        return {
+            "success": True,
+            "reservacion_id": reservacion_id,
+            "destino": viaje["destino"],
+            "num_personas": num_personas,
+            "total": reservacion["total"],
+        }
+
+    def reservaciones_de(self, user_id: str) -> List[Dict[str, Any]]:
+        with self._index_lock:
+            return list(self._por_usuario.get(user_id, []))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._index_lock:
+            return {
+                "reservaciones": sum(len(r) for r in self._por_usuario.values()),
+                "usuarios": len(self._por_usuario),
+                "cupos_disponibles": sum(v["cupos_disponibles"] for v in self._viajes.values()),
+            }
+
+
+# ------------------ ÍNDICE DE BÚSQUEDA ------------------
+
+# Índice en memoria sobre el catálogo para responder filtros sin recorrerlo entero:
+#   - arreglos ordenados por precio y por fecha de salida (rangos con bisect)
+#   - índice invertido de palabras normalizadas (minúsculas, sin acentos) de destino y
+#     descripción, con búsqueda por prefijo ("japo" encuentra "Japón")
+#   - la disponibilidad se lee del dict del viaje en el momento de la consulta, así que
+#     las reservas no obligan a reconstruir el índice
+
+_STOPWORDS = {"de", "del", "la", "las", "el", "los", "en", "con", "y", "a", "al", "por", "para", "un", "una"}
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas y sin acentos: 'Japón' -> 'japon'."""
+    t = unicodedata.normalize("NFKD", texto or "")
+    return "".join(c for c in t if not unicodedata.combining(c)).lower()
+
+
+def _palabras(texto: str) -> List[str]:
+    return [w for w in re.findall(r"\w+", normalizar(texto)) if len(w) > 1 and w not in _STOPWORDS]
+
+
+class CatalogIndex:
+    # Si se esperan más visitas que esto recorriendo por precio, conviene intersectar primero
+    MAX_VISITAS_ORDENADAS = 2000
+
+    def __init__(self, viajes: Iterable[Dict[str, Any]]):
+        self._viajes: Dict[int, Dict[str, Any]] = {int(v["id"]): v for v in viajes}
+        por_precio = sorted((float(v["precio"]), vid) for vid, v in self._viajes.items())
+        self._precios = [p for p, _ in por_precio]
+        self._ids_por_precio = [vid for _, vid in por_precio]
+        por_fecha = sorted((str(v["fecha_salida"]), vid) for vid, v in self._viajes.items())
+        self._fechas = [f for f, _ in por_fecha]
+        self._ids_por_fecha = [vid for _, vid in por_fecha]
+        postings: Dict[str, set] = defaultdict(set)
+        for vid, v in self._viajes.items():
+            for w in _palabras(f"{v['destino']} {v.get('descripcion') or ''}"):
+                postings[w].add(vid)
+        self._postings = dict(postings)
+        self._vocab = sorted(self._postings)
+
+    def __len__(self) -> int:
+        return len(self._viajes)
+
+    def _por_prefijo(self, palabra: str) -> set:
+        """Ids con alguna palabra que empiece por `palabra` (no modificar el set devuelto)."""
+        i = j = bisect.bisect_left(self._vocab, palabra)
+        while j < len(self._vocab) and self._vocab[j].startswith(palabra):
+            j += 1
+        if j - i == 1:
+            return self._postings[self._vocab[i]]
+        return set().union(*(self._postings[w] for w in self._vocab[i:j]))
+
+    def buscar(
+        self,
+        texto: Optional[str] = None,
+        precio_min: Optional[float] = None,
+        precio_max: Optional[float] = None,
+        salida_desde: Optional[str] = None,
+        salida_hasta: Optional[str] = None,
+        min_cupos: int = 1,
+        limite: int = 20,
+    ) -> List[Dict[str, Any]]:
+        """Viajes que cumplen todos los filtros, ordenados por precio (máximo `limite`).
+        Las fechas son 'YYYY-MM-DD' (inclusive)."""
+        # Rangos de precio y fecha: solo se calculan los límites (O(log n))
+        lo = bisect.bisect_left(self._precios, precio_min) if precio_min is not None else 0
+        hi = bisect.bisect_right(self._precios, precio_max) if precio_max is not None else len(self._precios)
+        flo = bisect.bisect_left(self._fechas, salida_desde) if salida_desde else 0
+        fhi = bisect.bisect_right(self._fechas, salida_hasta + "\uffff") if salida_hasta else len(self._fechas)
+        por_texto: Optional[set] = None
+        for w in _palabras(texto or ""):
+            ids = self._por_prefijo(w)
+            por_texto = ids if por_texto is None else por_texto & ids
+            if not por_texto:
+                return []
+
+        n = len(self._viajes)
+        en_fecha = salida_desde is not None or salida_hasta is not None
+
+        def fecha_ok(v: Dict[str, Any]) -> bool:
+            f = str(v["fecha_salida"])
+            return (not salida_desde or f >= salida_desde) and (not salida_hasta or f[:len(salida_hasta)] <= salida_hasta)
+
+        # Estrategia 1: recorrer el rango de precios (ya ordenado) y cortar al llegar a `limite`.
+        # Se espera visitar ~limite / selectividad de los demás filtros.
+        selectividad = 1.0
+        if en_fecha:
+            selectividad *= max(fhi - flo, 0) / max(n, 1)
+        if por_texto is not None:
+            selectividad *= len(por_texto) / max(n, 1)
+        visitas = (hi - lo) if selectividad == 0 else min(hi - lo, limite / selectividad)
+        if visitas <= self.MAX_VISITAS_ORDENADAS or (por_texto is None and not en_fecha):
+            resultado = []
+            for vid in itertools.islice(self._ids_por_precio, lo, hi):
+                v = self._viajes[vid]
+                if (
+                    v["cupos_disponibles"] >= min_cupos
+                    and (por_texto is None or vid in por_texto)
+                    and (not en_fecha or fecha_ok(v))
+                ):
+                    resultado.append(v)
+                    if len(resultado) >= limite:
+                        break
+            return resultado
+
+        # Estrategia 2: filtros muy selectivos -> intersectar candidatos (en C, con sets)
+        # y ordenar solo lo que queda
+        rango_fechas = itertools.islice(self._ids_por_fecha, flo, fhi)
+        if por_texto is not None:
+            candidatos = por_texto.intersection(rango_fechas) if en_fecha else por_texto
+        else:
+            candidatos = rango_fechas
+        encontrados = (
+            v for v in map(self._viajes.__getitem__, candidatos)
+            if v["cupos_disponibles"] >= min_cupos
+            and (precio_min is None or v["precio"] >= precio_min)
+            and (precio_max is None or v["precio"] <= precio_max)
+        )
+        return heapq.nsmallest(limite, encontrados, key=lambda v: (v["precio"], v["id"]))
+
+
+# ------------------ POSTGRESQL ------------------
+
+# Misma interfaz que ReservationEngine pero sobre las tablas `viajes` y `reservaciones`
+# de init_db.sql (ver setup_database.py). La reserva es una sola sentencia: el UPDATE
+# condicional descuenta cupos solo si alcanzan y el INSERT usa su RETURNING, así que
+# no hay sobreventa aunque reserven varios workers a la vez.
+
+_VIAJES_SQL = (
+    "SELECT id, destino, descripcion, precio, fecha_salida, fecha_regreso, cupos_disponibles "
+    "FROM viajes ORDER BY fecha_salida, id"
+)
+
+_RESERVAR_SQL = """
+WITH upd AS (
+    UPDATE viajes SET cupos_disponibles = cupos_disponibles - %(n)s
+    WHERE id = %(viaje_id)s AND cupos_disponibles >= %(n)s
+    RETURNING id, destino, precio, cupos_disponibles
+)
+INSERT INTO reservaciones (usuario_id, viaje_id, num_personas, total)
+SELECT %(usuario_id)s, upd.id, %(n)s, upd.precio * %(n)s FROM upd
+RETURNING id, total, (SELECT destino FROM upd), (SELECT cupos_disponibles FROM upd)
+"""
+
+_RESERVACIONES_SQL = (
+    "SELECT r.id, r.num_personas, r.total, r.estado, r.fecha_reservacion, "
+    "v.id, v.destino, v.descripcion, v.precio, v.fecha_salida, v.fecha_regreso "
+    "FROM reservaciones r JOIN viajes v ON v.id = r.viaje_id "
+    "WHERE r.usuario_id = %s ORDER BY r.id"
+)
+
+
+def _viaje_row(row: tuple) -> Dict[str, Any]:
+    vid, destino, descripcion, precio, salida, regreso, cupos = row
+    return {
+        "id": vid,
+        "destino": destino,
+        "descripcion": descripcion,
+        "precio": float(precio),
+        "fecha_salida": salida.isoformat(),
+        "fecha_regreso": regreso.isoformat(),
+        "cupos_disponibles": cupos,
+    }
+
+
+# Campos que usa CatalogIndex; los cupos se leen del dict en cada búsqueda
+_CAMPOS_INDICE = ("destino", "descripcion", "precio", "fecha_salida", "fecha_regreso")
+
+
+def _campos_indice(viaje: Dict[str, Any]) -> tuple:
+    return tuple(viaje[c] for c in _CAMPOS_INDICE)
+
+
+class PostgresReservationStore:
+    def __init__(self, cache_ttl: float = 30, on_change: Optional[Callable[[], Any]] = None):
+        """`cache_ttl`: segundos que se reutilizan el catálogo y las reservaciones leídas.
+        Las reservas hechas en este proceso actualizan la caché al momento; las de otros
+        workers se ven como mucho `cache_ttl` segundos después.
+        `on_change`: se llama cuando un refresco de la caché trae viajes nuevos, borrados o con
+        otro destino, precio o fechas; los cambios de cupos no lo disparan."""
+        self.cache_ttl = cache_ttl
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._catalogo: Optional[Dict[int, Dict[str, Any]]] = None
+        self._catalogo_at = 0.0
+        self._por_usuario: Dict[int, Any] = {}  # usuario_id -> (instante, reservaciones)
+        self.db_reads = 0
+
+    def _catalogo_vigente(self) -> Dict[int, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            if self._catalogo is not None and now - self._catalogo_at < self.cache_ttl:
+                return self._catalogo
+        rows = execute_query(_VIAJES_SQL)
+        nuevo = {r[0]: _viaje_row(r) for r in rows}
+        with self._lock:
+            self.db_reads += 1
+            self._catalogo_at = now
+            actual = self._catalogo
+            if actual is not None and actual.keys() == nuevo.keys() and all(
+                _campos_indice(actual[vid]) == _campos_indice(v) for vid, v in nuevo.items()
+            ):
+                # Solo cambiaron cupos (p. ej. reservas de otro worker): en el lugar, así los
+                # índices que guardan estos dicts siguen siendo válidos y ven los cupos nuevos
+                for vid, v in nuevo.items():
+                    actual[vid]["cupos_disponibles"] = v["cupos_disponibles"]
+                return actual
+            cambio = actual is not None
+            self._catalogo = nuevo
+        if cambio and self.on_change:
+            self.on_change()
+        return nuevo
+
+    def viajes(self) -> List[Dict[str, Any]]:
+        return list(self._catalogo_vigente().values())
+
+    def catalogo(self) -> Dict[int, Dict[str, Any]]:
+        """Índice id -> viaje sin copiar (solo lectura)."""
+        return self._catalogo_vigente()
+
+    def viaje(self, viaje_id: int) -> Optional[Dict[str, Any]]:
+        return self._catalogo_vigente().get(int(viaje_id))
+
+    def reservar(self, user_id: str, viaje_id: int, num_personas: int = 1) -> Dict[str, Any]:
+        try:
+            usuario_id = int(user_id)
+        except (TypeError, ValueError):
+            return {"success": False, "error": "El usuario debe tener un ID numérico"}
+        if num_personas < 1:
+            return {"success": False, "error": "La reservación debe ser para al menos 1 persona"}
+
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_RESERVAR_SQL, {"n": num_personas, "viaje_id": int(viaje_id), "usuario_id": usuario_id})
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute("SELECT cupos_disponibles FROM viajes WHERE id = %s", (int(viaje_id),))
+                    cupos = cur.fetchone()
+        if row is None:
+            if cupos is None:
+                return {"success": False, "error": "El viaje no existe"}
+            return {"success": False, "error": f"Solo hay {cupos[0]} cupos disponibles"}
+
+        reservacion_id, total, destino, cupos_restantes = row
+        with self._lock:
+            # En el lugar: los índices que guardan este dict ven los cupos nuevos
+            if self._catalogo is not None and int(viaje_id) in self._catalogo:
+                self._catalogo[int(viaje_id)]["cupos_disponibles"] = cupos_restantes
+            self._por_usuario.pop(usuario_id, None)
+        return {
+            "success": True,
+            "reservacion_id": reservacion_id,
+            "destino": destino,
+            "num_personas": num_personas,
+            "total": float(total),
+        }
+
+    def reservaciones_de(self, user_id: str) -> List[Dict[str, Any]]:
+        try:
+            usuario_id = int(user_id)
+        except (TypeError, ValueError):
+            return []
+        now = time.monotonic()
+        with self._lock:
+            cached = self._por_usuario.get(usuario_id)
+            if cached is not None and now - cached[0] < self.cache_ttl:
+                return list(cached[1])
+        reservaciones = [
+            {
+                "id": rid,
+                "usuario_id": usuario_id,
+                "viaje": {
+                    "id": vid,
+                    "destino": destino,
+                    "descripcion": descripcion,
+                    "precio": float(precio),
+                    "fecha_salida": salida.isoformat(),
+                    "fecha_regreso": regreso.isoformat(),
+                },
+                "num_personas": n,
+                "total": float(total),
+                "estado": estado,
+                "fecha_reservacion": fecha.isoformat() if fecha else None,
+            }
+            for rid, n, total, estado, fecha, vid, destino, descripcion, precio, salida, regreso in execute_query(
+                _RESERVACIONES_SQL, (usuario_id,)
+            )
+        ]
+        with self._lock:
+            self._por_usuario[usuario_id] = (now, reservaciones)
+            self.db_reads += 1
+        return list(reservaciones)
+
+    def stats(self) -> Dict[str, Any]:
+        rows = execute_query(
+            "SELECT (SELECT COUNT(*) FROM reservaciones), (SELECT COUNT(DISTINCT usuario_id) FROM reservaciones), "
+            "(SELECT COALESCE(SUM(cupos_disponibles), 0) FROM viajes)"
+        )
+        reservaciones, usuarios, cupos = rows[0]
+        return {"reservaciones": reservaciones, "usuarios": usuarios, "cupos_disponibles": int(cupos), "db_reads": self.db_reads}
@@ -1,24 +1,68 @@
+import asyncio
 import os
+import secrets
+import time
+import threading
 import json
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Literal, Optional
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from src.simple import agent  # tu agente compilado
+from typing import Iterator, List, Literal, Optional
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from src.simple import (  # tu agente compilado
+    EXPORT_FORMATS, agent, export_rows, llm_gemini, llm_groq, planner_stats, resolve_table_identifier,
+)
+from src.catalog import schema_cache
+from src.llm_cache import llm_cache, token_usage
+from src.metrics import RequestTrace, record_llm_call, render_metrics, request_trace, tracing
+from src.history_store import ConversationStore, UserCache
+from src.history_window import HistoryCompactor, count_turn_tokens
 
 AGENT_API_KEY = os.getenv("AGENT_API_KEY")
+# Credencial de administrador para la exportación de tablas; sin ella el endpoint queda deshabilitado
+AGENT_ADMIN_KEY = os.getenv("AGENT_ADMIN_KEY")
+# Adjunta a todas las respuestas el desglose de tiempos por nodo (además de req.debug)
+DEBUG_TIMINGS = os.getenv("DEBUG_TIMINGS", "0") not in ("0", "false", "False")
 
-# Carpeta para persistencia simple (historial y perfiles)
+# Carpeta para persistencia simple (historial y perfiles); AGENT_DATA_DIR permite usar
+# otra (p. ej. una temporal en benchmarks/pipeline.py)
 BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = (BASE_DIR / ".." / "data").resolve()
+DATA_DIR = Path(os.getenv("AGENT_DATA_DIR") or (BASE_DIR / ".." / "data")).resolve()
 HISTORY_DIR = DATA_DIR / "history"
 PROFILE_DIR = DATA_DIR / "profiles"
 for d in (HISTORY_DIR, PROFILE_DIR):
     d.mkdir(parents=True, exist_ok=True)
 
-app = FastAPI()
+# Historial: turnos que se cargan por petición y que se conservan por usuario
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "50"))
+HISTORY_RETENTION = int(os.getenv("HISTORY_RETENTION", "500"))
+# Los antiguos data/history/{user_id}.json se importan al primer acceso
+history_store = ConversationStore(DATA_DIR / "conversations.sqlite", legacy_dir=HISTORY_DIR, retention=HISTORY_RETENTION)
+
+# Los modelos se crean en el primer uso (importar el agente no carga los SDK de Groq/Gemini).
+# Con LLM_WARMUP=1 se cargan en segundo plano al arrancar: el worker queda listo enseguida
+# y la primera petición normalmente ya no paga ese costo.
+LLM_WARMUP = os.getenv("LLM_WARMUP", "1") not in ("0", "false", "False")
+
+def _warmup_models() -> None:
+    for model in (llm_groq, llm_gemini):
+        try:
+            model.get()
+        except Exception:
+            # Sin credenciales, etc.: el primer uso real vuelve a intentarlo y reporta el error
+            pass
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if LLM_WARMUP:
+        threading.Thread(target=_warmup_models, name="llm-warmup", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 # En dev no es necesario CORS si llamas vía proxy .NET (mismo origen).
 # Si vas a llamar directo desde el browser, ajusta allow_origins con tu dominio.
 app.add_middleware(
@@ -37,34 +81,17 @@ class ChatRequest(BaseModel):
     user_id: Optional[int] = None
     user_name: Optional[str] = None
     history: Optional[List[ChatTurn]] = None
-
-def _history_path(user_id: int) -> Path:
-    return HISTORY_DIR / f"{user_id}.json"
+    # Incluye en la respuesta `timings`: tiempo, consultas a BD y tokens por nodo
+    debug: bool = False
 
 def _profile_path(user_id: int) -> Path:
     return PROFILE_DIR / f"{user_id}.json"
 
-def load_history(user_id: Optional[int]) -> List[ChatTurn]:
-    if not user_id:
-        return []
-    p = _history_path(int(user_id))
-    if not p.exists():
-        return []
-    try:
-        data = json.loads(p.read_text(encoding="utf-8"))
-        return [ChatTurn(**t) for t in data]
-    except Exception:
-        return []
-
-def save_history(user_id: Optional[int], turns: List[ChatTurn]) -> None:
+def append_history(user_id: Optional[int], turns: List[ChatTurn]) -> None:
+    """Agrega solo los turnos nuevos; nunca reescribe el historial completo."""
     if not user_id:
         return
-    # Limitar tamaño del historial para evitar crecimiento infinito
-    trimmed = turns[-50:]
-    _history_path(int(user_id)).write_text(
-        json.dumps([t.model_dump() for t in trimmed], ensure_ascii=False, indent=0),
-        encoding="utf-8",
-    )
+    user_cache.append_history(user_id, [(t.role, t.content) for t in turns])
 
 def load_profile(user_id: Optional[int]) -> dict:
     if not user_id:
@@ -84,6 +111,53 @@ def save_profile(user_id: Optional[int], profile: dict) -> None:
         json.dumps(profile, ensure_ascii=False, indent=0), encoding="utf-8"
     )
 
+# Caché en memoria de perfiles e historial reciente (perfiles con escritura diferida)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+PROFILE_FLUSH_INTERVAL = float(os.getenv("PROFILE_FLUSH_INTERVAL", "2"))
+# Con varios workers el historial cacheado puede ir hasta USER_CACHE_TTL s por detrás de lo que
+# guardó otro worker; USER_CACHE_HISTORY=0 lo lee siempre de SQLite (los perfiles se siguen cacheando)
+USER_CACHE_HISTORY = os.getenv("USER_CACHE_HISTORY", "1") not in ("0", "false", "False")
+user_cache = UserCache(
+    history_store,
+    load_profile,
+    save_profile,
+    max_users=USER_CACHE_SIZE,
+    window=HISTORY_WINDOW,
+    ttl=USER_CACHE_TTL,
+    flush_interval=PROFILE_FLUSH_INTERVAL,
+    cache_history=USER_CACHE_HISTORY,
+)
+
+# Compactación del historial: ventana por tokens + resumen acumulado de lo anterior
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+
+async def summarize_turns(previous: str, rows) -> str:
+    """Pliega turnos que salieron de la ventana en el resumen acumulado (Groq)."""
+    transcript = "\n".join(f"{role}: {content}" for _, role, content in rows)
+    messages = [
+        SystemMessage(content=(
+            "Resume la conversación en español en 5 frases como máximo. Conserva nombres, "
+            "preferencias, tablas o datos mencionados y decisiones tomadas."
+        )),
+        HumanMessage(content=f"Resumen previo:\n{previous or '(vacío)'}\n\nNuevos turnos:\n{transcript}"),
+    ]
+    start = time.perf_counter()
+    msg = await llm_groq.ainvoke(messages)
+    record_llm_call("summary", llm_groq.model_name, time.perf_counter() - start, *token_usage(messages, msg))
+    return str(msg.content)
+
+# Los turnos fuera de la ventana se resumen cuando suman más de estos tokens (por defecto la
+# mitad del presupuesto); hasta entonces se envían completos
+HISTORY_RESUMMARIZE_TOKENS = int(os.getenv("HISTORY_RESUMMARIZE_TOKENS") or HISTORY_TOKEN_BUDGET // 2)
+history_compactor = HistoryCompactor(
+    history_store,
+    summarize_turns,
+    budget=HISTORY_TOKEN_BUDGET,
+    resummarize_tokens=HISTORY_RESUMMARIZE_TOKENS,
+    max_users=USER_CACHE_SIZE,
+)
+
 def to_lc_messages(turns: List[ChatTurn]):
     out = []
     for t in turns or []:
@@ -95,8 +169,7 @@ def to_lc_messages(turns: List[ChatTurn]):
             out.append(SystemMessage(content=t.content))
     return out
 
-@app.post("/api/chat")
-def chat(req: ChatRequest, authorization: Optional[str] = Header(None)):
+def require_token(authorization: Optional[str]) -> None:
     # Protección simple por token (opcional pero recomendable)
     if AGENT_API_KEY:
         if not authorization or not authorization.startswith("Bearer "):
@@ -105,37 +178,245 @@ def chat(req: ChatRequest, authorization: Optional[str] = Header(None)):
         if token != AGENT_API_KEY:
             raise HTTPException(status_code=403, detail="Forbidden")
 
-    # Cargar historial persistido (si hay user_id)
-    persisted: List[ChatTurn] = load_history(req.user_id)
-    profile = load_profile(req.user_id)
+def require_admin_token(authorization: Optional[str]) -> None:
+    # Para endpoints que sacan datos de la BD: a diferencia de require_token, sin clave
+    # configurada se rechaza (CORS admite cualquier origen)
+    if not AGENT_ADMIN_KEY:
+        raise HTTPException(status_code=503, detail="Exportación deshabilitada: falta AGENT_ADMIN_KEY")
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not secrets.compare_digest(authorization.split(" ", 1)[1], AGENT_ADMIN_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+async def prepare_turn(req: ChatRequest):
+    """Carga historial/perfil y construye el estado inicial del grafo.
+    Devuelve (state, pending_turns, profile, usage); pending_turns es el historial enviado por
+    el cliente que aún no está persistido y usage el conteo de tokens del contexto.
+    """
+    user_cache.begin_request()
+    # Cargar historial persistido (si hay user_id); la E/S de disco va a un hilo
+    persisted_rows = await asyncio.to_thread(user_cache.get_history_rows, req.user_id, HISTORY_WINDOW) if req.user_id else []
+    profile = await asyncio.to_thread(user_cache.get_profile, req.user_id) if req.user_id else {}
 
-    # Actualizar nombre en el perfil si se envía uno nuevo
+    # Actualizar nombre en el perfil si se envía uno nuevo (solo se escribe si cambió)
     if req.user_name:
         profile["name"] = req.user_name
-        save_profile(req.user_id, profile)
+        if req.user_id:
+            user_cache.set_profile(req.user_id, profile)
 
     # Elegir la fuente de historial: prioriza persistido si existe
-    base_history = persisted if persisted else (req.history or [])
-
-    # Agregar una instrucción de sistema con el nombre recordado, si está
-    sys_msgs: List[ChatTurn] = []
-    if profile.get("name"):
-        sys_msgs.append(ChatTurn(role="system", content=f"El usuario se llama {profile['name']}. Dirígete a él por su nombre cuando sea natural."))
+    if persisted_rows:
+        pending_turns: List[ChatTurn] = []
+        compacted = await history_compactor.compact(req.user_id, persisted_rows)
+    else:
+        pending_turns = req.history or []
+        client_rows = [(i, t.role, t.content) for i, t in enumerate(pending_turns, start=1)]
+        compacted = await history_compactor.compact(None, client_rows)
+    # Solo los turnos que caben en el presupuesto de tokens; lo anterior va resumido
+    base_history = [ChatTurn(role=r, content=c) for _, r, c in compacted["window"]]
 
-    # Construir historial LC + mensaje actual
-    history = to_lc_messages(sys_msgs + base_history)
+    # Construir historial LC + mensaje actual; el nombre recordado va en `user_name`
+    # y el grafo lo renderiza en el prompt de sistema (no se agrega a `messages`)
+    history = to_lc_messages(base_history)
     state = {
         "messages": history + [HumanMessage(content=req.message)],
         "user_role": req.user_role,
         "user_id": req.user_id,
         "user_name": profile.get("name"),
+        "conversation_summary": compacted["summary"],
     }
-    result = agent.invoke(state)
-    ai_msg = result.get("messages", [])[-1].content if result.get("messages") else ""
+    usage = dict(compacted["usage"])
+    usage["message_tokens"] = count_turn_tokens("user", req.message)
+    usage["input_tokens"] = count_tokens_approximately(state["messages"]) + usage["summary_tokens"]
+    return state, pending_turns, profile, usage
 
-    # Persistir historial si hay user_id
+async def persist_turn(req: ChatRequest, pending_turns: List[ChatTurn], ai_msg: str) -> None:
+    # Persistir historial si hay user_id (solo se agregan los turnos nuevos)
     if req.user_id:
-        new_history = base_history + [ChatTurn(role="user", content=req.message), ChatTurn(role="assistant", content=ai_msg)]
-        save_history(req.user_id, new_history)
+        new_turns = pending_turns + [ChatTurn(role="user", content=req.message), ChatTurn(role="assistant", content=ai_msg)]
+        await asyncio.to_thread(append_history, req.user_id, new_turns)
+
+@app.post("/api/chat")
+async def chat(req: ChatRequest, authorization: Optional[str] = Header(None)):
+    require_token(authorization)
+    with request_trace("chat") as trace:
+        state, pending_turns, profile, usage = await prepare_turn(req)
+
+        # ainvoke: mientras se espera a Groq/Gemini el worker atiende otras peticiones
+        result = await agent.ainvoke(state)
+        ai_msg = result.get("messages", [])[-1].content if result.get("messages") else ""
+
+        await persist_turn(req, pending_turns, ai_msg)
+    response = {"reply": ai_msg, "remembered_name": profile.get("name"), "context_tokens": usage}
+    if req.debug or DEBUG_TIMINGS:
+        response["timings"] = trace.summary()
+    return response
+
+
+# ------------------ STREAMING (SSE) ------------------
 
-    return {"reply": ai_msg, "remembered_name": profile.get("name")}
+# Evento de progreso que se emite al empezar cada nodo del grafo
+NODE_PROGRESS = {
+    "check_access": "checking access",
+    "plan": "planning",
+    "clarify": "clarifying",
+    "execute": "querying DB",
+    "reason": "reasoning",
+    "finalize": "answering",
+    "template": "answering",
+}
+
+# Solo se reenvían al cliente los tokens del nodo que redacta la respuesta final
+STREAMED_TOKEN_NODES = {"finalize"}
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest, authorization: Optional[str] = Header(None)):
+    """Igual que /api/chat pero por Server-Sent Events.
+
+    Eventos: `progress` ({node, status}) al iniciar cada nodo, `token` ({text}) con los
+    tokens de la respuesta final y `done` ({reply, remembered_name, context_tokens}) al terminar.
+    En modo debug `done` incluye además `timings`. Si ocurre un error se emite `error` ({detail}).
+    """
+    require_token(authorization)
+    # La traza se activa dos veces: aquí (historial, resumen) y dentro del generador, que
+    # Starlette itera después de que este handler retornó
+    trace = RequestTrace("chat_stream")
+    with tracing(trace):
+        state, pending_turns, profile, usage = await prepare_turn(req)
+
+    async def events():
+        with tracing(trace):
+            async for event in _stream_events():
+                yield event
+
+    async def _stream_events():
+        final_state: dict = {}
+        try:
+            async for mode, chunk in agent.astream(state, stream_mode=["tasks", "messages", "values"]):
+                if mode == "tasks":
+                    # Los eventos de inicio de tarea traen "input"; los de fin traen "result"
+                    if "input" in chunk and chunk.get("name") in NODE_PROGRESS:
+                        yield sse_event("progress", {"node": chunk["name"], "status": NODE_PROGRESS[chunk["name"]]})
+                elif mode == "messages":
+                    msg, meta = chunk
+                    if (
+                        meta.get("langgraph_node") in STREAMED_TOKEN_NODES
+                        and isinstance(msg, AIMessageChunk)
+                        and msg.content
+                    ):
+                        yield sse_event("token", {"text": msg.content})
+                else:
+                    final_state = chunk
+        except Exception as e:
+            trace.finish("error")
+            yield sse_event("error", {"detail": str(e)})
+            return
+
+        messages = final_state.get("messages") or []
+        ai_msg = messages[-1].content if messages else ""
+        await persist_turn(req, pending_turns, ai_msg)
+        done = {"reply": ai_msg, "remembered_name": profile.get("name"), "context_tokens": usage}
+        timings = trace.finish()
+        if req.debug or DEBUG_TIMINGS:
+            done["timings"] = timings
+        yield sse_event("done", done)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ------------------ MÉTRICAS ------------------
+
+@app.get("/metrics")
+def metrics(authorization: Optional[str] = Header(None)):
+    """Histogramas y contadores en formato de texto de Prometheus (ver src/metrics.py)."""
+    require_token(authorization)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ------------------ ADMINISTRACIÓN ------------------
+
+@app.get("/api/admin/schema-cache")
+def schema_cache_stats(authorization: Optional[str] = Header(None)):
+    require_token(authorization)
+    return schema_cache.stats()
+
+@app.post("/api/admin/schema-cache/invalidate")
+def schema_cache_invalidate(authorization: Optional[str] = Header(None)):
+    """Vacía la caché de metadatos (p. ej. justo después de una migración)."""
+    require_token(authorization)
+    return {"removed": schema_cache.invalidate(), **schema_cache.stats()}
+
+@app.get("/api/admin/planner-stats")
+def planner_stats_endpoint(authorization: Optional[str] = Header(None)):
+    """Cuántos planes salieron del planificador por reglas vs. de Groq."""
+    require_token(authorization)
+    return planner_stats()
+
+@app.get("/api/admin/llm-cache")
+def llm_cache_stats(authorization: Optional[str] = Header(None)):
+    require_token(authorization)
+    return llm_cache.stats() if llm_cache else {"enabled": False}
+
+@app.post("/api/admin/llm-cache/invalidate")
+def llm_cache_invalidate(namespace: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Vacía la caché de respuestas de LLM (toda o solo un namespace: plan, reason, finalize)."""
+    require_token(authorization)
+    if not llm_cache:
+        return {"enabled": False}
+    return {"removed": llm_cache.invalidate(namespace), **llm_cache.stats()}
+
+@app.get("/api/admin/user-cache")
+def user_cache_stats(authorization: Optional[str] = Header(None)):
+    """Aciertos de la caché de perfiles/historial, lecturas/escrituras a disco por petición y
+    contención de las escrituras al historial (peticiones simultáneas del mismo usuario)."""
+    require_token(authorization)
+    return {
+        **user_cache.stats(),
+        **history_store.stats(),
+        "summary_recomputes": history_compactor.summary_recomputes,
+        "summary_reuses": history_compactor.summary_reuses,
+        "summary_failures": history_compactor.summary_failures,
+    }
+
+
+async def _iterate_export(chunks: Iterator[str]):
+    """Recorre el generador síncrono de export_rows en hilos, un lote a la vez, y lo cierra al
+    terminar o si el cliente se desconecta (así la conexión del cursor vuelve al pool)."""
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await asyncio.to_thread(chunks.close)
+
+@app.get("/api/admin/export")
+async def export_table(
+    table: str,
+    format: Literal["csv", "ndjson"] = "csv",
+    limit: Optional[int] = None,
+    authorization: Optional[str] = Header(None),
+):
+    """Descarga una tabla completa (o sus primeras `limit` filas) en CSV o NDJSON.
+
+    Se lee con un cursor de servidor por lotes y se envía por streaming: la memoria del
+    servidor no crece con el tamaño de la tabla. El chat solo recibe una vista previa y este enlace.
+    Requiere la clave de administrador (AGENT_ADMIN_KEY), no la del chat.
+    """
+    require_admin_token(authorization)
+    schema, name, err = await asyncio.to_thread(resolve_table_identifier, table)
+    if err or not schema:
+        raise HTTPException(status_code=404, detail=err or "Tabla no especificada")
+    return StreamingResponse(
+        _iterate_export(export_rows(schema, name, format, limit=limit)),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{schema}.{name}.{format}"'},
+    )
@@ -1,14 +1,34 @@
 from langgraph.graph import StateGraph, START, END
+from langgraph.graph.message import add_messages
 from langchain_core.messages import AIMessage, SystemMessage, HumanMessage, BaseMessage
-from langchain.chat_models import init_chat_model
-from typing import Literal, TypedDict, List, Dict, Any, Tuple, Optional
-import psycopg2
+from langchain_core.runnables import RunnableLambda
+from typing import Annotated, Literal, TypedDict, List, Dict, Any, Iterator, Tuple, Optional
 from psycopg2 import sql
+import asyncio
+import csv
+import io
 import os
 import re
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 from dotenv import load_dotenv
-from functools import lru_cache
+
+# Acceso a BD: configuración y pool de conexiones compartido (src/db.py)
+from src.db import (
+    DB_CONFIG,
+    DB_POOL_MAX,
+    DOTNET_CONNSTR,
+    get_db_connection,
+    execute_query,
+    pooled_connection,
+    stream_query,
+)
+from src.llm_cache import acached_invoke, cached_invoke
+from src.lazy_llm import LazyChatModel
+from src.metrics import propagate, traced_node
+from src.catalog import cached_schema_lookup, load_catalog_snapshot, render_overview, schema_cache
 
 load_dotenv()
 
@@ -17,27 +37,18 @@ if os.getenv("GENAI_API_KEY") and not os.getenv("GOOGLE_API_KEY"):
     os.environ["GOOGLE_API_KEY"] = os.getenv("GENAI_API_KEY")
 
 # Modelos: Groq como orquestador, Gemini como razonador
+# Se construyen en el primer uso (ver src/lazy_llm.py): importar este módulo no carga los SDK
 # Groq (planner / finalizer)
-llm_groq = init_chat_model("llama-3.1-8b-instant", model_provider="groq", temperature=0.2)
+llm_groq = LazyChatModel("llama-3.1-8b-instant", model_provider="groq", temperature=0.2)
 # Gemini (reasoning)
-llm_gemini = init_chat_model("models/gemini-2.5-flash", model_provider="google_genai", temperature=0.2)
-
-# Configuración de la base de datos por variables de entorno o cadena .NET
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "database": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-    "port": int(os.getenv("DB_PORT", "5432")),
-    "sslmode": os.getenv("DB_SSLMODE", "require"),
-}
-
-DOTNET_CONNSTR = os.getenv("DB_CONNECTION_STRING") or os.getenv("DOTNET_DEFAULT_CONNECTION")
+llm_gemini = LazyChatModel("models/gemini-2.5-flash", model_provider="google_genai", temperature=0.2)
 
 
 # Definición del estado para LangGraph
+# `messages` solo guarda turnos de conversación (add_messages agrega, no reemplaza);
+# el contexto de sistema (rol, nombre) vive en campos propios y se renderiza en cada llamada al LLM.
 class MessagesState(TypedDict):
-    messages: List[BaseMessage]
+    messages: Annotated[List[BaseMessage], add_messages]
 
 class State(MessagesState, total=False):
     user_role: Literal["usuario", "cliente", "empleado", "administrador"]
@@ -45,60 +56,10 @@ class State(MessagesState, total=False):
     user_name: str
     style: Literal["technical", "non_technical"]
     access_granted: bool
+    system_prompt: str
 
-def _parse_dotnet_pg_connstr(conn: str) -> Dict[str, Any]:
-    """Convierte una connection string estilo .NET (con ;) a kwargs de psycopg2."""
-    parts = [p.strip() for p in conn.strip().split(";") if p.strip()]
-    kv = {}
-    for p in parts:
-        if "=" not in p:
-            continue
-        k, v = p.split("=", 1)
-        kv[k.strip().lower()] = v.strip()
-    host = kv.get("host") or kv.get("server")
-    database = kv.get("database") or kv.get("dbname")
-    user = kv.get("username") or kv.get("user id") or kv.get("user")
-    password = kv.get("password")
-    port = int(kv.get("port", "5432"))
-    sslmode = (kv.get("ssl mode") or kv.get("sslmode") or "require").lower()
-    # Trust Server Certificate=true -> mantener sslmode=require; psycopg2 no soporta "trust" explícito
-    return {
-        "host": host,
-        "database": database,
-        "user": user,
-        "password": password,
-        "port": port,
-        "sslmode": sslmode,
-    }
-
-@lru_cache(maxsize=1)
-def _effective_db_config() -> Dict[str, Any]:
-    if DOTNET_CONNSTR:
-        return _parse_dotnet_pg_connstr(DOTNET_CONNSTR)
-    return DB_CONFIG
-
-def get_db_connection():
-    """Establece conexión con la base de datos PostgreSQL"""
-    cfg = _effective_db_config()
-    missing = [k for k, v in cfg.items() if v in (None, "")]
-    if missing:
-        raise RuntimeError(f"Variables/campos faltantes para DB: {', '.join(missing)}")
-    return psycopg2.connect(**cfg)
-
-def execute_query(query: str, params: tuple = None) -> List[tuple]:
-    """Ejecuta una consulta SQL y retorna las filas."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(query, params or ())
-            if cur.description:
-                return cur.fetchall()
-            return []
-    finally:
-        if conn:
-            conn.close()
 
+@cached_schema_lookup("tables")
 def get_table_list(include_system: bool = False) -> List[tuple]:
     """Obtiene lista de tablas (schema, table_name)."""
     if include_system:
@@ -114,6 +75,7 @@ def get_table_list(include_system: bool = False) -> List[tuple]:
         )
     return execute_query(query)
 
+@cached_schema_lookup("table_count")
 def get_table_count(include_system: bool = False) -> int:
     """Cuenta tablas totales."""
     if include_system:
@@ -135,28 +97,42 @@ def get_last_user_message(state: State) -> str:
             return str(m.content)
     return ""
 
+# Frases clave por intención (en orden de prioridad para detect_db_intent)
+INTENT_KEYWORDS: Dict[str, List[str]] = {
+    "count": ["cuantas tablas", "cuántas tablas", "numero de tablas", "número de tablas", "total de tablas", "how many tables", "count tables"],
+    "list": ["lista de tablas", "listar tablas", "muestrame las tablas", "muéstrame las tablas", "show tables", "list tables"],
+    "columns": ["columnas", "campos", "estructura", "schema de", "describe", "describir"],
+    "rowcount": ["cuantas filas", "cuántas filas", "numero de filas", "número de filas", "registros totales", "row count", "count rows"],
+    "sample": ["muestra filas", "muestrame filas", "primeros", "primeras", "sample", "mostrar filas", "ver filas"],
+    "export": ["exporta", "exportar", "descarga", "descargar", "export", "download", "csv", "ndjson"],
+    # visión general
+    "overview": ["toda la base de datos", "toda su información", "estructura completa", "overview", "esquema completo", "todas las tablas y columnas", "diagrama"],
+}
+
 def detect_db_intent(text: str) -> Optional[str]:
     """Detecta intención relacionada a BD.
-    Retorna uno de: 'count', 'list', 'columns', 'rowcount', 'sample', 'overview', o None.
+    Retorna uno de: 'count', 'list', 'columns', 'rowcount', 'sample', 'export', 'overview', o None.
     """
     t = (text or "").lower()
-    ask_total = ["cuantas tablas", "cuántas tablas", "numero de tablas", "número de tablas", "total de tablas", "how many tables", "count tables"]
-    ask_list = ["lista de tablas", "listar tablas", "muestrame las tablas", "muéstrame las tablas", "show tables", "list tables"]
-    if any(k in t for k in ask_total):
+    if any(k in t for k in INTENT_KEYWORDS["count"]):
         return "count"
-    if any(k in t for k in ask_list) or ("tablas" in t and "columnas" not in t):
+    if any(k in t for k in INTENT_KEYWORDS["list"]) or ("tablas" in t and "columnas" not in t):
         return "list"
-    if any(k in t for k in ["columnas", "campos", "estructura", "schema de", "describe", "describir"]):
-        return "columns"
-    if any(k in t for k in ["cuantas filas", "cuántas filas", "numero de filas", "número de filas", "registros totales", "row count", "count rows"]):
-        return "rowcount"
-    if any(k in t for k in ["muestra filas", "muestrame filas", "primeros", "primeras", "sample", "mostrar filas", "ver filas"]):
-        return "sample"
-    # visión general
-    if any(k in t for k in ["toda la base de datos", "toda su información", "estructura completa", "overview", "esquema completo", "todas las tablas y columnas", "diagrama"]):
-        return "overview"
+    for intent in ("export", "columns", "rowcount", "sample", "overview"):
+        if any(k in t for k in INTENT_KEYWORDS[intent]):
+            return intent
     return None
 
+def wants_exact_count(text: str) -> bool:
+    """True si el usuario pide explícitamente un conteo exacto."""
+    t = (text or "").lower()
+    return any(k in t for k in ["exacto", "exacta", "exactas", "exactos", "exactamente", "exact", "precis"])
+
+def export_format(text: str) -> str:
+    """Formato de exportación pedido en el texto: 'ndjson' si lo menciona (o JSON), si no 'csv'."""
+    t = (text or "").lower()
+    return "ndjson" if any(k in t for k in ["ndjson", "jsonl", "json"]) else "csv"
+
 def extract_table_mention(text: str) -> Optional[str]:
     """Extrae posible mención de tabla (opcionalmente con esquema)."""
     if not text:
@@ -170,6 +146,118 @@ def extract_table_mention(text: str) -> Optional[str]:
     return None
 
 
+
+# ------------------ PLANIFICADOR RÁPIDO (SIN LLM) ------------------
+
+# Confianza mínima para usar el plan por reglas y saltarse la llamada a Groq
+FAST_PLAN_MIN_CONFIDENCE = float(os.getenv("FAST_PLAN_MIN_CONFIDENCE", "0.8"))
+
+# Palabras que pueden seguir a "de"/"tabla" sin ser nombres de tabla
+_TABLE_STOPWORDS = {
+    "de", "del", "la", "el", "los", "las", "un", "una", "unos", "unas", "mi", "mis", "su", "sus", "esta", "este",
+    "esa", "ese", "datos", "base", "tablas", "tabla", "table", "tables", "filas", "registros",
+    "columnas", "campos", "que", "cada", "todas", "todos", "the",
+}
+
+# La palabra siguiente va en un lookahead: en "tabla de reservaciones" el "de" descartado
+# puede ser a su vez la palabra clave de "reservaciones". \b evita "puede", "dónde", etc.
+_TABLE_AFTER_KEYWORD = re.compile(r"\b(?:tabla|table|de|del|from)\s+(?=([A-Za-z_][\w\.\"]*))", re.IGNORECASE)
+_QUALIFIED_TABLE = re.compile(r"\b([A-Za-z_]\w*)\.([A-Za-z_]\w*)\b")
+_SAMPLE_LIMIT = re.compile(r"\b(\d{1,3})\s+(?:filas|registros|primer[oa]s|rows)\b|\b(?:primer[oa]s|first|top)\s+(\d{1,3})\b", re.IGNORECASE)
+
+PLANNER_STATS: Dict[str, int] = {"fast_path": 0, "llm": 0, "llm_unparsed": 0}
+_planner_stats_lock = threading.Lock()
+
+
+def _count_planner_path(path: str) -> None:
+    with _planner_stats_lock:
+        PLANNER_STATS[path] = PLANNER_STATS.get(path, 0) + 1
+
+
+def planner_stats() -> Dict[str, Any]:
+    """Cuántas veces se planificó por reglas vs. con Groq."""
+    with _planner_stats_lock:
+        stats: Dict[str, Any] = dict(PLANNER_STATS)
+    total = sum(stats.values())
+    stats["fast_path_ratio"] = round(stats["fast_path"] / total, 4) if total else 0.0
+    return stats
+
+
+def _table_candidates(text: str) -> List[str]:
+    """Nombres de tabla plausibles en el texto (sin artículos ni palabras comunes), sin duplicados."""
+    found: List[str] = []
+    for m in _QUALIFIED_TABLE.finditer(text):
+        found.append(f"{m.group(1)}.{m.group(2)}")
+    for m in _TABLE_AFTER_KEYWORD.finditer(text):
+        name = m.group(1).strip().strip('"').rstrip(".")
+        if name.lower() not in _TABLE_STOPWORDS:
+            found.append(name)
+    # "public.viajes" y "viajes" cuentan como la misma tabla
+    unique: List[str] = []
+    for name in found:
+        short = name.split(".")[-1]
+        if not any(u == name or u.split(".")[-1] == short for u in unique):
+            unique.append(name)
+    return unique
+
+
+def _sample_limit(text: str) -> int:
+    m = _SAMPLE_LIMIT.search(text)
+    if m:
+        n = int(m.group(1) or m.group(2))
+        if 0 < n <= 100:
+            return n
+    return 5
+
+
+def fast_plan(user_text: str) -> Tuple[Optional[Dict[str, Any]], float]:
+    """Plan determinista por reglas con una confianza en [0, 1].
+
+    La confianza solo es alta si exactamente una intención coincide con sus frases clave
+    y, cuando la acción necesita tabla, hay exactamente un candidato de tabla.
+    """
+    t = (user_text or "").lower()
+    if not t.strip():
+        return None, 0.0
+    matched = [i for i, kws in INTENT_KEYWORDS.items() if any(k in t for k in kws)]
+    if not matched:
+        intent = detect_db_intent(user_text)
+        # Solo coincide la regla laxa ("tablas" suelto): probable listado, pero no seguro
+        if not intent:
+            return None, 0.0
+        return {"intent": intent, "actions": [{"type": "list_tables"}], "clarifications": [], "planner": "rules"}, 0.6
+    if len(matched) > 1:
+        return None, 0.3
+
+    intent = matched[0]
+    confidence = 0.95
+    # Mensajes largos suelen pedir varias cosas o matices que las reglas no capturan
+    if len(t.split()) > 20:
+        confidence -= 0.2
+
+    plan: Dict[str, Any] = {"intent": intent, "actions": [], "clarifications": [], "planner": "rules"}
+    if intent == "overview":
+        plan["actions"].append({"type": "overview"})
+    elif intent == "count":
+        plan["actions"].append({"type": "count_tables"})
+    elif intent == "list":
+        plan["actions"].append({"type": "list_tables"})
+    else:
+        candidates = _table_candidates(user_text)
+        if len(candidates) != 1:
+            # Sin tabla clara (o varias): que decida el LLM
+            return None, 0.4 if not candidates else 0.5
+        action: Dict[str, Any] = {"type": intent, "table": candidates[0]}
+        if intent == "sample":
+            action["limit"] = _sample_limit(user_text)
+        elif intent == "export":
+            action["format"] = export_format(user_text)
+        elif intent == "rowcount" and wants_exact_count(user_text):
+            action["exact"] = True
+        plan["actions"].append(action)
+    return plan, confidence
+
+@cached_schema_lookup("resolve")
 def resolve_table_identifier(raw_name: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """Resuelve nombre de tabla a (schema, table). Devuelve (schema, table, error)."""
     if not raw_name:
@@ -211,6 +299,7 @@ def resolve_table_identifier(raw_name: str) -> Tuple[Optional[str], Optional[str
         return rows[0][0], rows[0][1], None
 
 
+@cached_schema_lookup("columns")
 def get_columns(schema: str, table: str) -> List[tuple]:
     return execute_query(
         """
@@ -227,15 +316,52 @@ def get_row_count_for_table(schema: str, table: str) -> int:
     query = sql.SQL("SELECT COUNT(*) FROM {}.{}").format(
         sql.Identifier(schema), sql.Identifier(table)
     )
-    conn = None
-    try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(query)
-            return int(cur.fetchone()[0])
-    finally:
-        if conn:
-            conn.close()
+    rows = execute_query(query)
+    return int(rows[0][0]) if rows else 0
+
+
+# Por debajo de este número estimado de filas se hace COUNT(*) exacto (es barato)
+ROWCOUNT_EXACT_THRESHOLD = int(os.getenv("ROWCOUNT_EXACT_THRESHOLD", "100000"))
+
+
+def estimate_row_count(schema: str, table: str) -> Tuple[Optional[int], Optional[str]]:
+    """Estimación instantánea del número de filas a partir de las estadísticas.
+
+    Usa la misma extrapolación que el planner (reltuples/relpages * páginas actuales);
+    si la tabla nunca se analizó recurre a pg_stat_user_tables.n_live_tup.
+    Devuelve (estimación, método) o (None, None) si no hay estadísticas.
+    """
+    rows = execute_query(
+        """
+        SELECT c.reltuples, c.relpages,
+               pg_catalog.pg_relation_size(c.oid) / current_setting('block_size')::int,
+               s.n_live_tup
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_catalog.pg_stat_user_tables s ON s.relid = c.oid
+        WHERE n.nspname=%s AND c.relname=%s
+        """,
+        (schema, table),
+    )
+    if not rows:
+        return None, None
+    reltuples, relpages, cur_pages, live = rows[0]
+    if reltuples is not None and reltuples >= 0 and relpages:
+        return int(round(reltuples / relpages * cur_pages)), "pg_class"
+    if live:
+        return int(live), "pg_stat_user_tables"
+    return None, None
+
+
+def count_rows(schema: str, table: str, exact: bool = False) -> Dict[str, Any]:
+    """Cuenta filas: estimación si la tabla es grande, COUNT(*) si es pequeña o se pide exactitud.
+    Retorna {"count": int, "exact": bool, "method": str}.
+    """
+    if not exact:
+        estimate, method = estimate_row_count(schema, table)
+        if estimate is not None and estimate >= ROWCOUNT_EXACT_THRESHOLD:
+            return {"count": estimate, "exact": False, "method": method}
+    return {"count": get_row_count_for_table(schema, table), "exact": True, "method": "count(*)"}
 
 
 def get_sample_rows(schema: str, table: str, limit: int = 5) -> List[tuple]:
@@ -244,19 +370,61 @@ def get_sample_rows(schema: str, table: str, limit: int = 5) -> List[tuple]:
     query = sql.SQL("SELECT * FROM {}.{} LIMIT {}").format(
         sql.Identifier(schema), sql.Identifier(table), sql.Literal(limit)
     )
-    conn = None
-    try:
-        conn = get_db_connection()
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(query)
             rows = cur.fetchall()
             headers = [desc[0] for desc in cur.description]
             return [tuple(headers)] + rows
+
+
+# ------------------ EXPORTACIÓN POR STREAMING ------------------
+
+# Filas por FETCH del cursor de servidor (y por fragmento de la respuesta HTTP)
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "1000"))
+# Filas de vista previa que recibe el chat (y los LLM) al pedir una exportación
+EXPORT_PREVIEW_ROWS = int(os.getenv("EXPORT_PREVIEW_ROWS", "5"))
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
+def _csv_chunk(rows: List[tuple]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+
+def export_rows(schema: str, table: str, fmt: str = "csv", limit: Optional[int] = None) -> Iterator[str]:
+    """Exporta la tabla completa (o sus primeras `limit` filas) como fragmentos CSV o NDJSON.
+
+    Lee con un cursor de servidor en lotes de EXPORT_BATCH_ROWS (src/db.py: stream_query),
+    así que la memoria no depende del número de filas. En CSV el primer fragmento es la cabecera.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato de exportación no soportado: {fmt}")
+    query = sql.SQL("SELECT * FROM {}.{}").format(sql.Identifier(schema), sql.Identifier(table))
+    if limit is not None:
+        query = sql.SQL("{} LIMIT {}").format(query, sql.Literal(max(int(limit), 0)))
+    batches = stream_query(query, batch_size=EXPORT_BATCH_ROWS)
+    try:
+        headers = next(batches)
+        if fmt == "csv":
+            yield _csv_chunk([headers])
+            for rows in batches:
+                yield _csv_chunk(rows)
+            return
+        for rows in batches:
+            yield "".join(json.dumps(dict(zip(headers, r)), ensure_ascii=False, default=str) + "\n" for r in rows)
     finally:
-        if conn:
-            conn.close()
+        # Devuelve la conexión al pool aunque la descarga se corte a medias
+        batches.close()
+
+
+def export_url(schema: str, table: str, fmt: str) -> str:
+    """Ruta de descarga en src/server.py (requiere el mismo token que el resto de la API)."""
+    return "/api/admin/export?" + urlencode({"table": f"{schema}.{table}", "format": fmt})
 
 
+@cached_schema_lookup("primary_key")
 def get_primary_key(schema: str, table: str) -> List[str]:
     rows = execute_query(
         """
@@ -273,6 +441,7 @@ def get_primary_key(schema: str, table: str) -> List[str]:
     return [r[0] for r in rows]
 
 
+@cached_schema_lookup("foreign_keys")
 def get_foreign_keys(schema: str, table: str) -> List[Dict[str, Any]]:
     rows = execute_query(
         """
@@ -303,6 +472,7 @@ def get_foreign_keys(schema: str, table: str) -> List[Dict[str, Any]]:
     return list(fks.values())
 
 
+@cached_schema_lookup("indexes")
 def get_indexes(schema: str, table: str) -> List[Dict[str, Any]]:
     rows = execute_query(
         """
@@ -317,125 +487,100 @@ def get_indexes(schema: str, table: str) -> List[Dict[str, Any]]:
 
 
 def get_db_overview(max_tables: int | None = None) -> str:
-    rows = get_table_list()
-    if not rows:
-        return "No se encontraron tablas (excluyendo schemas del sistema)."
-    lines: List[str] = []
-    count = 0
-    for schema, table in rows:
-        if max_tables is not None and count >= max_tables:
-            break
-        count += 1
-        lines.append(f"# {schema}.{table}")
-        cols = get_columns(schema, table)
-        if cols:
-            lines.append("- Columnas:")
-            for c, t, n in cols:
-                lines.append(f"  - {c}: {t} nullable={n}")
-        pk = get_primary_key(schema, table)
-        if pk:
-            lines.append(f"- PK: {', '.join(pk)}")
-        fks = get_foreign_keys(schema, table)
-        if fks:
-            lines.append("- FKs:")
-            for fk in fks:
-                cols_s = ", ".join(fk["columns"]) 
-                ref_cols_s = ", ".join(fk["ref_columns"]) 
-                lines.append(f"  - {fk['constraint']}: ({cols_s}) -> {fk['ref_schema']}.{fk['ref_table']}({ref_cols_s})")
-        idx = get_indexes(schema, table)
-        if idx:
-            lines.append("- Índices:")
-            for i in idx:
-                lines.append(f"  - {i['name']}: {i['def']}")
-        lines.append("")
-    return "\n".join(lines)
+    """Visión general de la BD a partir de un snapshot del catálogo (consultas set-based)."""
+    snapshot = schema_cache.get_or_load(("snapshot",), load_catalog_snapshot)
+    return render_overview(snapshot, max_tables=max_tables)
 
 
 def check_user_access(state: State):
-    """Verifica el rol del usuario, determina permisos y la forma de hablar (técnica vs no técnica)."""
+    """Verifica el rol del usuario, determina permisos y la forma de hablar (técnica vs no técnica).
+
+    No toca `messages`: las instrucciones de rol quedan en `system_prompt` y se renderizan
+    una sola vez por llamada al LLM (ver render_system_context).
+    """
     new_state: Dict[str, Any] = {}
 
     user_role = state.get("user_role", "usuario")
     user_id = state.get("user_id")
-    user_name = state.get("user_name")
 
     # Por defecto evitamos tecnicismos salvo en administrador
     if user_role == "administrador":
         new_state["access_granted"] = True
         new_state["style"] = "technical"
-        system_msg = SystemMessage(content=(
+        new_state["system_prompt"] = (
             "Eres un asistente para un administrador. Puedes incluir detalles técnicos (tablas, esquemas, índices, SQL) cuando sea útil. "
             "Mantén precisión y justifica brevemente los pasos cuando agregue valor."
-        ))
+        )
     elif user_role == "empleado":
         new_state["access_granted"] = True
         new_state["style"] = "non_technical"
-        system_msg = SystemMessage(content=(
+        new_state["system_prompt"] = (
             "Eres un asistente para un empleado. Evita jerga técnica (SQL, tablas, esquemas, índices). "
             "Explica en lenguaje sencillo, orientado al negocio. Si el usuario pide detalles técnicos de forma explícita, confirma primero."
-        ))
+        )
     elif user_role in ["usuario", "cliente"]:
+        new_state["style"] = "non_technical"
         if user_id:
             new_state["access_granted"] = True
-            new_state["style"] = "non_technical"
-            system_msg = SystemMessage(content=(
+            new_state["system_prompt"] = (
                 f"Asistes a un {user_role}. Solo puedes acceder a la información del usuario con ID {user_id}. "
                 "Responde sin tecnicismos y con foco en utilidad práctica."
-            ))
+            )
         else:
             new_state["access_granted"] = False
-            new_state["style"] = "non_technical"
-            system_msg = SystemMessage(content=(
-                "Acceso denegado. No se proporcionó un ID de usuario válido."
-            ))
+            new_state["messages"] = [AIMessage(content="❌ Acceso denegado. No se proporcionó un ID de usuario válido.")]
     else:
         new_state["access_granted"] = False
         new_state["style"] = "non_technical"
-        system_msg = SystemMessage(content="Rol de usuario no reconocido.")
+        new_state["messages"] = [AIMessage(content="❌ Rol de usuario no reconocido.")]
 
-    # Mensajes de sistema adicionales: coherencia e identidad del usuario
-    sys_msgs = [system_msg]
-    if user_name:
-        sys_msgs.append(SystemMessage(content=(
-            f"El usuario se llama {user_name}. Dirígete a él por su nombre cuando sea natural y mantén consistencia."
-        )))
+    return new_state
 
-    # Agregar mensajes del sistema al inicio del historial existente
-    messages = sys_msgs + state.get("messages", [])
-    new_state["messages"] = messages
 
-    return new_state
+def render_system_context(state: State, instruction: str = "") -> SystemMessage:
+    """Arma el único SystemMessage de una llamada: rol + nombre del usuario + instrucción del nodo."""
+    parts = [state.get("system_prompt") or ""]
+    if state.get("user_name"):
+        parts.append(
+            f"El usuario se llama {state['user_name']}. Dirígete a él por su nombre cuando sea natural y mantén consistencia."
+        )
+    parts.append(instruction)
+    return SystemMessage(content="\n".join(p for p in parts if p))
 
 # ------------------ NODOS DESGLOSADOS ------------------
 
 # Ampliamos el estado con artefactos intermedios
 class State(State, total=False):
+    conversation_summary: str
     plan: Dict[str, Any]
     db_results: List[Dict[str, Any]]
     reasoned_answer: str
 
 
-def plan_with_groq(state: State):
-    """Groq planifica acciones a partir del último mensaje del usuario y su rol."""
-    if not state.get("access_granted", False):
-        return {"messages": [AIMessage(content="❌ Acceso denegado. No tienes permisos suficientes.")]} 
-
+def _plan_messages(state: State) -> List[BaseMessage]:
     user_role = state.get("user_role")
     user_text = get_last_user_message(state)
-
     plan_prompt = (
         "Eres un planificador. Dada la petición del usuario y su rol, genera un plan JSON mínimo.\n"
         "Incluye: intent (string), actions (array), clarifications (array).\n"
-        "Actions: overview, count_tables, list_tables, columns(table), rowcount(table), sample(table, limit).\n"
+        "Actions: overview, count_tables, list_tables, columns(table), rowcount(table, exact), sample(table, limit), "
+        "export(table, format: csv|ndjson).\n"
+        "Usa export (no sample) cuando el usuario quiera descargar o exportar la tabla completa.\n"
+        "En rowcount usa exact=true solo si el usuario pide explícitamente un conteo exacto.\n"
         "Si falta la tabla/esquema, agrega una pregunta en clarifications y NO incluyas esa action.\n"
         "Responde SOLO con JSON válido.\n"
         f"Rol: {user_role}\nUsuario: {user_text}"
     )
-    plan_msg = llm_groq.invoke([SystemMessage(content="Planificador de acciones"), HumanMessage(content=plan_prompt)])
+    return [SystemMessage(content="Planificador de acciones"), HumanMessage(content=plan_prompt)]
+
 
+def _parse_plan(content: str, user_text: str) -> Dict[str, Any]:
+    """Interpreta el JSON del planificador; si no es válido, planifica con reglas."""
     try:
-        plan: Dict[str, Any] = json.loads(plan_msg.content)
+        plan: Dict[str, Any] = json.loads(content)
+        _count_planner_path("llm")
     except Exception:
+        _count_planner_path("llm_unparsed")
         intent = detect_db_intent(user_text)
         plan = {"intent": intent or "general", "actions": [], "clarifications": []}
         if intent == "overview":
@@ -444,14 +589,75 @@ def plan_with_groq(state: State):
             plan["actions"].append({"type": "count_tables"})
         elif intent == "list":
             plan["actions"].append({"type": "list_tables"})
-        elif intent in ("columns", "rowcount", "sample"):
+        elif intent in ("columns", "rowcount", "sample", "export"):
             raw = extract_table_mention(user_text)
             if raw:
-                plan["actions"].append({"type": intent, "table": raw, **({"limit": 5} if intent == "sample" else {})})
+                action = {"type": intent, "table": raw}
+                if intent == "sample":
+                    action["limit"] = 5
+                elif intent == "export":
+                    action["format"] = export_format(user_text)
+                elif intent == "rowcount" and wants_exact_count(user_text):
+                    action["exact"] = True
+                plan["actions"].append(action)
             else:
                 plan["clarifications"].append("¿De qué tabla? Indica 'schema.tabla' o solo 'tabla'.")
+    return plan
+
+
+# Argumentos de caché: la pregunta del usuario (para paráfrasis) y el resto del contexto
+# que determina la respuesta. Así dos preguntas parecidas solo comparten respuesta si
+# los datos, el rol y el estilo son los mismos. El plan solo usa la clave exacta: preguntas
+# casi idénticas sobre tablas distintas ("filas de viajes" / "filas de reservaciones")
+# quedan por encima del umbral de similitud y compartirían plan.
+
+def _answer_cache_args(state: State) -> Dict[str, Any]:
+    return {
+        "semantic_text": get_last_user_message(state),
+        "context": {
+            "role": state.get("user_role"),
+            "style": state.get("style"),
+            "user_name": state.get("user_name"),
+            "system_prompt": state.get("system_prompt"),
+            "plan": state.get("plan"),
+            "db_results": state.get("db_results"),
+            "reasoned_answer": state.get("reasoned_answer"),
+            "conversation": _conversation_context(state),
+        },
+    }
+
+
+_ACCESS_DENIED = {"messages": [AIMessage(content="❌ Acceso denegado. No tienes permisos suficientes.")]}
 
-    return {"plan": plan}
+# Artefactos del turno anterior: con checkpointer el estado persiste entre turnos, y sin esto
+# finalize (y su clave de caché) o should_reason verían los resultados de la pregunta previa
+_TURN_RESET = {"db_results": None, "reasoned_answer": None}
+
+
+def plan_with_groq(state: State):
+    """Groq planifica acciones a partir del último mensaje del usuario y su rol."""
+    if not state.get("access_granted", False):
+        return _ACCESS_DENIED
+    user_text = get_last_user_message(state)
+    plan, confidence = fast_plan(user_text)
+    if plan is not None and confidence >= FAST_PLAN_MIN_CONFIDENCE:
+        _count_planner_path("fast_path")
+        return {"plan": plan, **_TURN_RESET}
+    plan_msg = cached_invoke(llm_groq, _plan_messages(state), "plan")
+    return {"plan": _parse_plan(plan_msg.content, user_text), **_TURN_RESET}
+
+
+async def aplan_with_groq(state: State):
+    """Versión async de plan_with_groq (no bloquea el event loop mientras Groq responde)."""
+    if not state.get("access_granted", False):
+        return _ACCESS_DENIED
+    user_text = get_last_user_message(state)
+    plan, confidence = fast_plan(user_text)
+    if plan is not None and confidence >= FAST_PLAN_MIN_CONFIDENCE:
+        _count_planner_path("fast_path")
+        return {"plan": plan, **_TURN_RESET}
+    plan_msg = await acached_invoke(llm_groq, _plan_messages(state), "plan")
+    return {"plan": _parse_plan(plan_msg.content, user_text), **_TURN_RESET}
 
 
 def should_clarify(state: State) -> Literal["clarify", "exec"]:
@@ -467,103 +673,330 @@ def ask_for_clarification(state: State):
     return {"messages": [AIMessage(content=question)]}
 
 
-def execute_db_actions(state: State):
-    """Ejecuta acciones planificadas en la BD (si el rol lo permite)."""
-    plan: Dict[str, Any] = state.get("plan") or {}
-    user_role = state.get("user_role")
-    user_text = get_last_user_message(state)
+# Hilos para las acciones de BD, compartidos por todas las peticiones del proceso (cada acción
+# usa su conexión del pool): por defecto tantos como conexiones tiene el pool
+DB_ACTION_WORKERS = int(os.getenv("DB_ACTION_WORKERS") or DB_POOL_MAX)
+_action_executor = ThreadPoolExecutor(max_workers=DB_ACTION_WORKERS, thread_name_prefix="db-action")
+
+_TABLE_ACTIONS = ("columns", "rowcount", "sample", "export")
+_KNOWN_ACTIONS = ("overview", "count_tables", "list_tables") + _TABLE_ACTIONS
 
+def _plan_actions(state: State) -> List[Dict[str, Any]]:
+    """Acciones del plan que son objetos; el plan del LLM puede traer cualquier cosa."""
+    plan = state.get("plan")
+    actions = plan.get("actions") if isinstance(plan, dict) else None
+    return [a for a in actions if isinstance(a, dict)] if isinstance(actions, list) else []
+
+
+def _check_action_permissions(state: State) -> Optional[Dict[str, Any]]:
     # Restringir acciones globales para roles: solo administrador puede ver metadatos globales
-    if user_role != "administrador":
-        if any(a.get("type") in ("count_tables", "list_tables", "overview") for a in plan.get("actions", [])):
+    if state.get("user_role") != "administrador":
+        if any(a.get("type") in ("count_tables", "list_tables", "overview") for a in _plan_actions(state)):
             return {"messages": [AIMessage(content="❌ No tienes permisos para consultar metadatos globales de BD.")]}
+        if any(a.get("type") == "export" for a in _plan_actions(state)):
+            return {"messages": [AIMessage(content="❌ Solo un administrador puede exportar tablas.")]}
+    return None
 
-    db_results: List[Dict[str, Any]] = []
+
+def _planned_actions(state: State) -> List[Dict[str, Any]]:
+    """Acciones conocidas del plan, con la tabla ya decidida (del plan o del texto).
+
+    Una tabla que no es texto (p. ej. una lista inventada por el LLM) se descarta y la acción
+    queda marcada con `invalid_table` para que responda con su propio error.
+    """
+    user_text = get_last_user_message(state)
+    actions = []
+    for action in _plan_actions(state):
+        if action.get("type") not in _KNOWN_ACTIONS:
+            continue
+        if action["type"] in _TABLE_ACTIONS:
+            table = action.get("table")
+            if table and not isinstance(table, str):
+                action = {**action, "table": None, "invalid_table": repr(table)}
+            else:
+                action = {**action, "table": table or extract_table_mention(user_text)}
+        actions.append(action)
+    return actions
+
+
+def _safe_resolve(raw: str):
+    """Resuelve la tabla; si la BD falla devuelve la excepción para que la acción la reporte."""
     try:
-        for action in plan.get("actions", []):
-            a_type = action.get("type")
-            if a_type == "overview":
-                overview = get_db_overview()
-                db_results.append({"action": a_type, "result": overview})
-            elif a_type == "count_tables":
-                total = get_table_count()
-                db_results.append({"action": a_type, "result": total})
-            elif a_type == "list_tables":
-                rows = get_table_list()
-                db_results.append({"action": a_type, "result": [f"{s}.{t}" for s, t in rows]})
-            elif a_type in ("columns", "rowcount", "sample"):
-                raw = action.get("table") or extract_table_mention(user_text)
-                if not raw:
-                    db_results.append({"action": a_type, "error": "Tabla no especificada"})
-                    continue
-                schema, table, err = resolve_table_identifier(raw)
-                if err:
-                    db_results.append({"action": a_type, "error": err})
-                    continue
-                if a_type == "columns":
-                    cols = get_columns(schema, table)
-                    db_results.append({
-                        "action": a_type,
-                        "table": f"{schema}.{table}",
-                        "result": [{"name": c, "type": t, "nullable": n} for c, t, n in cols],
-                    })
-                elif a_type == "rowcount":
-                    cnt = get_row_count_for_table(schema, table)
-                    db_results.append({"action": a_type, "table": f"{schema}.{table}", "result": cnt})
-                else:  # sample
-                    limit = int(action.get("limit") or 5)
-                    rows = get_sample_rows(schema, table, limit=limit)
-                    if not rows:
-                        db_results.append({"action": a_type, "table": f"{schema}.{table}", "result": []})
-                    else:
-                        headers = rows[0]
-                        data = [dict(zip(headers, r)) for r in rows[1:]]
-                        db_results.append({"action": a_type, "table": f"{schema}.{table}", "result": data})
+        return resolve_table_identifier(raw)
     except Exception as e:
-        return {"messages": [AIMessage(content=f"Error al consultar la BD: {e}")]}
+        return e
 
+
+def _run_action(action: Dict[str, Any], resolutions: Dict[str, Any]) -> Dict[str, Any]:
+    """Ejecuta una acción; los errores quedan en su propio resultado sin afectar a las demás."""
+    a_type = action.get("type")
+    try:
+        if a_type == "overview":
+            return {"action": a_type, "result": get_db_overview()}
+        if a_type == "count_tables":
+            return {"action": a_type, "result": get_table_count()}
+        if a_type == "list_tables":
+            rows = get_table_list()
+            return {"action": a_type, "result": [f"{s}.{t}" for s, t in rows]}
+
+        if action.get("invalid_table"):
+            return {"action": a_type, "error": f"Tabla no válida: {action['invalid_table']}"}
+        raw = action.get("table")
+        if not raw:
+            return {"action": a_type, "error": "Tabla no especificada"}
+        resolved = resolutions[raw]
+        if isinstance(resolved, Exception):
+            raise resolved
+        schema, table, err = resolved
+        if err:
+            return {"action": a_type, "error": err}
+        if a_type == "columns":
+            cols = get_columns(schema, table)
+            return {
+                "action": a_type,
+                "table": f"{schema}.{table}",
+                "result": [{"name": c, "type": t, "nullable": n} for c, t, n in cols],
+            }
+        if a_type == "rowcount":
+            cnt = count_rows(schema, table, exact=bool(action.get("exact")))
+            return {
+                "action": a_type,
+                "table": f"{schema}.{table}",
+                "result": cnt["count"],
+                "exact": cnt["exact"],
+                "method": cnt["method"],
+            }
+        if a_type == "export":
+            # Al chat (y a los LLM) solo llega una vista previa acotada; los datos van por la descarga
+            fmt = action.get("format") if action.get("format") in EXPORT_FORMATS else "csv"
+            rows = get_sample_rows(schema, table, limit=EXPORT_PREVIEW_ROWS)
+            cnt = count_rows(schema, table)
+            return {
+                "action": a_type,
+                "table": f"{schema}.{table}",
+                "format": fmt,
+                "url": export_url(schema, table, fmt),
+                "rows": cnt["count"],
+                "exact": cnt["exact"],
+                "result": [dict(zip(rows[0], r)) for r in rows[1:]] if rows else [],
+            }
+        # sample
+        limit = int(action.get("limit") or 5)
+        rows = get_sample_rows(schema, table, limit=limit)
+        if not rows:
+            return {"action": a_type, "table": f"{schema}.{table}", "result": []}
+        headers = rows[0]
+        data = [dict(zip(headers, r)) for r in rows[1:]]
+        return {"action": a_type, "table": f"{schema}.{table}", "result": data}
+    except Exception as e:
+        return {"action": a_type, "error": f"Error al consultar la BD: {e}", "db_error": True}
+
+
+def _collect_results(db_results: List[Dict[str, Any]]):
+    # Si fallaron todas las consultas (p. ej. BD caída) se informa directamente
+    if db_results and all(r.get("db_error") for r in db_results):
+        return {"messages": [AIMessage(content=db_results[0]["error"])]}
+    for r in db_results:
+        r.pop("db_error", None)
     return {"db_results": db_results}
 
 
-def should_reason(state: State) -> Literal["reason", "end"]:
+def execute_db_actions(state: State):
+    """Ejecuta acciones planificadas en la BD (si el rol lo permite).
+
+    Las acciones son independientes: se ejecutan en paralelo en un pool acotado de hilos,
+    cada tabla mencionada se resuelve una sola vez y los resultados conservan el orden del plan.
+    """
+    denied = _check_action_permissions(state)
+    if denied:
+        return denied
+    actions = _planned_actions(state)
+    raws = list(dict.fromkeys(a["table"] for a in actions if a.get("table")))
+
+    if len(actions) <= 1:
+        resolutions = {raw: _safe_resolve(raw) for raw in raws}
+        return _collect_results([_run_action(a, resolutions) for a in actions])
+
+    # propagate(): los hilos del pool no heredan la traza de la petición (src/metrics.py)
+    resolutions = dict(zip(raws, _action_executor.map(propagate(_safe_resolve), raws)))
+    run = propagate(_run_action)
+    return _collect_results(list(_action_executor.map(lambda a: run(a, resolutions), actions)))
+
+
+async def aexecute_db_actions(state: State):
+    """Versión async: las consultas (psycopg2, bloqueantes) corren en el pool de hilos de
+    acciones, en paralelo; el pool de conexiones limita cuántas llegan a la BD a la vez.
+    """
+    denied = _check_action_permissions(state)
+    if denied:
+        return denied
+    actions = _planned_actions(state)
+    raws = list(dict.fromkeys(a["table"] for a in actions if a.get("table")))
+
+    loop = asyncio.get_running_loop()
+    resolve, run = propagate(_safe_resolve), propagate(_run_action)
+    resolved = await asyncio.gather(*(loop.run_in_executor(_action_executor, resolve, raw) for raw in raws))
+    resolutions = dict(zip(raws, resolved))
+    db_results = await asyncio.gather(
+        *(loop.run_in_executor(_action_executor, run, a, resolutions) for a in actions)
+    )
+    return _collect_results(list(db_results))
+
+
+# ------------------ RUTEO SEGÚN RESULTADOS ------------------
+
+# Qué camino sigue cada tipo de acción tras ejecutarse, según el estilo del usuario:
+#   "reason"   -> Gemini razona y Groq redacta (dos llamadas LLM)
+#   "finalize" -> solo Groq redacta
+#   "template" -> respuesta con plantilla, sin LLM
+# Con varias acciones gana el camino más costoso. Se puede sobreescribir con la
+# variable RESULT_ROUTING (JSON), p. ej. {"columns": {"technical": "template"}}.
+RESULT_ROUTING: Dict[str, Dict[str, str]] = {
+    "overview": {"technical": "template", "non_technical": "template"},
+    "count_tables": {"technical": "template", "non_technical": "finalize"},
+    "list_tables": {"technical": "template", "non_technical": "finalize"},
+    "rowcount": {"technical": "template", "non_technical": "finalize"},
+    "columns": {"technical": "finalize", "non_technical": "reason"},
+    "sample": {"technical": "reason", "non_technical": "reason"},
+    "export": {"technical": "template", "non_technical": "finalize"},
+}
+# Sin acciones (conversación general) o con acciones desconocidas
+DEFAULT_RESULT_ROUTE = "reason"
+
+_ROUTE_COST = {"template": 0, "finalize": 1, "reason": 2}
+
+
+def _apply_result_routing(raw: str) -> None:
+    """Aplica RESULT_ROUTING sobre los valores por defecto; un error de configuración falla
+    al arrancar (RuntimeError) en vez de en cada petición."""
+    try:
+        overrides = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"RESULT_ROUTING no es JSON válido: {e}") from e
+    if not isinstance(overrides, dict):
+        raise RuntimeError("RESULT_ROUTING debe ser un objeto {acción: {estilo: ruta}}.")
+    for action, routes in overrides.items():
+        if action not in _KNOWN_ACTIONS:
+            raise RuntimeError(f"RESULT_ROUTING: acción desconocida '{action}' (válidas: {', '.join(_KNOWN_ACTIONS)}).")
+        if not isinstance(routes, dict):
+            raise RuntimeError(f"RESULT_ROUTING['{action}'] debe ser un objeto {{estilo: ruta}}.")
+        for style, route in routes.items():
+            if style not in ("technical", "non_technical"):
+                raise RuntimeError(f"RESULT_ROUTING['{action}']: estilo desconocido '{style}' (válidos: technical, non_technical).")
+            if route not in _ROUTE_COST:
+                raise RuntimeError(f"RESULT_ROUTING['{action}']['{style}']: ruta desconocida '{route}' (válidas: {', '.join(_ROUTE_COST)}).")
+        RESULT_ROUTING[action].update(routes)
+
+
+if os.getenv("RESULT_ROUTING"):
+    _apply_result_routing(os.getenv("RESULT_ROUTING"))
+
+
+def should_reason(state: State) -> Literal["reason", "finalize", "template", "end"]:
     # Si ya se devolvió un mensaje (p. ej. error/permiso) y no hay resultados, terminamos.
     if state.get("db_results") is None and state.get("messages"):
         return "end"
-    return "reason"
+    db_results = state.get("db_results") or []
+    if not db_results:
+        return DEFAULT_RESULT_ROUTE
+    style = state.get("style", "non_technical")
+    route = "template"
+    for r in db_results:
+        # Los errores se explican con el LLM (al menos el redactor final)
+        r_route = RESULT_ROUTING.get(r.get("action"), {}).get(style, DEFAULT_RESULT_ROUTE)
+        if "error" in r and r_route == "template":
+            r_route = "finalize"
+        if _ROUTE_COST[r_route] > _ROUTE_COST[route]:
+            route = r_route
+    return route
+
+
+def _render_result(r: Dict[str, Any], technical: bool) -> str:
+    action = r.get("action")
+    table = r.get("table", "")
+    if "error" in r:
+        return f"⚠️ {r['error']}"
+    result = r.get("result")
+    if action == "overview":
+        return str(result)
+    if action == "count_tables":
+        return f"Hay {result} tablas en la base de datos." if technical else f"Hay {result} conjuntos de datos registrados."
+    if action == "list_tables":
+        return "\n".join([f"Tablas ({len(result)}):"] + [f"- {t}" for t in result])
+    if action == "rowcount":
+        amount = f"{result:,}" if r.get("exact", True) else f"aproximadamente {result:,}"
+        suffix = "" if r.get("exact", True) else " (estimación de las estadísticas de PostgreSQL)"
+        return f"La tabla {table} tiene {amount} filas{suffix}." if technical else f"Hay {amount} registros en {table.split('.')[-1]}."
+    if action == "export":
+        amount = f"{r['rows']:,}" if r.get("exact", True) else f"~{r['rows']:,}"
+        lines = [f"Exportación de {table} ({amount} filas, {r['format'].upper()}): {r['url']}"]
+        if result:
+            lines.append(f"Vista previa ({len(result)} filas):")
+            lines += [json.dumps(row, ensure_ascii=False, default=str) for row in result]
+        return "\n".join(lines)
+    if action == "columns":
+        lines = [f"Columnas de {table}:"]
+        for c in result:
+            lines.append(f"- {c['name']}: {c['type']}" + ("" if c["nullable"] == "YES" else " (NOT NULL)"))
+        return "\n".join(lines)
+    return json.dumps(r, ensure_ascii=False, default=str)
+
+
+def respond_with_template(state: State):
+    """Responde resultados simples con plantillas, sin llamar a ningún LLM."""
+    technical = state.get("style") == "technical"
+    db_results = state.get("db_results") or []
+    text = "\n\n".join(_render_result(r, technical) for r in db_results)
+    return {"messages": [AIMessage(content=text)]}
+
+
+def _reason_messages(state: State) -> List[BaseMessage]:
+    return [
+        SystemMessage(content="Razonador de consultas de BD"),
+        HumanMessage(content=json.dumps({
+            "plan": state.get("plan") or {},
+            "user": get_last_user_message(state),
+            "role": state.get("user_role"),
+            "db_results": state.get("db_results") or [],
+        }, ensure_ascii=False, default=str))
+    ]
 
 
 def reason_with_gemini(state: State):
     """Gemini razona sobre plan + resultados."""
-    plan: Dict[str, Any] = state.get("plan") or {}
-    db_results = state.get("db_results") or []
-    user_role = state.get("user_role")
-    user_text = get_last_user_message(state)
+    gemini_msg = cached_invoke(llm_gemini, _reason_messages(state), "reason", **_answer_cache_args(state))
+    return {"reasoned_answer": gemini_msg.content}
 
-    gemini_msg = llm_gemini.invoke([
-        SystemMessage(content="Razonador de consultas de BD"),
-        HumanMessage(content=json.dumps({
-            "plan": plan,
-            "user": user_text,
-            "role": user_role,
-            "db_results": db_results,
-        }, ensure_ascii=False))
-    ])
+
+async def areason_with_gemini(state: State):
+    """Versión async de reason_with_gemini."""
+    gemini_msg = await acached_invoke(llm_gemini, _reason_messages(state), "reason", **_answer_cache_args(state))
     return {"reasoned_answer": gemini_msg.content}
 
 
-def finalize_with_groq(state: State):
-    """Groq orquesta y entrega la respuesta final (o passthrough de overview)."""
-    plan: Dict[str, Any] = state.get("plan") or {}
+def _overview_passthrough(state: State) -> Optional[str]:
+    """Si hay un overview entre los resultados, se devuelve tal cual (sin LLM)."""
     db_results = state.get("db_results") or []
-    user_role = state.get("user_role")
-    user_text = get_last_user_message(state)
-    reasoned = state.get("reasoned_answer")
-
-    # Si es overview, devolver tal cual
     if any(r.get("action") == "overview" for r in db_results):
-        overview_text = next((r.get("result") for r in db_results if r.get("action") == "overview"), reasoned or "")
-        return {"messages": [AIMessage(content=overview_text)]}
+        return next((r.get("result") for r in db_results if r.get("action") == "overview"), state.get("reasoned_answer") or "")
+    return None
+
+
+# Turnos previos (ya acotados por tokens en el servidor) que se pasan al redactor final
+FINALIZE_CONTEXT_TURNS = int(os.getenv("FINALIZE_CONTEXT_TURNS", "6"))
 
+
+def _conversation_context(state: State) -> Dict[str, Any]:
+    """Resumen acumulado + últimos turnos previos al mensaje actual, para dar continuidad."""
+    previous = [m for m in state.get("messages", [])[:-1] if isinstance(m, (HumanMessage, AIMessage))]
+    recent = previous[-FINALIZE_CONTEXT_TURNS:] if FINALIZE_CONTEXT_TURNS > 0 else []
+    return {
+        "summary": state.get("conversation_summary") or "",
+        "recent": [{"role": "user" if isinstance(m, HumanMessage) else "assistant", "content": str(m.content)} for m in recent],
+    }
+
+
+def _finalize_messages(state: State) -> List[BaseMessage]:
     # Adaptar el tono final según el estilo y el nombre del usuario
     style = state.get("style", "non_technical")
     user_name = state.get("user_name")
@@ -571,32 +1004,61 @@ def finalize_with_groq(state: State):
     sys_instruction = "Orquestador - respuesta final"
     if style == "non_technical":
         sys_instruction += ": Redacta sin tecnicismos (no mencionar SQL, tablas, esquemas, índices). Enfoca en impacto práctico y pasos claros."
-    if user_name:
-        sys_instruction += f" Personaliza el saludo usando el nombre {user_name} cuando sea natural."
+    sys_instruction += " Si un conteo tiene exact=false, indica que es aproximado."
+    sys_instruction += " Si hay una exportación, incluye su url de descarga tal cual."
 
-    groq_final = llm_groq.invoke([
-        SystemMessage(content=sys_instruction),
+    return [
+        render_system_context(state, sys_instruction),
         HumanMessage(content=json.dumps({
-            "user": user_text,
-            "role": user_role,
+            "user": get_last_user_message(state),
+            "role": state.get("user_role"),
             "style": style,
             "user_name": user_name,
-            "plan": plan,
-            "db_results": db_results,
-            "reasoned_answer": reasoned,
-        }, ensure_ascii=False))
-    ])
+            "plan": state.get("plan") or {},
+            "db_results": state.get("db_results") or [],
+            "reasoned_answer": state.get("reasoned_answer"),
+            "conversation": _conversation_context(state),
+        }, ensure_ascii=False, default=str))
+    ]
+
+
+def finalize_with_groq(state: State):
+    """Groq orquesta y entrega la respuesta final (o passthrough de overview)."""
+    overview_text = _overview_passthrough(state)
+    if overview_text is not None:
+        return {"messages": [AIMessage(content=overview_text)]}
+    groq_final = cached_invoke(llm_groq, _finalize_messages(state), "finalize", **_answer_cache_args(state))
+    return {"messages": [AIMessage(content=groq_final.content)]}
+
+
+async def afinalize_with_groq(state: State):
+    """Versión async de finalize_with_groq."""
+    overview_text = _overview_passthrough(state)
+    if overview_text is not None:
+        return {"messages": [AIMessage(content=overview_text)]}
+    groq_final = await acached_invoke(llm_groq, _finalize_messages(state), "finalize", **_answer_cache_args(state))
     return {"messages": [AIMessage(content=groq_final.content)]}
 
 
 # ------------------ GRAFO ------------------
 _builder = StateGraph(State)
-_builder.add_node("check_access", check_user_access)
-_builder.add_node("plan", plan_with_groq)
-_builder.add_node("clarify", ask_for_clarification)
-_builder.add_node("execute", execute_db_actions)
-_builder.add_node("reason", reason_with_gemini)
-_builder.add_node("finalize", finalize_with_groq)
+
+
+def _node(name: str, func, afunc=None):
+    """Nodo instrumentado (src/metrics.py): tiempo, consultas, tokens y caché por nodo."""
+    if afunc is None:
+        return traced_node(name, func)
+    return RunnableLambda(traced_node(name, func), afunc=traced_node(name, afunc))
+
+
+_builder.add_node("check_access", _node("check_access", check_user_access))
+# Cada nodo con E/S tiene versión sync (agent.invoke) y async (agent.ainvoke)
+_builder.add_node("plan", _node("plan", plan_with_groq, aplan_with_groq))
+_builder.add_node("clarify", _node("clarify", ask_for_clarification))
+_builder.add_node("execute", _node("execute", execute_db_actions, aexecute_db_actions))
+_builder.add_node("reason", _node("reason", reason_with_gemini, areason_with_gemini))
+_builder.add_node("finalize", _node("finalize", finalize_with_groq, afinalize_with_groq))
+_builder.add_node("template", _node("template", respond_with_template))
 
 _builder.add_edge(START, "check_access")
 
@@ -618,12 +1080,14 @@ _builder.add_conditional_edges(
 )
 _builder.add_edge("clarify", END)
 
-# Tras ejecutar, si no hay resultados por error/permiso, terminamos; si hay, razonamos
+# Tras ejecutar, si no hay resultados por error/permiso, terminamos; si hay, se elige
+# entre razonar (Gemini + Groq), solo redactar (Groq) o plantilla (sin LLM)
 _builder.add_conditional_edges(
     "execute",
     should_reason,
-    {"reason": "reason", "end": END},
+    {"reason": "reason", "finalize": "finalize", "template": "template", "end": END},
 )
+_builder.add_edge("template", END)
 _builder.add_edge("reason", "finalize")
 _builder.add_edge("finalize", END)
 
@@ -1,12 +1,13 @@
 """
 Script de prueba para el agente Galleta con memoria conversacional
 """
-from src.main import builder
+import os
+from src.main import build_checkpointer, builder
 from langchain_core.messages import HumanMessage
-from langgraph.checkpoint.memory import MemorySaver
 
-# Compilar el agente con memoria para uso local
-memory = MemorySaver()
+# Compilar el agente con memoria para uso local (durable en SQLite salvo que se indique otra
+# con GALLETA_CHECKPOINTER=memory|postgres); las conversaciones sobreviven entre ejecuciones
+memory = build_checkpointer(os.getenv("GALLETA_CHECKPOINTER", "sqlite"))
 agent = builder.compile(checkpointer=memory)
 
 def chat_with_galleta():
@@ -91,12 +92,346 @@ def run_automated_tests():
     print("✅ PRUEBAS COMPLETADAS")
     print("="*60 + "\n")
 
+def run_context_checks(turnos: int = 100):
+    """
+    El contexto de sistema de src/simple.py no se acumula: en una conversación de `turnos`
+    turnos (con checkpointer, como un hilo real) el SystemMessage que recibe el LLM tiene los
+    mismos tokens en el turno 1 que en el último y `messages` nunca guarda mensajes de sistema.
+    Usa un modelo falso: no llama a Groq/Gemini ni a la BD.
+    """
+    import json
+    from langchain_core.messages import AIMessage, SystemMessage
+    from langchain_core.messages.utils import count_tokens_approximately
+    from langgraph.checkpoint.memory import MemorySaver
+    import src.llm_cache as llm_cache_module
+    from src import simple
+
+    print("\n" + "="*60)
+    print(f"📏 CONTEXTO DE SISTEMA EN {turnos} TURNOS")
+    print("="*60)
+
+    system_tokens = []
+
+    class ModeloFalso:
+        model_name = "falso"
+
+        def invoke(self, messages, *args, **kwargs):
+            texto = str(messages[-1].content)
+            if texto.startswith("Eres un planificador"):
+                return AIMessage(content=json.dumps({"intent": "general", "actions": [], "clarifications": []}))
+            sistema = [m for m in messages if isinstance(m, SystemMessage)]
+            if "respuesta final" in str(sistema[0].content if sistema else ""):
+                assert len(sistema) == 1, f"El redactor recibió {len(sistema)} mensajes de sistema"
+                system_tokens.append(count_tokens_approximately(sistema))
+            return AIMessage(content="De acuerdo.")
+
+    originales = (simple.llm_groq, simple.llm_gemini, llm_cache_module.llm_cache)
+    simple.llm_groq = simple.llm_gemini = ModeloFalso()
+    llm_cache_module.llm_cache = None
+    try:
+        graph = simple._builder.compile(checkpointer=MemorySaver())
+        config = {"configurable": {"thread_id": "context-check"}}
+        for n in range(1, turnos + 1):
+            state = graph.invoke(
+                {"messages": [HumanMessage(content=f"Cuéntame algo interesante, van {n} mensajes")],
+                 "user_role": "empleado", "user_id": 7, "user_name": "Carlos"},
+                config=config,
+            )
+            assert not any(isinstance(m, SystemMessage) for m in state["messages"]), f"Mensaje de sistema en messages (turno {n})"
+    finally:
+        simple.llm_groq, simple.llm_gemini, llm_cache_module.llm_cache = originales
+
+    assert len(system_tokens) == turnos, f"Se esperaban {turnos} llamadas al redactor, hubo {len(system_tokens)}"
+    print(f"Tokens del SystemMessage: turno 1 = {system_tokens[0]}, turno {turnos} = {system_tokens[-1]}")
+    print(f"Mensajes en el estado tras {turnos} turnos: {len(state['messages'])} (sin mensajes de sistema)")
+    assert system_tokens[-1] == system_tokens[0] and len(set(system_tokens)) == 1, "El contexto de sistema creció"
+    print("✅ El contexto de sistema se mantiene constante")
+def run_reservation_stress_test(num_threads: int = 16, reservas_por_hilo: int = 5000, cupos_por_viaje: int = 15000):
+    """
+    Prueba de concurrencia del motor de reservaciones (sin LLM).
+    Varios hilos reservan a la vez sobre pocos viajes; al final no debe haber
+    sobreventa: cupos vendidos + cupos restantes == cupos iniciales.
+    """
+    import random
+    import threading
+    import time
+    from src.reservas import ReservationEngine
+
+    print("\n" + "="*60)
+    print("🧪 PRUEBA DE CONCURRENCIA DE RESERVACIONES")
+    print("="*60)
+
+    viajes = [
+        {"id": i, "destino": f"Destino {i}", "precio": 100.0 * i, "cupos_disponibles": cupos_por_viaje}
+        for i in range(1, 9)
+    ]
+    cupos_iniciales = sum(v["cupos_disponibles"] for v in viajes)
+    engine = ReservationEngine(viajes)
+    resultados = [[] for _ in range(num_threads)]
+    inicio = threading.Barrier(num_threads)
+
+    def worker(n: int):
+        rnd = random.Random(n)
+        inicio.wait()
+        for _ in range(reservas_por_hilo):
+            r = engine.reservar(f"user-{n}", rnd.randint(1, len(viajes)), rnd.randint(1, 3))
+            resultados[n].append(r)
+
+    hilos = [threading.Thread(target=worker, args=(n,)) for n in range(num_threads)]
+    t0 = time.perf_counter()
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    elapsed = time.perf_counter() - t0
+
+    todas = [r for rs in resultados for r in rs]
+    exitosas = [r for r in todas if r["success"]]
+    vendidos = sum(r["num_personas"] for r in exitosas)
+    restantes = sum(v["cupos_disponibles"] for v in viajes)
+    ids = [r["reservacion_id"] for r in exitosas]
+
+    print(f"Intentos: {len(todas)} en {elapsed:.2f}s ({len(todas) / elapsed:,.0f} reservas/s)")
+    print(f"Confirmadas: {len(exitosas)} | cupos vendidos: {vendidos} | restantes: {restantes}")
+    assert vendidos + restantes == cupos_iniciales, "¡Sobreventa o cupos perdidos!"
+    assert all(v["cupos_disponibles"] >= 0 for v in viajes), "¡Cupos negativos!"
+    assert len(ids) == len(set(ids)), "¡IDs de reservación duplicados!"
+    assert sum(len(engine.reservaciones_de(f"user-{n}")) for n in range(num_threads)) == len(exitosas)
+    print("✅ Sin sobreventa, IDs únicos e índices por usuario consistentes")
+
+def run_catalog_index_benchmark(num_viajes: int = 100_000, repeticiones: int = 200):
+    """
+    Mide el índice de búsqueda del catálogo con un catálogo sintético grande y
+    compara cada resultado con un filtrado lineal (mismos viajes, mismo orden).
+    """
+    import random
+    import time
+    from datetime import date, timedelta
+    from src.reservas import CatalogIndex, normalizar
+
+    print("\n" + "="*60)
+    print(f"🔎 ÍNDICE DEL CATÁLOGO ({num_viajes:,} viajes)")
+    print("="*60)
+
+    rnd = random.Random(7)
+    ciudades = ["Cancún", "París", "Cusco", "Tokyo", "Cartagena", "Nueva York", "Barcelona", "Río de Janeiro", "Bogotá", "Mérida"]
+    temas = ["playa", "montaña", "museos", "gastronomía", "aventura", "historia", "nieve", "selva"]
+    viajes = []
+    for i in range(1, num_viajes + 1):
+        salida = date(2026, 1, 1) + timedelta(days=rnd.randint(0, 364))
+        viajes.append({
+            "id": i,
+            "destino": f"{rnd.choice(ciudades)} {i}",
+            "descripcion": f"Viaje de {rnd.choice(temas)} y {rnd.choice(temas)}.",
+            "precio": round(rnd.uniform(300, 5000), 2),
+            "fecha_salida": salida.isoformat(),
+            "fecha_regreso": (salida + timedelta(days=7)).isoformat(),
+            "cupos_disponibles": rnd.randint(0, 30),
+        })
+
+    t0 = time.perf_counter()
+    index = CatalogIndex(viajes)
+    print(f"Construcción: {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    consultas = [
+        {"precio_max": 800, "salida_desde": "2026-12", "salida_hasta": "2026-12", "min_cupos": 4},
+        {"texto": "playa", "precio_max": 1000},
+        {"texto": "paris", "salida_desde": "2026-06-01", "salida_hasta": "2026-06-15"},
+        {"texto": "cancun 123"},
+        {"salida_desde": "2026-03-01", "salida_hasta": "2026-03-01", "min_cupos": 20},
+        {"min_cupos": 1},
+    ]
+
+    def lineal(texto=None, precio_max=None, salida_desde=None, salida_hasta=None, min_cupos=1):
+        palabras = normalizar(texto or "").split()
+        res = [
+            v for v in viajes
+            if v["cupos_disponibles"] >= min_cupos
+            and (precio_max is None or v["precio"] <= precio_max)
+            and (not salida_desde or v["fecha_salida"] >= salida_desde)
+            and (not salida_hasta or v["fecha_salida"][:len(salida_hasta)] <= salida_hasta)
+            and all(any(w.startswith(p) for w in normalizar(v["destino"] + " " + v["descripcion"]).replace(".", " ").split()) for p in palabras)
+        ]
+        return sorted(res, key=lambda v: (v["precio"], v["id"]))[:20]
+
+    peor = 0.0
+    for q in consultas:
+        esperado = [v["id"] for v in lineal(**q)]
+        obtenido = [v["id"] for v in index.buscar(**q)]
+        assert obtenido == esperado, f"Resultado distinto para {q}"
+        t0 = time.perf_counter()
+        for _ in range(repeticiones):
+            index.buscar(**q)
+        ms = (time.perf_counter() - t0) * 1000 / repeticiones
+        peor = max(peor, ms)
+        print(f"{ms:7.3f} ms  {len(obtenido):2d} resultados  {q}")
+    print(f"{'✅' if peor < 1 else '⚠️'} Peor consulta: {peor:.3f} ms")
+
+def run_fast_plan_checks():
+    """
+    Casos del planificador por reglas de src/simple.py (sin LLM ni BD): tabla detectada
+    y si la confianza alcanza para saltarse a Groq.
+    """
+    from src.simple import FAST_PLAN_MIN_CONFIDENCE, fast_plan
+
+    print("\n" + "="*60)
+    print("🧭 PLANIFICADOR RÁPIDO")
+    print("="*60)
+
+    # (mensaje, tipo de acción esperado o None si debe decidir el LLM, tabla esperada)
+    casos = [
+        ("¿Qué columnas tiene la tabla viajes?", "columns", "viajes"),
+        ("cuántas filas tiene la tabla de reservaciones", "rowcount", "reservaciones"),
+        ("¿Cuántas filas tiene la tabla del reservaciones?", "rowcount", "reservaciones"),
+        ("Muestra filas de la tabla public.viajes, primeros 10", "sample", "public.viajes"),
+        ("¿Dónde puede ver las columnas de viajes?", "columns", "viajes"),
+        ("Describe la tabla de la base", None, None),
+        ("Columnas de la tabla viajes y de la tabla reservaciones", None, None),
+    ]
+    for texto, tipo, tabla in casos:
+        plan, confianza = fast_plan(texto)
+        rapido = plan is not None and confianza >= FAST_PLAN_MIN_CONFIDENCE
+        accion = plan["actions"][0] if rapido and plan["actions"] else {}
+        print(f"{confianza:.2f}  {accion or '(LLM)'}  <- {texto}")
+        if tipo is None:
+            assert not rapido, f"No debía saltarse el LLM: {texto} -> {accion}"
+        else:
+            assert rapido and accion.get("type") == tipo and accion.get("table") == tabla, f"Plan inesperado: {texto} -> {plan}"
+    print("✅ Planes por reglas correctos")
+
+    run_turn_isolation_checks()
+
+def run_turn_isolation_checks():
+    """
+    Con checkpointer el estado persiste entre turnos: una conversación general seguida de
+    un conteo (ruta finalize, sin Gemini) y de una petición denegada no debe arrastrar el
+    razonamiento ni los resultados del turno anterior. Modelos falsos y BD simulada.
+    """
+    import json
+    from langchain_core.messages import AIMessage
+    from langgraph.checkpoint.memory import MemorySaver
+    from benchmarks.fake_llm import FakeChatModel
+    import src.llm_cache as llm_cache_module
+    from src import simple
+
+    redactor = []
+
+    def responder(messages):
+        texto = str(messages[-1].content)
+        if texto.startswith("Eres un planificador"):
+            acciones = [{"type": "list_tables"}] if "lista las tablas" in texto else []
+            return AIMessage(content=json.dumps({"intent": "general", "actions": acciones, "clarifications": []}))
+        if "Razonador" in str(messages[0].content):
+            return AIMessage(content="RAZONAMIENTO DEL TURNO 1")
+        redactor.append(json.loads(texto))
+        return AIMessage(content="De acuerdo.")
+
+    originales = (simple.llm_groq, simple.llm_gemini, llm_cache_module.llm_cache,
+                  simple.resolve_table_identifier, simple.count_rows)
+    simple.llm_groq = simple.llm_gemini = FakeChatModel(responder=responder)
+    llm_cache_module.llm_cache = None
+    simple.resolve_table_identifier = lambda raw: ("public", raw, None)
+    simple.count_rows = lambda schema, table, exact=False: {"count": 42, "exact": True, "method": "count"}
+    try:
+        graph = simple._builder.compile(checkpointer=MemorySaver())
+        config = {"configurable": {"thread_id": "turn-isolation"}}
+
+        def turno(texto):
+            return graph.invoke({"messages": [HumanMessage(content=texto)], "user_role": "empleado", "user_id": 7}, config=config)
+
+        turno("Hola, ¿cómo estás?")
+        assert redactor[-1]["reasoned_answer"] == "RAZONAMIENTO DEL TURNO 1"
+        state = turno("cuántas filas tiene la tabla viajes")
+        assert len(redactor) == 2, "El conteo debía ir solo al redactor"
+        assert redactor[-1]["reasoned_answer"] is None, f"Razonamiento arrastrado: {redactor[-1]['reasoned_answer']}"
+        assert [r["action"] for r in redactor[-1]["db_results"]] == ["rowcount"]
+        state = turno("lista las tablas")
+        assert len(redactor) == 2, "La petición denegada no debía llegar al redactor"
+        assert "permisos" in state["messages"][-1].content and state.get("db_results") is None
+    finally:
+        (simple.llm_groq, simple.llm_gemini, llm_cache_module.llm_cache,
+         simple.resolve_table_identifier, simple.count_rows) = originales
+    print("✅ Cada turno usa solo sus propios resultados (checkpointer)")
+
+def run_llm_cache_checks():
+    """
+    Nivel semántico de src/llm_cache.py con embeddings deterministas (sin red): al pasar
+    del tamaño máximo se desaloja primero lo vencido y luego lo más antiguo de cualquier grupo.
+    """
+    import hashlib
+    import time
+    from src.llm_cache import LLMCache
+
+    print("\n" + "="*60)
+    print("🗂️  CACHÉ SEMÁNTICA DE LLM")
+    print("="*60)
+
+    class HashEmbeddings:
+        def embed_query(self, text):
+            return [b - 128 for b in hashlib.sha256(text.encode("utf-8")).digest()]
+
+    size = 5
+    cache = LLMCache(sqlite_path=None, embeddings=HashEmbeddings(), semantic_size=size)
+
+    def put(i, ttl=None):
+        # Cada respuesta tiene su propio contexto (como al incluir plan y db_results): un grupo por entrada
+        cache.put(f"key-{i}", "finalize", f"respuesta {i}", ttl=ttl, semantic=("finalize", "m", f"ctx-{i}", f"pregunta {i}"))
+
+    def served(i):
+        # Otra clave exacta: solo puede responder el nivel semántico
+        return cache.get(f"otra-{i}", semantic=("finalize", "m", f"ctx-{i}", f"pregunta {i}"))
+
+    for i in range(3 * size):
+        put(i)
+        assert served(i) == f"respuesta {i}", f"La entrada recién guardada {i} no se sirve"
+    assert cache.stats()["semantic_entries"] == size
+    assert [served(i) for i in range(2 * size)] == [None] * (2 * size), "Quedaron entradas antiguas"
+    assert all(served(i) for i in range(2 * size, 3 * size))
+    print(f"✅ Tras {3 * size} entradas quedan las {size} más recientes y la última se sirve")
+
+    # Una entrada vencida se desaloja antes que la más antigua vigente
+    put(100, ttl=0.001)
+    time.sleep(0.01)
+    oldest = 2 * size + 1  # la de 2*size salió al entrar la vencida
+    put(101)
+    assert served(101) == "respuesta 101" and served(oldest) == f"respuesta {oldest}"
+    assert cache.stats()["semantic_entries"] == size
+    print("✅ Lo vencido sale primero")
+
+    # SQLite no acumula filas vencidas: se purgan solas cada `purge_every` escrituras
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LLMCache(sqlite_path=f"{tmp}/llm_cache.sqlite", purge_every=10)
+        for i in range(100):
+            cache.put(f"vencida-{i}", "finalize", "x", ttl=0.001)
+            time.sleep(0.002)
+        filas = cache._conn().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        assert filas < 10, f"Quedan {filas} filas vencidas en SQLite"
+        assert cache.stats()["purged"] >= 90
+        cache._conn().close()
+    print(f"✅ SQLite purgado: {filas} filas tras 100 escrituras vencidas")
+
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == "--test":
         # Ejecutar pruebas automatizadas
         run_automated_tests()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--context":
+        # El prompt de sistema no crece con la conversación (100 turnos)
+        run_context_checks()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--stress":
+        # Prueba de concurrencia del motor de reservaciones
+        run_reservation_stress_test()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--index":
+        # Rendimiento y exactitud del índice de búsqueda del catálogo
+        run_catalog_index_benchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--planner":
+        # Regresiones del planificador por reglas (nombres de tabla) y aislamiento entre turnos
+        run_fast_plan_checks()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--llm-cache":
+        # Desalojo del nivel semántico de la caché de LLM
+        run_llm_cache_checks()
     else:
         # Ejecutar chat interactivo
         chat_with_galleta()